@@ -21,12 +21,46 @@ from matplotlib.patches import Circle
 import cellpack.autopack as autopack
 from cellpack.autopack.ldSequence import halton
 from cellpack.autopack.plotly_result import PlotlyAnalysis
-from cellpack.autopack.utils import check_paired_key, get_paired_key, get_seed_list
+from cellpack.autopack.SharedGrid import SharedGrid
+from cellpack.autopack.utils import (
+    check_paired_key,
+    combine_binned_distances,
+    get_binned_count_below,
+    get_nearest_neighbor_statistics,
+    get_paired_key,
+    get_radial_distribution,
+    get_seed_list,
+    is_binned_distances,
+)
 from cellpack.autopack.writers import Writer
 from cellpack.autopack.writers.MarkdownWriter import MarkdownWriter
 
 log = logging.getLogger(__name__)
 
+# Analysis of the worker process, set once by _init_seed_worker
+_worker_analysis = None
+
+
+def _init_seed_worker(analysis, shared_grid_specs):
+    """attaches the grid arrays built by the main process"""
+    global _worker_analysis
+    t1 = time()
+    SharedGrid.attach(analysis.env.grid, shared_grid_specs)
+    _worker_analysis = analysis
+    log.debug(f"Time to attach the shared grid: {time() - t1:0.2f}")
+
+
+def _pack_seed_in_worker(**kwargs):
+    results = _worker_analysis.pack_one_seed(build_grid=False, **kwargs)
+    seed = int(kwargs["seed_list"][kwargs["seed_index"]])
+    return (
+        results,
+        seed,
+        _worker_analysis.seed_startup_times[seed],
+        _worker_analysis.seed_to_results[seed],
+        _worker_analysis.env.result_file,
+    )
+
 
 class Analysis:
     def __init__(
@@ -58,6 +92,10 @@ class Analysis:
         self.figures_path = self.output_path / "figures"
         self.figures_path.mkdir(parents=True, exist_ok=True)
         self.seed_to_results = {}
+        # seconds from the start of a seed to the start of its fill
+        self.seed_startup_times = {}
+        # bins of the pairwise distances, None keeps all the distances
+        self.distance_bin_edges = None
         self.helper = autopack.helper
 
     @staticmethod
@@ -149,6 +187,23 @@ class Analysis:
         Plots the distribution of distances for ingredient and pairs of ingredients
         """
         for ingr_key, distances in all_ingredient_distances.items():
+            if is_binned_distances(distances):
+                self.plot_binned_distances(
+                    distances,
+                    filename=self.figures_path
+                    / f"{ingr_key}_pairwise_distances_{self.env.basename}.png",
+                    title_str=ingr_key,
+                    x_label="pairwise distance",
+                    save_png=True,
+                )
+                radii, rdf = get_radial_distribution(distances)
+                self.plot(
+                    rdf,
+                    radii,
+                    self.figures_path / f"{ingr_key}_rdf_{self.env.basename}.png",
+                )
+                plt.close()
+                continue
             if len(distances) <= 1:
                 continue
             self.histogram(
@@ -212,11 +267,14 @@ class Analysis:
         """
         Returns the minimum distance between packed objects
         """
-        return min(
-            self.combine_results_from_ingredients(
-                self.combine_results_from_seeds(pairwise_distance_dict)
+        all_distances = self.combine_distances_from_seeds(pairwise_distance_dict)
+        if any(is_binned_distances(value) for value in all_distances.values()):
+            return min(
+                distances["nearest_neighbor"]["min"]
+                for distances in all_distances.values()
+                if distances["nearest_neighbor"]["min"] is not None
             )
-        )
+        return min(self.combine_results_from_ingredients(all_distances))
 
     def get_number_of_ingredients_packed(
         self,
@@ -289,7 +347,7 @@ class Analysis:
             recipe_data
         )
         if pairwise_distance_dict is not None:
-            all_pairwise_distances = self.combine_results_from_seeds(
+            all_pairwise_distances = self.combine_distances_from_seeds(
                 pairwise_distance_dict
             )
 
@@ -330,12 +388,24 @@ class Analysis:
                         )
                     )
 
-            df = pd.DataFrame(
-                {
-                    "Ingredient key": list(all_pairwise_distances.keys()),
-                    "Pairwise distance distribution": img_list,
-                }
-            )
+            table = {
+                "Ingredient key": list(all_pairwise_distances.keys()),
+                "Pairwise distance distribution": img_list,
+            }
+            if any(
+                is_binned_distances(value) for value in all_pairwise_distances.values()
+            ):
+                nearest_neighbor_distances = []
+                for distances in all_pairwise_distances.values():
+                    statistics = get_nearest_neighbor_statistics(distances)
+                    if statistics["count"]:
+                        nearest_neighbor_distances.append(
+                            f"{statistics['mean']:.2f} ± {statistics['std']:.2f}"
+                        )
+                    else:
+                        nearest_neighbor_distances.append("")
+                table["Nearest neighbor distance"] = nearest_neighbor_distances
+            df = pd.DataFrame(table)
 
             md_object.add_table(header="", table=df)
 
@@ -416,14 +486,17 @@ class Analysis:
             md_object.add_header(header="Partner Analysis")
             partner_data = []
             for paired_key, partner_values in partner_pair_dict.items():
-                pairwise_distances = numpy.array(
-                    combined_pairwise_distance_dict[paired_key]
-                )
+                pairwise_distances = combined_pairwise_distance_dict[paired_key]
                 padded_radius = 1.2 * partner_values["touching_radius"]
-                close_fraction = (
-                    numpy.count_nonzero(pairwise_distances < padded_radius)
-                    / partner_values["num_packed"]
-                )
+                if is_binned_distances(pairwise_distances):
+                    close_count = get_binned_count_below(
+                        pairwise_distances, padded_radius
+                    )
+                else:
+                    close_count = numpy.count_nonzero(
+                        numpy.array(pairwise_distances) < padded_radius
+                    )
+                close_fraction = close_count / partner_values["num_packed"]
                 partner_data.append(
                     {
                         "Ingredient pair": paired_key,
@@ -483,7 +556,7 @@ class Analysis:
             self.pairwise_distance_dict = self.read_dict_from_glob_file(
                 "pairwise_distances_*.json"
             )
-        combined_pairwise_distance_dict = self.combine_results_from_seeds(
+        combined_pairwise_distance_dict = self.combine_distances_from_seeds(
             self.pairwise_distance_dict
         )
 
@@ -611,6 +684,43 @@ class Analysis:
             plt.savefig(filename)
             plt.close()
 
+    def plot_binned_distances(
+        self,
+        binned_distances,
+        filename,
+        title_str="",
+        x_label="",
+        y_label="count",
+        add_to_result=True,
+        save_png=False,
+    ):
+        """
+        Histogram of binned distances, as histogram plots lists of distances
+        """
+        bin_edges = numpy.array(binned_distances["bin_edges"])
+        y = numpy.array(binned_distances["counts"])
+        bincenters = 0.5 * (bin_edges[1:] + bin_edges[:-1])
+        if add_to_result:
+            self.helper.plot_data.add_scatter(
+                title=f"{title_str}: {x_label}",
+                xaxis_title=x_label,
+                yaxis_title=y_label,
+                xtrace=bincenters,
+                ytraces={y_label: y},
+            )
+        if save_png:
+            plt.clf()
+            if y.sum() == 0:
+                return
+            y_err_vals = numpy.sqrt(y * (1 - y / numpy.sum(y)))
+            dbin = 0.9 * (bincenters[1] - bincenters[0]) if len(y) > 1 else 0.9
+            plt.bar(bincenters, y, width=dbin, color="r", yerr=y_err_vals)
+            plt.title(title_str)
+            plt.xlabel(x_label)
+            plt.ylabel(y_label)
+            plt.savefig(filename)
+            plt.close()
+
     def plot(self, rdf, radii, file_name):
         plt.clf()
         matplotlib.rc("font", size=14)
@@ -825,14 +935,20 @@ class Analysis:
             seed_distances_from_center,
             seed_distances_between_ingredients,
             seed_angles,
-        ) = self.env.get_distances_and_angles(ingr.name, center, get_angles=get_angles)
+        ) = self.env.get_distances_and_angles(
+            ingr.name, center, get_angles=get_angles, bin_edges=self.distance_bin_edges
+        )
 
         center_distance_dict[seed_index][
             ingr.name
         ] = seed_distances_from_center.tolist()
+        if not is_binned_distances(seed_distances_between_ingredients):
+            seed_distances_between_ingredients = (
+                seed_distances_between_ingredients.tolist()
+            )
         pairwise_distance_dict[seed_index][
             ingr.name
-        ] = seed_distances_between_ingredients.tolist()
+        ] = seed_distances_between_ingredients
         ingredient_position_dict[seed_index][
             ingr.name
         ] = seed_ingredient_positions.tolist()
@@ -863,9 +979,14 @@ class Analysis:
                 ingr.name,
                 ingr2.name,
             ):
-                pairwise_distance_dict[seed_index][f"{ingr.name}_{ingr2.name}"] = (
-                    self.env.calc_pairwise_distances(ingr.name, ingr2.name).tolist()
+                pairwise_distances = self.env.calc_pairwise_distances(
+                    ingr.name, ingr2.name, bin_edges=self.distance_bin_edges
                 )
+                if not is_binned_distances(pairwise_distances):
+                    pairwise_distances = pairwise_distances.tolist()
+                pairwise_distance_dict[seed_index][
+                    f"{ingr.name}_{ingr2.name}"
+                ] = pairwise_distances
 
         return pairwise_distance_dict
 
@@ -956,6 +1077,43 @@ class Analysis:
 
         return output_dict
 
+    def combine_distances_from_seeds(self, pairwise_distance_dict):
+        """
+        Combines the pairwise distances of multiple seeds, the lists of
+        distances are concatenated and the binned distances are summed
+        """
+        distances_dict = {}
+        for ingr_dict in pairwise_distance_dict.values():
+            for ingr_name, distances in ingr_dict.items():
+                distances_dict.setdefault(ingr_name, []).append(distances)
+        output_dict = {}
+        for ingr_name, distances_list in distances_dict.items():
+            binned_distances_list = [
+                distances
+                for distances in distances_list
+                if is_binned_distances(distances)
+            ]
+            if binned_distances_list:
+                output_dict[ingr_name] = combine_binned_distances(binned_distances_list)
+            else:
+                output_dict[ingr_name] = [
+                    distance for distances in distances_list for distance in distances
+                ]
+        return output_dict
+
+    def get_distance_bin_edges(self, distance_analysis_options):
+        """
+        Returns the bins of the pairwise distances from 0 to the cutoff of the
+        distance analysis options, or None to keep all the distances
+        """
+        if distance_analysis_options is None:
+            return None
+        return numpy.linspace(
+            0,
+            distance_analysis_options["cutoff"],
+            distance_analysis_options.get("number_of_bins", 100) + 1,
+        )
+
     def combine_results_from_ingredients(self, input_dict):
         """
         Combines results from multiple ingredients into one list
@@ -982,15 +1140,25 @@ class Analysis:
         plot_figures=False,
         save_gradient_data_as_image=False,
         clean_grid_cache=False,
+        build_grid=True,
     ):
         """
-        Packs one seed of a recipe and returns the recipe object
+        Packs one seed of a recipe and returns the recipe object. With
+        build_grid=False the grid is not built again, the fill starts from the
+        distances stored when it was built.
         """
+        t1 = time()
         seed = int(seed_list[seed_index])
         seed_basename = self.env.add_seed_number_to_base_name(seed)
-        self.env.reset()
+        # the compartment points are part of the grid the fill starts from
+        self.env.reset(keep_compartment_grids=not build_grid)
         numpy.random.seed(seed)
-        self.build_grid()
+        if build_grid:
+            self.build_grid()
+        else:
+            self.env.restore_grid_state()
+        self.seed_startup_times[seed] = time() - t1
+        log.debug(f"Startup time for seed {seed}: {self.seed_startup_times[seed]:0.2f}")
         two_d = self.env.is_two_d()
         use_simularium = False
         self.pack(
@@ -1119,8 +1287,11 @@ class Analysis:
                 output_path=self.figures_path,
                 **image_export_options,
             )
-            env_image_writer = self.env.create_voxelization(env_image_writer)
-            env_image_writer.export_image()
+            if env_image_writer.chunk_size is not None:
+                env_image_writer.export_image_chunked()
+            else:
+                env_image_writer = self.env.create_voxelization(env_image_writer)
+                env_image_writer.export_image()
 
         if save_gradient_data_as_image:
             gradient_data_figure_path = self.figures_path / "gradient_data_figures"
@@ -1183,6 +1354,9 @@ class Analysis:
         plot_figures = packing_config_data["save_plot_figures"]
         show_grid = packing_config_data["show_grid_plot"]
         image_export_options = packing_config_data.get("image_export_options")
+        self.distance_bin_edges = self.get_distance_bin_edges(
+            packing_config_data.get("distance_analysis_options")
+        )
 
         if image_export_options is not None:
             global ImageWriter
@@ -1232,48 +1406,68 @@ class Analysis:
         if parallel:
             num_processes = numpy.min(
                 [
-                    int(numpy.floor(0.8 * multiprocessing.cpu_count())),
+                    max(int(numpy.floor(0.8 * multiprocessing.cpu_count())), 1),
                     number_of_packings,
                 ]
             )
-            with concurrent.futures.ProcessPoolExecutor(
-                max_workers=num_processes
-            ) as executor:
-                futures = []
-                for seed_index in range(number_of_packings):
-                    futures.append(
-                        executor.submit(
-                            self.pack_one_seed,
-                            seed_index=seed_index,
-                            seed_list=seed_list,
-                            bounding_box=bounding_box,
-                            center_distance_dict=center_distance_dict,
-                            pairwise_distance_dict=pairwise_distance_dict,
-                            ingredient_position_dict=ingredient_position_dict,
-                            ingredient_angle_dict=ingredient_angle_dict,
-                            ingredient_occurence_dict=ingredient_occurence_dict,
-                            ingredient_key_dict=ingredient_key_dict,
-                            get_distance_distribution=get_distance_distribution,
-                            image_export_options=image_export_options,
-                            save_gradient_data_as_image=save_gradient_data_as_image,
-                            clean_grid_cache=clean_grid_cache,
+            # build the grid once, the workers attach to its arrays and only
+            # copy the distances and free points of each fill
+            self.build_grid()
+            grid = self.env.grid
+            grid.distToClosestSurf_store = numpy.array(
+                grid.distToClosestSurf, dtype=float
+            )
+            with SharedGrid(grid) as shared_grid, shared_grid.detached(grid):
+                with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=num_processes,
+                    initializer=_init_seed_worker,
+                    initargs=(self, shared_grid.specs),
+                ) as executor:
+                    futures = []
+                    for seed_index in range(number_of_packings):
+                        futures.append(
+                            executor.submit(
+                                _pack_seed_in_worker,
+                                seed_index=seed_index,
+                                seed_list=seed_list,
+                                bounding_box=bounding_box,
+                                center_distance_dict=center_distance_dict,
+                                pairwise_distance_dict=pairwise_distance_dict,
+                                ingredient_position_dict=ingredient_position_dict,
+                                ingredient_angle_dict=ingredient_angle_dict,
+                                ingredient_occurence_dict=ingredient_occurence_dict,
+                                ingredient_key_dict=ingredient_key_dict,
+                                get_distance_distribution=get_distance_distribution,
+                                image_export_options=image_export_options,
+                                save_gradient_data_as_image=save_gradient_data_as_image,
+                                clean_grid_cache=clean_grid_cache,
+                            )
                         )
-                    )
-                for future in concurrent.futures.as_completed(futures):
-                    (
-                        seed_center_distance_dict,
-                        seed_pairwise_distance_dict,
-                        seed_ingredient_position_dict,
-                        seed_ingredient_angle_dict,
-                        seed_ingredient_occurence_dict,
-                        seed_ingredient_key_dict,
-                    ) = future.result()
-                    center_distance_dict.update(seed_center_distance_dict)
-                    pairwise_distance_dict.update(seed_pairwise_distance_dict)
-                    ingredient_position_dict.update(seed_ingredient_position_dict)
-                    ingredient_angle_dict.update(seed_ingredient_angle_dict)
-                    ingredient_occurence_dict.update(seed_ingredient_occurence_dict)
-                    ingredient_key_dict.update(seed_ingredient_key_dict)
+                    for future in concurrent.futures.as_completed(futures):
+                        (
+                            (
+                                seed_center_distance_dict,
+                                seed_pairwise_distance_dict,
+                                seed_ingredient_position_dict,
+                                seed_ingredient_angle_dict,
+                                seed_ingredient_occurence_dict,
+                                seed_ingredient_key_dict,
+                            ),
+                            seed,
+                            startup_time,
+                            seed_results,
+                            result_file,
+                        ) = future.result()
+                        center_distance_dict.update(seed_center_distance_dict)
+                        pairwise_distance_dict.update(seed_pairwise_distance_dict)
+                        ingredient_position_dict.update(seed_ingredient_position_dict)
+                        ingredient_angle_dict.update(seed_ingredient_angle_dict)
+                        ingredient_occurence_dict.update(seed_ingredient_occurence_dict)
+                        ingredient_key_dict.update(seed_ingredient_key_dict)
+                        self.seed_startup_times[seed] = startup_time
+                        # written as simularium files by the main process
+                        self.seed_to_results[seed] = seed_results
+                        self.env.result_file = result_file
 
         else:
             for seed_index in range(number_of_packings):
@@ -1302,6 +1496,13 @@ class Analysis:
                     clean_grid_cache=clean_grid_cache,
                 )
 
+        if len(self.seed_startup_times):
+            startup_times = list(self.seed_startup_times.values())
+            log.info(
+                f"Startup time per seed: mean {numpy.mean(startup_times):0.2f}s, "
+                f"max {numpy.max(startup_times):0.2f}s"
+            )
+
         self.writeJSON(center_distance_file, center_distance_dict)
         self.writeJSON(pairwise_distance_file, pairwise_distance_dict)
         self.writeJSON(ingredient_position_file, ingredient_position_dict)
@@ -1313,7 +1514,7 @@ class Analysis:
             ingredient_position_dict
         )
         all_center_distances = self.combine_results_from_seeds(center_distance_dict)
-        all_ingredient_distances = self.combine_results_from_seeds(
+        all_ingredient_distances = self.combine_distances_from_seeds(
             pairwise_distance_dict
         )
         all_ingredient_occurences = self.combine_results_from_seeds(
@@ -1324,9 +1525,14 @@ class Analysis:
         all_center_distance_array = numpy.array(
             self.combine_results_from_ingredients(all_center_distances)
         )
-        all_pairwise_distance_array = numpy.array(
-            self.combine_results_from_ingredients(all_ingredient_distances)
-        )
+        if self.distance_bin_edges is not None:
+            all_pairwise_distances = combine_binned_distances(
+                all_ingredient_distances.values()
+            )
+        else:
+            all_pairwise_distances = numpy.array(
+                self.combine_results_from_ingredients(all_ingredient_distances)
+            )
         all_ingredient_position_array = numpy.array(
             self.combine_results_from_ingredients(all_ingredient_positions)
         )
@@ -1368,9 +1574,18 @@ class Analysis:
                     y_label="count",
                 )
 
-            if len(all_center_distance_array) > 1:
+            if self.distance_bin_edges is not None:
+                if all_pairwise_distances is not None:
+                    self.plot_binned_distances(
+                        all_pairwise_distances,
+                        self.figures_path
+                        / f"all_ingredient_pairwise_distances_{self.env.basename}.png",
+                        title_str="all_ingredients",
+                        x_label="pairwise distances",
+                    )
+            elif len(all_center_distance_array) > 1:
                 self.histogram(
-                    all_pairwise_distance_array,
+                    all_pairwise_distances,
                     self.figures_path
                     / f"all_ingredient_pairwise_distances_{self.env.basename}.png",
                     title_str="all_ingredients",
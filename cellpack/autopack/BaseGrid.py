@@ -37,12 +37,14 @@
 """
 
 import logging
+from abc import ABC, abstractmethod
 import numpy
 from scipy import spatial
 import math
 from math import ceil, floor
 from random import randrange
 import cellpack.autopack as autopack
+from cellpack.autopack.CandidateIndex import CandidateIndex
 from cellpack.autopack.ldSequence import cHaltonSequence3
 
 
@@ -66,6 +68,214 @@ class gridPoint:
         )  # Stores the global coordinate associated with this point
 
 
+class LatticeArray(ABC):
+    """
+    Read-only array of one row per grid point whose rows are computed from the
+    point index when they are indexed, instead of being stored. Supports the
+    indexing the packing uses on the dense arrays (integers, slices, index
+    arrays, boolean masks and a column after them) and numpy.take; numpy
+    functions that need the whole array get it from __array__.
+    """
+
+    ndim = 2
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def shape(self):
+        return (len(self), 3)
+
+    @abstractmethod
+    def get_rows(self, indices):
+        """rows of the grid points of the given indices"""
+
+    def _get_indices(self, key):
+        if isinstance(key, slice):
+            return numpy.arange(*key.indices(len(self)))
+        indices = numpy.asarray(key)
+        if indices.dtype == bool:
+            return numpy.nonzero(indices)[0]
+        indices = indices.astype(int, copy=False)
+        if indices.size and (indices.min() < -len(self) or indices.max() >= len(self)):
+            raise IndexError(f"index out of bounds for {len(self)} grid points")
+        return numpy.where(indices < 0, indices + len(self), indices)
+
+    def __getitem__(self, key):
+        columns = ()
+        if isinstance(key, tuple):
+            key, columns = key[0], key[1:]
+        rows = self.get_rows(self._get_indices(key))
+        if not columns:
+            return rows
+        if rows.ndim == 1:
+            return rows[columns]
+        return rows[(slice(None),) + columns]
+
+    def take(self, indices, axis=None):
+        if axis != 0:
+            return numpy.asarray(self).take(indices, axis=axis)
+        return self.get_rows(self._get_indices(indices))
+
+    def __array__(self, dtype=None, copy=None):
+        rows = self.get_rows(numpy.arange(len(self)))
+        return rows if dtype is None else rows.astype(dtype, copy=False)
+
+    def __iter__(self):
+        return iter(numpy.asarray(self))
+
+
+class LatticePositions(LatticeArray):
+    """
+    Positions of the grid points of a regular lattice, computed from the axis
+    coordinates x, y, z and the flat index (j * nx + i) * nz + k, followed by
+    the positions of the off-grid points appended after the lattice
+    """
+
+    def __init__(self, x, y, z, off_grid_positions=None, dtype=float):
+        self.x = numpy.asarray(x)
+        self.y = numpy.asarray(y)
+        self.z = numpy.asarray(z)
+        self.dtype = numpy.dtype(dtype)
+        self.volume = len(self.x) * len(self.y) * len(self.z)
+        if off_grid_positions is None:
+            off_grid_positions = numpy.zeros((0, 3), dtype=self.dtype)
+        self.off_grid_positions = numpy.asarray(off_grid_positions, dtype=self.dtype)
+        self.size = self.volume + len(self.off_grid_positions)
+
+    def get_lattice_rows(self, indices, rows):
+        nx, nz = len(self.x), len(self.z)
+        j, remainder = numpy.divmod(indices, nx * nz)
+        i, k = numpy.divmod(remainder, nz)
+        rows[..., 0] = self.x[i]
+        rows[..., 1] = self.y[j]
+        rows[..., 2] = self.z[k]
+        return rows
+
+    def get_rows(self, indices):
+        indices = numpy.asarray(indices)
+        rows = numpy.empty(indices.shape + (3,), dtype=self.dtype)
+        if not len(self.off_grid_positions):
+            return self.get_lattice_rows(indices, rows)
+        on_lattice = indices < self.volume
+        rows[on_lattice] = self.get_lattice_rows(
+            indices[on_lattice], numpy.empty((numpy.count_nonzero(on_lattice), 3))
+        )
+        rows[~on_lattice] = self.off_grid_positions[indices[~on_lattice] - self.volume]
+        return rows
+
+    def extend(self, positions, dtype="f"):
+        """
+        Returns the positions with the given positions appended after the
+        current ones, stored with dtype like the dense grid arrays do
+        """
+        return LatticePositions(
+            self.x,
+            self.y,
+            self.z,
+            numpy.concatenate(
+                (self.off_grid_positions, numpy.asarray(positions).reshape(-1, 3))
+            ),
+            dtype,
+        )
+
+
+class LatticeIndices(LatticeArray):
+    """
+    (i, j, k) lattice indices of the flat index i * ny * nz + j * nz + k, the
+    order of BaseGrid.cartesian
+    """
+
+    dtype = numpy.dtype(int)
+
+    def __init__(self, nb_grid_points):
+        self.nb_grid_points = [int(n) for n in nb_grid_points]
+        nx, ny, nz = self.nb_grid_points
+        self.size = nx * ny * nz
+
+    def get_rows(self, indices):
+        _, ny, nz = self.nb_grid_points
+        i, remainder = numpy.divmod(numpy.asarray(indices), ny * nz)
+        j, k = numpy.divmod(remainder, nz)
+        return numpy.stack((i, j, k), -1)
+
+
+class GridState:
+    """
+    Packing state of a grid that changes while a fill is running: the distance of
+    every grid point to the closest surface, the free points permutation and the
+    number of points that are still free. The arrays are shared with the grid and
+    are updated in place, see BaseGrid.updateDistances. The candidate points of the
+    ingredients are indexed by compartment id and distance threshold once they are
+    first asked for, see CandidateIndex.
+    """
+
+    def __init__(
+        self, distances, free_points, nb_free_points=None, compartment_ids=None
+    ):
+        self.distances = distances
+        self.free_points = free_points
+        if nb_free_points is None:
+            nb_free_points = len(free_points)
+        self.nb_free_points = nb_free_points
+        self.compartment_ids = compartment_ids
+        self.candidate_index = None
+
+    def get_candidate_index(self):
+        if self.candidate_index is None:
+            self.candidate_index = CandidateIndex(
+                self.distances,
+                self.compartment_ids,
+                self.free_points[: self.nb_free_points],
+            )
+        return self.candidate_index
+
+    def get_candidates(self, compartment_id, threshold):
+        """
+        Returns the free points of the compartment whose distance to the closest
+        surface is at least threshold, as a read-only view
+        """
+        return self.get_candidate_index().get_candidates(compartment_id, threshold)
+
+    def get_weighted_candidates(self, key, weights, compartment_id, threshold):
+        """
+        Returns a sum tree over the weights of the same candidates, see
+        CandidateIndex.get_weighted_candidates
+        """
+        return self.get_candidate_index().get_weighted_candidates(
+            key, weights, compartment_id, threshold
+        )
+
+    def update(self, insidePoints, newDistPoints):
+        # insidePoints and newDistPoints are {grid point index: distance} dicts
+        inside_points = numpy.fromiter(
+            insidePoints.keys(), dtype=int, count=len(insidePoints)
+        )
+        new_dist_points = numpy.fromiter(
+            newDistPoints.keys(), dtype=int, count=len(newDistPoints)
+        )
+        self.nb_free_points = BaseGrid.update_distances(
+            inside_points,
+            numpy.fromiter(insidePoints.values(), dtype=float, count=len(insidePoints)),
+            new_dist_points,
+            numpy.fromiter(
+                newDistPoints.values(), dtype=float, count=len(newDistPoints)
+            ),
+            self.free_points,
+            self.nb_free_points,
+            self.distances,
+        )
+        if self.candidate_index is not None:
+            self.candidate_index.update(inside_points, new_dist_points)
+        return self.nb_free_points
+
+    def snapshot(self):
+        """returns a copy of the state that is not affected by later placements"""
+        return GridState(
+            self.distances.copy(), self.free_points.copy(), self.nb_free_points
+        )
+
+
 class BaseGrid:
     """
     The Grid class
@@ -101,6 +311,87 @@ class BaseGrid:
         # free_points[nbFreePoints:] won't necessarily be the indices of inside points
         return free_points, nbFreePoints
 
+    @staticmethod
+    def remove_free_points(points, free_points, nbFreePoints):
+        """
+        Batched version of reorder_free_points over an array of grid point indices.
+        The points are removed in order with the same swaps as reorder_free_points,
+        but every run of removals that doesn't read an entry written earlier in the
+        same run is applied with a single numpy assignment.
+        Returns the new number of free points.
+        """
+        points = numpy.asarray(points, dtype=int)
+        nb_total = len(free_points)
+        start = 0
+        while start < len(points):
+            pts = points[start:]
+            steps = numpy.arange(len(pts))
+            last_free = nbFreePoints - 1 - steps
+            # negative positions wrap around like the scalar version
+            last_free[last_free < 0] += nb_total
+            kill_values = free_points[pts]
+            last_values = free_points[last_free]
+            # each removal writes free_points[vKill] then free_points[vLastFree]
+            written = numpy.empty(2 * len(pts), dtype=int)
+            written[0::2] = kill_values
+            written[1::2] = last_values
+            values = numpy.empty(2 * len(pts), dtype=free_points.dtype)
+            values[0::2] = last_values
+            values[1::2] = kill_values
+            # find the first removal reading an entry written by a previous one
+            unique_written, first_write = numpy.unique(written, return_index=True)
+            first_step = first_write // 2
+            conflict = numpy.zeros(len(pts), dtype=bool)
+            for read in (pts % nb_total, last_free):
+                pos = numpy.searchsorted(unique_written, read)
+                pos[pos == len(unique_written)] = 0
+                conflict |= (unique_written[pos] == read) & (first_step[pos] < steps)
+            nb_batch = int(numpy.argmax(conflict)) if conflict.any() else len(pts)
+            # apply the independent removals, keeping the last write of each entry
+            written = written[: 2 * nb_batch][::-1]
+            values = values[: 2 * nb_batch][::-1]
+            written, last_write = numpy.unique(written, return_index=True)
+            free_points[written] = values[last_write]
+            nbFreePoints -= nb_batch
+            start += nb_batch
+            if start < len(points):
+                free_points, nbFreePoints = BaseGrid.reorder_free_points(
+                    points[start], free_points, nbFreePoints
+                )
+                start += 1
+        return nbFreePoints
+
+    @staticmethod
+    def update_distances(
+        inside_points,
+        inside_distances,
+        new_dist_points,
+        new_distances,
+        free_points,
+        nbFreePoints,
+        distance,
+    ):
+        """
+        Batched update of the grid after a placement. inside_points are removed
+        from the free points and get their signed distance, the distance of the
+        other new_dist_points is lowered to new_distances.
+        All arguments are numpy arrays, free_points and distance are updated in place.
+        Returns the new number of free points.
+        """
+        inside_points = numpy.asarray(inside_points, dtype=int)
+        new_dist_points = numpy.asarray(new_dist_points, dtype=int)
+        new_distances = numpy.asarray(new_distances, dtype=float)
+        nbFreePoints = BaseGrid.remove_free_points(
+            inside_points, free_points, nbFreePoints
+        )
+        distance[inside_points] = inside_distances
+        outside = ~numpy.isin(new_dist_points, inside_points)
+        new_dist_points = new_dist_points[outside]
+        distance[new_dist_points] = numpy.minimum(
+            distance[new_dist_points], new_distances[outside]
+        )
+        return nbFreePoints
+
     @staticmethod
     def updateDistances(
         insidePoints,
@@ -109,32 +400,26 @@ class BaseGrid:
         nbFreePoints,
         distance,
     ):
-        # self.log.info(
-        #     "*************updating Distances %d %d", nbFreePoints, len(insidePoints)
-        # )
-        # TODO: move this to env class, ing shouldn't aware of the whole grid
-
-        # t1 = time()
-        # distChanges = {}
-        for pt, dist in list(insidePoints.items()):
-            try:
-                free_points, nbFreePoints = BaseGrid.reorder_free_points(
-                    pt, free_points, nbFreePoints
-                )
-            except Exception:
-                print(pt, "not in freeePoints********************************")
-                pass
-            distance[pt] = dist
-        # self.log.debug("update free points loop %d", time() - t1)
-        # t2 = time()
-        for pt, dist in list(newDistPoints.items()):
-            if pt not in insidePoints:
-                distance[pt] = dist
-        # self.log.debug("update distance loop %d", time() - t2)
-        return nbFreePoints
+        # insidePoints and newDistPoints are {grid point index: distance} dicts
+        return BaseGrid.update_distances(
+            numpy.fromiter(insidePoints.keys(), dtype=int, count=len(insidePoints)),
+            numpy.fromiter(insidePoints.values(), dtype=float, count=len(insidePoints)),
+            numpy.fromiter(newDistPoints.keys(), dtype=int, count=len(newDistPoints)),
+            numpy.fromiter(
+                newDistPoints.values(), dtype=float, count=len(newDistPoints)
+            ),
+            free_points,
+            nbFreePoints,
+            distance,
+        )
 
     def __init__(
-        self, boundingBox=([0, 0, 0], [0.1, 0.1, 0.1]), spacing=20, setup=True
+        self,
+        boundingBox=([0, 0, 0], [0.1, 0.1, 0.1]),
+        spacing=20,
+        setup=True,
+        implicit_lattice=False,
+        compact_state=False,
     ):
         self.log = logging.getLogger("grid")
         self.log.propagate = False
@@ -170,6 +455,12 @@ class BaseGrid:
         self._x = None
         self._y = None
         self._z = None
+        # position of the first lattice point, set by create_grid_point_positions
+        self.lattice_origin = None
+        # compute the positions and ijk indices of the lattice points from their
+        # index instead of storing them
+        self.implicit_lattice = implicit_lattice
+        self.set_state_dtypes(compact_state)
 
         # this are specific for each compartment
         self.aInteriorGrids = []
@@ -181,6 +472,10 @@ class BaseGrid:
         self.result_filename = None  # used after fill to store result
         self.tree = None
         self.tree_free = None
+        # tree over the compartment surface points appended after the lattice
+        self.off_grid_tree = None
+        # integer offsets of the lattice points around a sphere center, by radius
+        self.sphere_stencils = {}
         self.encapsulatingGrid = 0
         self.center = None
         self.backup = None
@@ -196,17 +491,19 @@ class BaseGrid:
 
         self.create_grid_point_positions()
         nx, ny, nz = self.nbGridPoints
-        self.ijkPtIndice = self.cartesian([range(nx), range(ny), range(nz)])
+        if self.implicit_lattice:
+            self.ijkPtIndice = LatticeIndices(self.nbGridPoints)
+        else:
+            self.ijkPtIndice = self.cartesian([range(nx), range(ny), range(nz)])
 
         self.getDiagonal()
         self.nbSurfacePoints = 0
         self.log.info(f"SETUP BASE GRID {self.gridVolume} {self.gridSpacing}")
         self.compartment_ids = numpy.zeros(self.gridVolume, "i")  # [0]*nbPoints
-        # self.distToClosestSurf = [self.diag]*self.gridVolume#surface point too?
-        self.distToClosestSurf = (
-            numpy.ones(self.gridVolume) * self.diag
-        )  # (self.distToClosestSurf)
-        self.free_points = list(range(self.gridVolume))
+        self.distToClosestSurf = numpy.full(
+            self.gridVolume, self.diag, dtype=self.distance_dtype
+        )
+        self.free_points = numpy.arange(self.gridVolume, dtype=self.index_dtype)
         self.nbFreePoints = len(self.free_points)
         self.log.info(
             "gridSpacing %r, length compartment_ids %r",
@@ -222,13 +519,39 @@ class BaseGrid:
         # reset the  distToClosestSurf and the free_points
         # boundingBox should be the same otherwise why keeping the grid
         self.log.info("reset Grid distance to closest surface and free_points")
-        self.distToClosestSurf = (
-            numpy.array(self.distToClosestSurf[:]) * 0.0
-        ) + self.diag
-        # self.distToClosestSurf[:] = self.diag  # numpy.array([self.diag]*len(self.distToClosestSurf))#surface point too?
-        self.free_points = list(range(len(self.free_points)))
+        self.distToClosestSurf = numpy.full(
+            len(self.distToClosestSurf), self.diag, dtype=self.distance_dtype
+        )
+        self.free_points = numpy.arange(len(self.free_points), dtype=self.index_dtype)
         self.nbFreePoints = len(self.free_points)
 
+    def set_state_dtypes(self, compact_state):
+        """
+        Sets the dtypes the distances and the free points are stored with,
+        float32 and int32 for a compact state, which halves the memory they
+        take per grid point, float64 and int64 otherwise
+        """
+        self.compact_state = compact_state
+        self.distance_dtype = numpy.float32 if compact_state else numpy.float64
+        self.index_dtype = numpy.int32 if compact_state else numpy.int64
+
+    def create_state(self):
+        """
+        Converts the distances and free points to numpy buffers owned by the grid
+        and wraps them in a GridState that the packing loop mutates in place
+        """
+        self.distToClosestSurf = numpy.asarray(
+            self.distToClosestSurf, dtype=self.distance_dtype
+        )
+        self.free_points = numpy.asarray(self.free_points, dtype=self.index_dtype)
+        self.nbFreePoints = len(self.free_points)
+        return GridState(
+            self.distToClosestSurf,
+            self.free_points,
+            self.nbFreePoints,
+            compartment_ids=self.compartment_ids,
+        )
+
     def removeFreePoint(self, pti):
         tmp = self.free_points[self.nbFreePoints]  # last one
         self.free_points[self.nbFreePoints] = pti
@@ -303,7 +626,6 @@ class BaseGrid:
         self._y = y = grid_dimensions[1]
         self._z = z = grid_dimensions[2]
 
-        xyz = numpy.meshgrid(x, y, z, copy=False)
         nx = len(
             x
         )  # sizes must be +1 or the right, top, and back edges don't get any points using this numpy.arange method
@@ -314,7 +636,13 @@ class BaseGrid:
         self.nbGridPoints = [nx, ny, nz]
         self.gridVolume = nx * ny * nz
         self.ijkPtIndice = numpy.ndindex(nx, ny, nz)
-        self.masterGridPositions = numpy.vstack(xyz).reshape(3, -1).T
+        if self.implicit_lattice:
+            self.masterGridPositions = LatticePositions(x, y, z)
+        else:
+            xyz = numpy.meshgrid(x, y, z, copy=False)
+            self.masterGridPositions = numpy.vstack(xyz).reshape(3, -1).T
+        self.lattice_origin = numpy.array([x[0], y[0], z[0]])
+        self.sphere_stencils = {}
 
     def getClosestGridPoint(self, pt3d):
         if self.tree is None:
@@ -591,6 +919,24 @@ class BaseGrid:
                     return False
             return True
 
+    def are_points_inside_bb(self, points, dist=None, jitter=[1, 1, 1], bb=None):
+        """
+        is_point_inside_bb for an array of 3d points, returns one boolean per
+        point
+        """
+        if bb is None:
+            bb = self.boundingBox
+        origin = numpy.array(bb[0])
+        edge = numpy.maximum(numpy.array(bb[1]), self.gridSpacing)
+        points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+        inside = ~numpy.any((points < origin) | (points > edge), axis=1)
+        if dist is not None:
+            # distance to closest wall, the zero distances are ignored
+            for distances in ((points - origin) * jitter, (edge - points) * jitter):
+                distances[distances == 0] = numpy.inf
+                inside &= distances.min(1) > dist
+        return inside
+
     def getCenter(self):
         """
         Get the center of the grid
@@ -609,11 +955,86 @@ class BaseGrid:
         s = numpy.sum(d * d)
         return math.sqrt(s)
 
-    def getPointsInSphere(self, pt, radius):
+    def is_regular_lattice(self):
+        """
+        True if the first gridVolume points are the lattice built by
+        create_grid_point_positions, whose flat index is (j * nx + i) * nz + k
+        """
+        return self.lattice_origin is not None and self.gridVolume > 0
+
+    def get_sphere_stencil(self, radius):
+        """
+        Returns the lattice points that can be within radius of a position whose
+        closest lattice point is the center of a box of half sizes extents, as
+        their (j, i, k) indices in the box, their offsets in the flat index and the
+        (j, i, k) extents. The box does not extend further than the grid along any
+        axis. The points are in the order of the flat index so the ones found with
+        the stencil come out sorted.
+        """
+        radius = float(radius)
+        stencil = self.sphere_stencils.get(radius)
+        if stencil is None:
+            # the position is at most half a diagonal away from its closest point
+            reach = radius / self.gridSpacing + math.sqrt(3) / 2.0
+            nx, ny, nz = self.nbGridPoints
+            extents = numpy.minimum(int(ceil(reach)), [ny - 1, nx - 1, nz - 1])
+            offsets = numpy.indices(2 * extents + 1).reshape(3, -1) - extents[:, None]
+            offsets = offsets[:, (offsets * offsets).sum(0) <= reach * reach]
+            flat_offsets = (offsets[0] * nx + offsets[1]) * nz + offsets[2]
+            stencil = (offsets + extents[:, None], flat_offsets, extents.tolist())
+            self.sphere_stencils[radius] = stencil
+        return stencil
+
+    def getPointsInSphereTree(self, pt, radius):
         if self.tree is None:
             self.tree = spatial.cKDTree(self.masterGridPositions, leafsize=10)
-        # add surface points
-        ptIndices = self.tree.query_ball_point(pt, radius)  # , n_jobs=-1)
+        return numpy.array(self.tree.query_ball_point(pt, radius), dtype=int)
+
+    def getOffGridPointsInSphere(self, pt, radius):
+        """indices of the points appended after the lattice that are within radius"""
+        nb_off_grid_points = len(self.masterGridPositions) - self.gridVolume
+        if self.off_grid_tree is None or self.off_grid_tree.n != nb_off_grid_points:
+            self.off_grid_tree = spatial.cKDTree(
+                self.masterGridPositions[self.gridVolume :], leafsize=10
+            )
+        indices = self.off_grid_tree.query_ball_point(pt, radius)
+        return numpy.array(indices, dtype=int) + self.gridVolume
+
+    def getPointsInSphere(self, pt, radius):
+        """
+        Returns the indices of the grid points within radius of pt as an int array.
+        On the regular lattice the candidates are the cached stencil of that radius
+        around the closest lattice point, other grids use a KD-tree.
+        """
+        if not self.is_regular_lattice():
+            return self.getPointsInSphereTree(pt, radius)
+        pt = numpy.asarray(pt, dtype=float).ravel()[:3]
+        nx, ny, nz = self.nbGridPoints
+        # closest lattice point, a position outside of the grid uses the closest
+        # point on its side, which is not further from any grid point
+        ijk = numpy.rint((pt - self.lattice_origin) / self.gridSpacing)
+        i, j, k = numpy.clip(ijk, 0, (nx - 1, ny - 1, nz - 1)).astype(int).tolist()
+        box_indices, flat_offsets, extents = self.get_sphere_stencil(radius)
+        # squared distances along each axis of the box around the closest point,
+        # infinite for the planes of the box that are outside of the grid
+        axis_distances = []
+        for center, extent, coordinates, value in zip(
+            (j, i, k), extents, (self._y, self._x, self._z), (pt[1], pt[0], pt[2])
+        ):
+            lower = center - extent
+            delta = numpy.full(2 * extent + 1, numpy.inf)
+            inside = coordinates[max(lower, 0) : center + extent + 1] - value
+            delta[max(-lower, 0) : max(-lower, 0) + len(inside)] = inside * inside
+            axis_distances.append(delta)
+        dy, dx, dz = axis_distances
+        bj, bi, bk = box_indices
+        distances = dx[bi] + dy[bj] + dz[bk]
+        ptIndices = flat_offsets + ((j * nx + i) * nz + k)
+        ptIndices = ptIndices[distances <= radius * radius]
+        if len(self.masterGridPositions) > self.gridVolume:
+            ptIndices = numpy.concatenate(
+                (ptIndices, self.getOffGridPointsInSphere(pt, radius))
+            )
         return ptIndices
 
     def getPointsInCubeFillBB(self, bb, pt, radius, addSP=True, info=False):
@@ -692,7 +1113,7 @@ class BaseGrid:
 
     def getPointsInCube(self, bb, pt, radius, addSP=True, info=False):
         """
-        Return all grid points indicesinside the given bounding box.
+        Return all grid points indices inside the given bounding box as an int array.
         """
         spacing1 = 1.0 / self.gridSpacing
         NX, NY, NZ = self.nbGridPoints
@@ -709,24 +1130,18 @@ class BaseGrid:
         k0 = int(max(0, floor((oz - OZ) * spacing1)))
         k1 = int(min(NZ, int((ez - OZ) * spacing1) + 1))
 
-        zPlaneLength = NX * NY
-
-        ptIndices = []
-        for z in range(int(k0), int(k1)):
-            offz = z * zPlaneLength
-            for y in range(int(j0), int(j1)):
-                off = y * NX + offz
-                for x in range(int(i0), int(i1)):
-                    ptIndices.append(x + off)
+        # x moves fastest, then y, then z
+        ptIndices = (
+            numpy.arange(k0, k1)[:, None, None] * NX * NY
+            + numpy.arange(j0, j1)[None, :, None] * NX
+            + numpy.arange(i0, i1)[None, None, :]
+        ).ravel()
 
         # add surface points
         if addSP and self.nbSurfacePoints != 0:
             result = numpy.zeros((self.nbSurfacePoints,), "i")
             nb = self.surfPtsBht.closePoints(tuple(pt), radius, result)
-            dimx, dimy, dimz = self.nbGridPoints
-            ptIndices.extend(
-                list(map(lambda x, length=self.gridVolume: x + length, result[:nb]))
-            )
+            ptIndices = numpy.concatenate((ptIndices, result[:nb] + self.gridVolume))
         return ptIndices
 
     def computeGridNumberOfPoint(self, boundingBox, space):
@@ -757,6 +1172,20 @@ class BaseGrid:
             self.surfPtsBht = spatial.cKDTree(verts, leafsize=10)
         self.nbSurfacePoints = len(verts)
 
+    def add_off_grid_positions(self, positions):
+        """
+        Appends the positions of off-grid points after the grid points, the
+        positions of all the points are then stored as float32
+        """
+        if isinstance(self.masterGridPositions, LatticePositions):
+            self.masterGridPositions = self.masterGridPositions.extend(positions)
+            return
+        nb_points = len(self.masterGridPositions)
+        all_positions = numpy.zeros((nb_points + len(positions), 3), "f")
+        all_positions[:nb_points] = self.masterGridPositions
+        all_positions[nb_points:] = positions
+        self.masterGridPositions = all_positions
+
     def computeExteriorVolume(self, compartments=None, space=None, fbox_bb=None):
         # compute exterior volume, totalVolume without compartments volume
         unitVol = self.gridSpacing**3
@@ -0,0 +1,226 @@
+from bisect import bisect_left
+
+import numpy
+
+
+def _read_only(array):
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+class CompartmentCandidates:
+    """
+    Grid points of one compartment. The level of a point is the number of
+    thresholds its distance to the closest surface reaches, or 0 once it is no
+    longer free. The points are ordered by decreasing level, so the candidates
+    of a threshold are the prefix of `points` that ends at `ends[threshold index]`.
+    """
+
+    def __init__(self, points):
+        self.points = points
+        self.thresholds = []
+        self.ends = []
+
+    def get_levels(self, positions):
+        return (numpy.array(self.ends)[None, :] > positions[:, None]).sum(1)
+
+
+class WeightSumTree:
+    """
+    Sum tree over the weights of the candidate points of one bucket, used to draw
+    a point with a probability proportional to its weight in O(log n). The
+    leaves are the candidates when the tree is built, sorted by point index, and
+    the points that stop being candidates get a weight of 0.
+    """
+
+    def __init__(self, points, weights, compartment_id, threshold):
+        self.points = numpy.sort(points)
+        self.compartment_id = compartment_id
+        self.threshold = threshold
+        weights = numpy.nan_to_num(numpy.asarray(weights)[self.points].astype(float))
+        self.capacity = 1 << max(len(self.points) - 1, 0).bit_length()
+        self.tree = numpy.zeros(2 * self.capacity)
+        self.tree[self.capacity : self.capacity + len(self.points)] = numpy.maximum(
+            weights, 0.0
+        )
+        size = self.capacity
+        while size > 1:
+            self.tree[size // 2 : size] = (
+                self.tree[size : 2 * size : 2] + self.tree[size + 1 : 2 * size : 2]
+            )
+            size //= 2
+
+    def total(self):
+        return self.tree[1]
+
+    def remove(self, points):
+        points = numpy.asarray(points, dtype=int)
+        leaves = numpy.searchsorted(self.points, points)
+        found = leaves < len(self.points)
+        found[found] = self.points[leaves[found]] == points[found]
+        nodes = numpy.unique(leaves[found] + self.capacity)
+        self.tree[nodes] = 0.0
+        while len(nodes) and nodes[0] > 1:
+            nodes = numpy.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, value):
+        """
+        Returns the first point whose cumulative weight is at least value, or
+        None if all the weights are 0
+        """
+        if self.total() <= 0:
+            return None
+        node = 1
+        while node < self.capacity:
+            left = 2 * node
+            # rounding can leave value above the left sum with an empty right side
+            if value <= self.tree[left] or self.tree[left + 1] <= 0:
+                node = left
+            else:
+                value -= self.tree[left]
+                node = left + 1
+        return self.points[node - self.capacity]
+
+
+class CandidateIndex:
+    """
+    Free grid points that an ingredient can be dropped at, bucketed by compartment
+    id and by distance-to-surface threshold (the cutoff of the ingredient). The
+    candidates of a bucket are a prefix of an array that is kept up to date from
+    the points touched by each placement, so they are returned without scanning
+    the grid.
+
+    During a fill the distances only decrease and points are only removed, so
+    the points only ever move down to lower levels.
+    """
+
+    def __init__(self, distances, compartment_ids, free_points):
+        self.distances = distances
+        self.compartment_ids = numpy.asarray(compartment_ids)
+        self.is_free = numpy.zeros(len(distances), dtype=bool)
+        self.is_free[free_points] = True
+        # position of each point in the array of its compartment
+        self.positions = numpy.full(len(distances), -1, dtype=int)
+        self.compartments = {}
+        self.weighted_candidates = {}
+
+    def get_compartment(self, compartment_id):
+        compartment = self.compartments.get(compartment_id)
+        if compartment is None:
+            points = numpy.nonzero(self.compartment_ids == compartment_id)[0]
+            self.positions[points] = numpy.arange(len(points))
+            compartment = CompartmentCandidates(points)
+            self.compartments[compartment_id] = compartment
+        return compartment
+
+    def add_threshold(self, compartment, threshold):
+        """
+        Splits the points of the level the threshold falls in between the ones
+        that reach it and the ones that don't, and returns the threshold index
+        """
+        index = bisect_left(compartment.thresholds, threshold)
+        if (
+            index < len(compartment.thresholds)
+            and compartment.thresholds[index] == threshold
+        ):
+            return index
+        start = compartment.ends[index] if index < len(compartment.ends) else 0
+        end = compartment.ends[index - 1] if index > 0 else len(compartment.points)
+        level_points = compartment.points[start:end]
+        reached = numpy.logical_and(
+            self.distances[level_points] >= threshold, self.is_free[level_points]
+        )
+        level_points = numpy.concatenate(
+            (level_points[reached], level_points[~reached])
+        )
+        compartment.points[start:end] = level_points
+        self.positions[level_points] = numpy.arange(start, end)
+        compartment.thresholds.insert(index, threshold)
+        compartment.ends.insert(index, start + int(numpy.count_nonzero(reached)))
+        return index
+
+    def get_candidates(self, compartment_id, threshold):
+        """
+        Returns a read-only view of the free points of the compartment whose
+        distance is at least threshold. The view is only valid until the next
+        update.
+        """
+        compartment = self.get_compartment(int(compartment_id))
+        index = self.add_threshold(compartment, float(threshold))
+        return _read_only(compartment.points[: compartment.ends[index]])
+
+    def is_candidate(self, points, compartment_id, threshold):
+        compartment = self.get_compartment(int(compartment_id))
+        index = self.add_threshold(compartment, float(threshold))
+        return numpy.logical_and(
+            self.compartment_ids[points] == compartment_id,
+            self.positions[points] < compartment.ends[index],
+        )
+
+    def get_weighted_candidates(self, key, weights, compartment_id, threshold):
+        """
+        Returns the sum tree of the weights of the candidates of a bucket, built
+        the first time the key is asked for and kept up to date by update
+        """
+        weighted_candidates = self.weighted_candidates.get(key)
+        if weighted_candidates is None:
+            weighted_candidates = WeightSumTree(
+                self.get_candidates(compartment_id, threshold),
+                weights,
+                compartment_id,
+                threshold,
+            )
+            self.weighted_candidates[key] = weighted_candidates
+        return weighted_candidates
+
+    def move_to_end(self, compartment, moving, start, end):
+        """swaps the moving points with the points at the end of [start, end)"""
+        points = compartment.points
+        tail = points[start:end]
+        outside = numpy.sort(self.positions[moving])
+        outside = outside[outside < start]
+        slots = start + numpy.nonzero(~numpy.isin(tail, moving))[0]
+        outside_points = points[outside]
+        points[outside] = points[slots]
+        points[slots] = outside_points
+        self.positions[points[outside]] = outside
+        self.positions[outside_points] = slots
+
+    def update(self, inside_points, new_dist_points):
+        """
+        Removes the inside points of a placement and moves the points whose
+        distance went under a threshold down to their new level
+        """
+        self.is_free[inside_points] = False
+        points = numpy.unique(numpy.concatenate((inside_points, new_dist_points)))
+        compartment_ids = self.compartment_ids[points]
+        for compartment_id, compartment in self.compartments.items():
+            if not len(compartment.thresholds):
+                continue
+            touched = points[compartment_ids == compartment_id]
+            levels = compartment.get_levels(self.positions[touched])
+            new_levels = numpy.searchsorted(
+                compartment.thresholds, self.distances[touched], side="right"
+            )
+            new_levels[~self.is_free[touched]] = 0
+            lowered = new_levels < levels
+            touched = touched[lowered]
+            levels, new_levels = levels[lowered], new_levels[lowered]
+            for level in range(len(compartment.thresholds), 0, -1):
+                leaving = numpy.logical_and(levels == level, new_levels < level)
+                nb_leaving = numpy.count_nonzero(leaving)
+                if nb_leaving == 0:
+                    continue
+                end = compartment.ends[level - 1]
+                self.move_to_end(compartment, touched[leaving], end - nb_leaving, end)
+                compartment.ends[level - 1] = end - nb_leaving
+                levels[leaving] = level - 1
+        for weighted_candidates in self.weighted_candidates.values():
+            removed = ~self.is_candidate(
+                points,
+                weighted_candidates.compartment_id,
+                weighted_candidates.threshold,
+            )
+            weighted_candidates.remove(points[removed])
@@ -58,6 +58,7 @@
 import logging
 import os
 import pickle
+from collections import OrderedDict
 
 import numpy
 from time import time
@@ -68,6 +69,7 @@ from scipy import spatial
 import cellpack.autopack as autopack
 from cellpack.autopack import transformation as tr, binvox_rw
 from cellpack.autopack.BaseGrid import gridPoint
+from cellpack.autopack.MeshStore import MeshStore
 from cellpack.autopack.interface_objects.packed_objects import (
     PackedObject,
     PackedObjects,
@@ -119,6 +121,12 @@ class Compartment(CompartmentList):
     surface. Compartment can be nested
     """
 
+    # (mesh, pitch, hollow) -> filled matrix and inverse transform of the trimesh
+    # voxelization of the mesh, shared by the compartments and packings of it.
+    # The least recently used matrices are dropped past max_size bytes
+    voxelized_meshes = OrderedDict()
+    voxelized_meshes_max_size = 512 * 1024**2
+
     def __init__(self, name, object_info):
         super().__init__()
         self.name = name
@@ -164,6 +172,10 @@ class Compartment(CompartmentList):
         # list of grid point indices on compartment surface
         self.surfacePoints = None
         self.surfacePointsNormals = {}  # will be point index:normal
+        # normals of the surface points computed when the grid is built, the
+        # row of each grid point in surface_normals, or -1
+        self.surface_normal_rows = None
+        self.surface_normals = None
 
         self.number = None  # will be set to an integer when this compartment
         # is added to a Environment. Positivefor surface pts
@@ -501,7 +513,45 @@ class Compartment(CompartmentList):
         else:
             return False
 
+    def build_surface_normals(self, env, mesh_store):
+        """
+        Computes the normals of all the surface points of the compartment in one
+        query on the mesh, so placing a surface ingredient reads its normal
+        instead of querying the mesh for each point. The normals already set
+        by BuildGrid for the off grid surface points are kept.
+        """
+        if mesh_store is None:
+            return
+        compartment_ids = numpy.asarray(env.grid.compartment_ids)
+        known_normals = (
+            self.surfacePointsNormals
+            if isinstance(self.surfacePointsNormals, dict)
+            else {}
+        )
+        known_point_ids = numpy.fromiter(
+            known_normals.keys(), dtype=int, count=len(known_normals)
+        )
+        point_ids = numpy.union1d(
+            numpy.nonzero(compartment_ids == self.number)[0], known_point_ids
+        )
+        is_known = numpy.isin(point_ids, known_point_ids)
+        normals = numpy.zeros((len(point_ids), 3))
+        normals[~is_known] = mesh_store.get_normals(
+            self.gname, env.grid.masterGridPositions[point_ids[~is_known]]
+        )
+        for row in numpy.nonzero(is_known)[0]:
+            normals[row] = known_normals[point_ids[row]]
+        self.surface_normal_rows = numpy.full(
+            len(compartment_ids), -1, dtype=numpy.int32
+        )
+        self.surface_normal_rows[point_ids] = numpy.arange(len(point_ids))
+        self.surface_normals = normals
+
     def get_normal_for_point(self, pt, pos, mesh_store):
+        if self.surface_normal_rows is not None and pt < len(self.surface_normal_rows):
+            row = self.surface_normal_rows[pt]
+            if row >= 0:
+                return self.surface_normals[row]
         if pt not in self.surfacePointsNormals:
             normal = mesh_store.get_normal(self.gname, pos)
             self.surfacePointsNormals[pt] = normal
@@ -761,6 +811,17 @@ class Compartment(CompartmentList):
         else:
             return False
 
+    def are_points_inside_mesh(self, points, mesh_store):
+        """is_point_inside_mesh for an array of points"""
+        points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+        inside = ~numpy.any(
+            (points < numpy.array(self.bb[0])) | (points > numpy.array(self.bb[1])),
+            axis=1,
+        )
+        if inside.any():
+            inside[inside] = mesh_store.contains_points_mesh(self.gname, points[inside])
+        return inside
+
     def BuildGrid(self, env, mesh_store=None):
         if self.is_orthogonal_bounding_box == 1:
             self.prepare_buildgrid_box(env)
@@ -896,6 +957,8 @@ class Compartment(CompartmentList):
         else:
             self.log.error("Not a recognized inner grid method", env.innerGridMethod)
 
+        if mesh_store is not None and mesh_store.get_object(self.gname) is not None:
+            self.build_surface_normals(env, mesh_store)
         self.compute_volume_and_set_count(
             env, self.surfacePoints, self.insidePoints, areas=vSurfaceArea
         )
@@ -958,7 +1021,9 @@ class Compartment(CompartmentList):
         grid_pt_to_calc = master_grid_positions[grid_pt_indexes]
 
         surface_distances, _ = surface_tree.query(tuple(grid_pt_to_calc))
-        all_surface_distances = numpy.full(master_grid_positions.shape[0], numpy.nan)
+        all_surface_distances = numpy.full(
+            master_grid_positions.shape[0], numpy.nan, dtype=env.grid.distance_dtype
+        )
         all_surface_distances[grid_pt_indexes] = surface_distances
 
         if (
@@ -971,7 +1036,7 @@ class Compartment(CompartmentList):
             )
             grid_pt_to_calc = master_grid_positions[grid_pts_between_surfaces]
             scaled_distance_to_next_surface = numpy.full(
-                master_grid_positions.shape[0], numpy.nan
+                master_grid_positions.shape[0], numpy.nan, dtype=env.grid.distance_dtype
             )
             (
                 scaled_distance_to_next_surface[grid_pts_between_surfaces],
@@ -1235,6 +1300,77 @@ class Compartment(CompartmentList):
         self.surfacePointsNormals = surfacePointsNormals
         return self.insidePoints, self.surfacePoints
 
+    def get_inside_points_scanline(self, grid, mesh_store, chunk_size=10000):
+        """
+        Returns a mask of the grid points inside the compartment mesh. A ray is
+        cast along z through each column of the lattice that crosses the mesh
+        bounding box, the points of the column between its first and second
+        crossing, third and fourth... are inside. The columns with an odd number
+        of crossings (a ray grazing the mesh) and the points that are not on the
+        lattice are checked with the mesh contains query.
+        """
+        mesh = mesh_store.get_mesh(self.gname)
+        positions = grid.masterGridPositions
+        inside = numpy.zeros(len(positions), dtype=bool)
+        nx, ny, nz = grid.nbGridPoints
+        nb_lattice_points = grid.gridVolume
+        # the flat index of the lattice is (j * nx + i) * nz + k
+        lattice = positions[:nb_lattice_points].reshape(ny * nx, nz, 3)
+        column_positions = lattice[:, 0, :2]
+        z_values = lattice[0, :, 2]
+        lower, upper = mesh.bounds
+        columns = numpy.nonzero(
+            numpy.all(
+                (column_positions >= lower[:2]) & (column_positions <= upper[:2]),
+                axis=1,
+            )
+        )[0]
+        ray_origins = numpy.zeros((len(columns), 3))
+        ray_origins[:, :2] = column_positions[columns]
+        ray_origins[:, 2] = lower[2] - grid.gridSpacing
+        ray_directions = numpy.zeros((len(columns), 3))
+        ray_directions[:, 2] = 1.0
+        locations, ray_indices = MeshStore.get_ray_hits(
+            mesh, ray_origins, ray_directions, chunk_size=chunk_size
+        )
+
+        order = numpy.lexsort((locations[:, 2], ray_indices))
+        ray_indices = ray_indices[order]
+        hit_z = locations[order, 2]
+        counts = numpy.bincount(ray_indices, minlength=len(columns))
+        rank = (
+            numpy.arange(len(ray_indices))
+            - (numpy.cumsum(counts) - counts)[ray_indices]
+        )
+        paired = (counts % 2 == 0)[ray_indices]
+        entering = paired & (rank % 2 == 0)
+        leaving = paired & (rank % 2 == 1)
+        column_starts = columns[ray_indices[entering]] * nz
+        # runs of inside points, filled with a cumulative sum over the lattice
+        run_starts = column_starts + numpy.searchsorted(
+            z_values, hit_z[entering], side="left"
+        )
+        run_ends = column_starts + numpy.searchsorted(
+            z_values, hit_z[leaving], side="right"
+        )
+        runs = numpy.bincount(
+            run_starts, minlength=nb_lattice_points + 1
+        ) - numpy.bincount(run_ends, minlength=nb_lattice_points + 1)
+        inside[:nb_lattice_points] = numpy.cumsum(runs)[:nb_lattice_points] > 0
+
+        unpaired_columns = columns[counts % 2 == 1]
+        points_to_check = numpy.concatenate(
+            (
+                (unpaired_columns[:, None] * nz + numpy.arange(nz)).ravel(),
+                numpy.arange(nb_lattice_points, len(positions)),
+            )
+        )
+        if len(points_to_check):
+            inside[points_to_check] = mesh_store.contains_points_mesh(
+                self.gname, positions[points_to_check]
+            )
+        return inside
+
     def BuildGrid_scanline(
         self,
         env,
@@ -1247,44 +1383,15 @@ class Compartment(CompartmentList):
         mesh_store,
     ):
         """Build the compartment grid ie surface and inside point using scanline"""
-        insidePoints = []
         number = self.number
-        # the main loop
-        # check the first point
-        NX, NY, NZ = env.grid.nbGridPoints
-        # int(k * NX * NY + j * NX + i)
-        ptInd = 0
-        coord = [
-            grdPos.item((ptInd, 0)),
-            grdPos.item((ptInd, 1)),
-            grdPos.item((ptInd, 2)),
-        ]
-        # is this point inside
-        inside = self.is_point_inside_mesh(coord, diag, mesh_store, ray=3)
-        for k in range(NZ):
-            for i in range(NX):
-                for j in range(NY):
-                    ptInd = int(k * NX * NY + j * NX + i)
-                    coord = [
-                        grdPos.item((ptInd, 0)),
-                        grdPos.item((ptInd, 1)),
-                        grdPos.item((ptInd, 2)),
-                    ]
-                    insideBB = self.checkPointInsideBB(
-                        coord, dist=new_distances.item(ptInd)
-                    )
-                    if insideBB:
-                        # check only if close enouhg to surface
-                        if (
-                            new_distances.item(ptInd)
-                            < env.grid.gridSpacing * 1.1547 * 2.0
-                        ):
-                            inside = self.is_point_inside_mesh(
-                                coord, diag, mesh_store, ray=3
-                            )
-                        if inside:
-                            insidePoints.append(ptInd)
-                            idarray.itemset(ptInd, -number)
+        if env.grid.is_regular_lattice():
+            inside = self.get_inside_points_scanline(env.grid, mesh_store)
+        else:
+            inside = mesh_store.contains_points_mesh(self.gname, grdPos)
+        point_ids = numpy.nonzero(inside)[0]
+        # largest compartments need to be created first for this to work
+        insidePoints = point_ids[numpy.abs(idarray[point_ids]) < number]
+        idarray[insidePoints] = -number
         nbGridPoints = len(env.grid.masterGridPositions)
 
         surfPtsBB, surfPtsBBNorms = self.filter_surface_pts_to_fill_box(srfPts, env)
@@ -1827,14 +1934,15 @@ class Compartment(CompartmentList):
         """Extend the environment grd using the compartment point"""
         if extended:
             number_off_grid_pts = len(off_grid_surface_pts)
-            pointArrayRaw = numpy.zeros((nbGridPoints + number_off_grid_pts, 3), "f")
-            pointArrayRaw[:nbGridPoints] = env.grid.masterGridPositions
-            pointArrayRaw[nbGridPoints:] = off_grid_surface_pts
+            env.grid.add_off_grid_positions(off_grid_surface_pts)
             env.grid.nbSurfacePoints += number_off_grid_pts
-            env.grid.masterGridPositions = pointArrayRaw
             if type(env.grid.distToClosestSurf) == numpy.ndarray:
                 # histoVol.grid.distToClosestSurf = numpy.append(histoVol.grid.distToClosestSurf,numpy.array([histoVol.grid.diag,]*length ))
-                distCS = numpy.ones(number_off_grid_pts) * env.grid.diag
+                distCS = numpy.full(
+                    number_off_grid_pts,
+                    env.grid.diag,
+                    dtype=env.grid.distToClosestSurf.dtype,
+                )
                 env.grid.distToClosestSurf = numpy.hstack(
                     (env.grid.distToClosestSurf, distCS)
                 )
@@ -1844,7 +1952,9 @@ class Compartment(CompartmentList):
                 )
             ptId = numpy.ones(number_off_grid_pts, "i") * self.number  # surface point
             env.grid.compartment_ids = numpy.hstack((env.grid.compartment_ids, ptId))
-            env.grid.free_points = numpy.arange(nbGridPoints + number_off_grid_pts)
+            env.grid.free_points = numpy.arange(
+                nbGridPoints + number_off_grid_pts, dtype=env.grid.index_dtype
+            )
             surfacePoints = list(
                 range(nbGridPoints, nbGridPoints + number_off_grid_pts)
             )
@@ -1852,7 +1962,6 @@ class Compartment(CompartmentList):
                 surfacePointsNormals[nbGridPoints + i] = n
         else:
             number_off_grid_pts = len(off_grid_surface_pts)
-            pointArrayRaw = env.grid.masterGridPositions
             env.grid.nbSurfacePoints += number_off_grid_pts
             surfacePoints = list(
                 range(nbGridPoints - number_off_grid_pts, nbGridPoints)
@@ -3014,6 +3123,7 @@ class Compartment(CompartmentList):
         voxel_size,
         mesh_store,
         hollow=False,
+        voxel_offset=None,
     ):
         """
         Creates a mask of the compartment voxelization
@@ -3025,39 +3135,73 @@ class Compartment(CompartmentList):
         :param voxel_size: size of the voxels
         :param mesh_store: mesh store
         :param hollow: if True, the mask will be hollow otherwise it will fill in the segmentation
+        :param voxel_offset: index of the first voxel of the mask in the image
         """
         if voxel_size is None:
             voxel_size = numpy.array([1, 1, 1], dtype=int)
 
+        if voxel_offset is None:
+            voxel_offset = numpy.zeros(3, dtype=int)
+
         if center is None:  # use the middle of the grid
             center = (self.bounding_box[0] + self.bounding_box[1]) / 2.0
 
-        Z, Y, X = numpy.meshgrid(
-            numpy.arange(z_width),
-            numpy.arange(y_width),
-            numpy.arange(x_width),
-            indexing="ij",
-        )
-        coords = numpy.column_stack(
-            [
-                (X * voxel_size[0] - center[0]).flatten(),
-                (Y * voxel_size[1] - center[1]).flatten(),
-                (Z * voxel_size[2] - center[2]).flatten(),
-            ]
-        )
-
         mesh = mesh_store.get_mesh(self.gname)
+        matrix, inverse_transform = self.get_voxelized_mesh(
+            mesh, numpy.min(voxel_size), hollow
+        )
 
-        if hollow:
-            trimesh_grid = creation.voxelize(mesh, pitch=numpy.min(voxel_size)).hollow()
-        else:
-            trimesh_grid = creation.voxelize(mesh, pitch=numpy.min(voxel_size)).fill()
-
-        mask_ravel = trimesh_grid.is_filled(coords)
-        mask = mask_ravel.reshape((x_width, y_width, z_width), order="F")
+        # the trimesh voxel grid is axis aligned, the voxels of each image axis
+        # map to the grid indices the voxel positions round to, as in is_filled
+        indices = []
+        in_range = []
+        for axis, width in enumerate((x_width, y_width, z_width)):
+            voxels = numpy.arange(voxel_offset[axis], voxel_offset[axis] + width)
+            positions = voxels * voxel_size[axis] - center[axis]
+            axis_indices = numpy.round(
+                positions * inverse_transform[axis, axis] + inverse_transform[axis, 3]
+            ).astype(int)
+            axis_in_range = (axis_indices >= 0) & (axis_indices < matrix.shape[axis])
+            indices.append(axis_indices[axis_in_range])
+            in_range.append(axis_in_range)
+
+        mask = numpy.zeros((x_width, y_width, z_width), dtype=bool)
+        mask[numpy.ix_(*in_range)] = matrix[numpy.ix_(*indices)]
 
         return mask
 
+    @staticmethod
+    def get_voxelized_mesh(mesh, pitch, hollow=False):
+        """
+        Returns the filled matrix and the inverse transform of the voxelization
+        of the mesh, voxelized once per mesh, pitch and hollow option
+        """
+        # the hash of a trimesh mesh changes with its vertices and faces
+        key = (hash(mesh), float(pitch), hollow)
+        voxelized_meshes = Compartment.voxelized_meshes
+        voxelized_mesh = voxelized_meshes.get(key)
+        if voxelized_mesh is not None:
+            voxelized_meshes.move_to_end(key)
+        else:
+            trimesh_grid = creation.voxelize(mesh, pitch=pitch)
+            if hollow:
+                trimesh_grid = trimesh_grid.hollow()
+            else:
+                trimesh_grid = trimesh_grid.fill()
+            voxelized_mesh = (
+                trimesh_grid.matrix,
+                numpy.linalg.inv(trimesh_grid.transform),
+            )
+            voxelized_meshes[key] = voxelized_mesh
+            # the matrix just voxelized is kept even if it is larger
+            total_size = sum(matrix.nbytes for matrix, _ in voxelized_meshes.values())
+            while total_size > Compartment.voxelized_meshes_max_size and (
+                len(voxelized_meshes) > 1
+            ):
+                _, (matrix, _) = voxelized_meshes.popitem(last=False)
+                total_size -= matrix.nbytes
+        return voxelized_mesh
+
     def create_voxelization(
         self,
         image_data,
@@ -3068,7 +3212,9 @@ class Compartment(CompartmentList):
         **kwargs,
     ):
         """
-        Creates a voxelization mask at the position of the compartment
+        Creates a voxelization mask at the position of the compartment, when
+        image_data is a window of the image only the mask of that window is
+        created
         """
         if "mesh_store" not in kwargs:
             raise RuntimeError(
@@ -3079,14 +3225,35 @@ class Compartment(CompartmentList):
         hollow = kwargs.get("hollow", False)
 
         relative_position = position - bounding_box[0]
+        image_offset = kwargs.get("image_offset")
+        if image_offset is None:
+            mask = self.create_voxelized_mask(
+                *image_size,
+                center=relative_position,
+                voxel_size=voxel_size,
+                mesh_store=mesh_store,
+                hollow=hollow,
+            )
+            image_data[mask] = 255
+            return image_data
+
+        lower = numpy.maximum(image_offset, 0)
+        upper = numpy.minimum(numpy.add(image_offset, image_data.shape), image_size)
+        if numpy.any(upper <= lower):
+            return image_data
         mask = self.create_voxelized_mask(
-            *image_size,
+            *(upper - lower),
             center=relative_position,
             voxel_size=voxel_size,
             mesh_store=mesh_store,
             hollow=hollow,
+            voxel_offset=lower,
+        )
+        window = tuple(
+            slice(lower[i] - image_offset[i], upper[i] - image_offset[i])
+            for i in range(3)
         )
-        image_data[mask] = 255
+        image_data[window][mask] = 255
 
         return image_data
 
@@ -50,8 +50,10 @@ import json
 import logging
 import os
 import pickle
+import shutil
 from collections import OrderedDict
 from json import encoder
+from pathlib import Path
 from random import random, seed, uniform
 from time import time
 
@@ -65,12 +67,17 @@ from cellpack.autopack import IOutils, get_cache_location, get_local_file_locati
 
 # backward compatibility with kevin method
 from cellpack.autopack.BaseGrid import BaseGrid as BaseGrid
+from cellpack.autopack.GridCache import GridCache
+from cellpack.autopack.GridSnapshot import GridSnapshot
+from cellpack.autopack.IngredientScheduler import IngredientScheduler
 from cellpack.autopack.interface_objects.packed_objects import PackedObjects
 from cellpack.autopack.loaders.utils import create_output_dir
 from cellpack.autopack.MeshStore import MeshStore
+from cellpack.autopack.SpatialIndex import SpatialHashGrid
 from cellpack.autopack.utils import (
     cmp_to_key,
     expand_object_using_key,
+    get_binned_distances,
     get_max_value_from_distribution,
     get_min_value_from_distribution,
     get_value_from_distribution,
@@ -142,6 +149,9 @@ class Environment(CompartmentList):
         self.boundingBox = numpy.array(recipe["bounding_box"])
         self.spacing = config["spacing"]
         self.load_from_grid_file = config["load_from_grid_file"]
+        self.implicit_lattice = config.get("implicit_lattice", False)
+        self.compact_grid_state = config.get("compact_grid_state", False)
+        self.batched_jitter = config.get("batched_jitter", False)
         self.show_progress_bar = config["show_progress_bar"]
         self.name = name
         self.version = recipe.get("version", "default")
@@ -157,15 +167,26 @@ class Environment(CompartmentList):
             f"{self.out_folder}/{self.name}_{config['name']}_{self.version}_grid.dat"
         )
         self.previous_grid_file = None
+        self.grid_cache = None
         if self.load_from_grid_file:
             # first check if grid file path is specified in recipe
             if recipe.get("grid_file_path") is not None:
                 self.grid_file_out = get_local_file_location(
                     recipe["grid_file_path"], cache="grids"
                 )
-            # check if grid file is already present in the output folder
-            if os.path.isfile(self.grid_file_out):
-                self.previous_grid_file = self.grid_file_out
+                if os.path.isfile(self.grid_file_out):
+                    self.previous_grid_file = self.grid_file_out
+            else:
+                # otherwise the grid is looked up by the geometry it is built
+                # from when the grid is built, the cache is shared by the
+                # recipes packed in the same out folder
+                grid_cache_dir = config["grid_cache_dir"]
+                if grid_cache_dir is None:
+                    grid_cache_dir = Path(config["out"], "grid_cache")
+                self.grid_cache = GridCache(
+                    grid_cache_dir,
+                    config["grid_cache_max_size_mb"] * 1024**2,
+                )
         self.setupfile = ""
         self.current_path = None  # the path of the recipe file
         self.custom_paths = None
@@ -208,7 +229,6 @@ class Environment(CompartmentList):
         self.randomRot = RandomRot()  # the class used to generate random rotation
         self.activeIngr = []
         self.activeIngre_saved = []
-        self.freePtsUpdateThreshold = 0.0
         # optionally can provide a host and a viewer
         self.host = None
         self.afviewer = None
@@ -253,9 +273,8 @@ class Environment(CompartmentList):
         self.nb_ingredient = 0
         self.totalNbIngr = 0
         self.treemode = "cKDTree"
-        self.close_ingr_bhtree = (
-            None  # RBHTree(a.tolist(),range(len(a)),10,10,10,10,10,9999)
-        )
+        # spatial index of the packed ingredients, updated after each placement
+        self.packed_objects_index = None
 
         self.packed_objects = PackedObjects()
 
@@ -292,10 +311,16 @@ class Environment(CompartmentList):
         """
         Clean the grid cache
         """
-        local_file_path = get_cache_location(
-            name=grid_file_name, cache="grids", destination=""
-        )
-        if os.path.exists(local_file_path):
+        if self.grid_cache is not None:
+            local_file_path = self.grid_cache.directory / grid_file_name
+        else:
+            local_file_path = get_cache_location(
+                name=grid_file_name, cache="grids", destination=""
+            )
+        if os.path.isdir(local_file_path):
+            log.info(f"Removing grid cache snapshot: {local_file_path}")
+            shutil.rmtree(local_file_path)
+        elif os.path.exists(local_file_path):
             log.info(f"Removing grid cache file: {local_file_path}")
             os.remove(local_file_path)
 
@@ -415,20 +440,51 @@ class Environment(CompartmentList):
         else:
             return spatial.distance.pdist(positions)
 
-    def get_distances(self, ingredient_name, center):
+    def get_distance_analysis_volume(self):
+        """
+        Returns the volume of the bounding box, or its area for 2D packings, and
+        its number of dimensions
+        """
+        box_size = numpy.array(self.boundingBox[1]) - numpy.array(self.boundingBox[0])
+        if self.is_two_d():
+            return float(numpy.prod(numpy.sort(box_size)[1:])), 2
+        return float(numpy.prod(box_size)), 3
 
+    def get_binned_distances(self, positions, bin_edges, other_positions=None):
+        volume, dimensions = self.get_distance_analysis_volume()
+        return get_binned_distances(
+            positions,
+            bin_edges,
+            other_positions=other_positions,
+            volume=volume,
+            dimensions=dimensions,
+        )
+
+    def get_distances(self, ingredient_name, center, bin_edges=None):
+        """
+        Returns the positions of the ingredient, their distances from the
+        center and the distances between them, binned up to the last of
+        bin_edges when they are given
+        """
         ingredient_positions = self.packed_objects.get_positions_for_ingredient(
             ingredient_name
         )
 
-        if len(ingredient_positions):
+        if bin_edges is not None:
+            distances_between_ingredients = self.get_binned_distances(
+                ingredient_positions, bin_edges
+            )
+        elif len(ingredient_positions):
             distances_between_ingredients = spatial.distance.pdist(ingredient_positions)
+        else:
+            distances_between_ingredients = numpy.array([])
+
+        if len(ingredient_positions):
             distances_from_center = numpy.linalg.norm(
                 ingredient_positions - numpy.array(center), axis=1
             )
         else:
             distances_from_center = numpy.array([])
-            distances_between_ingredients = numpy.array([])
 
         return (
             ingredient_positions,
@@ -473,12 +529,14 @@ class Environment(CompartmentList):
         )
         return numpy.degrees(numpy.array([anglesX, anglesY, anglesZ]))
 
-    def get_distances_and_angles(self, ingredient_name, center, get_angles=False):
+    def get_distances_and_angles(
+        self, ingredient_name, center, get_angles=False, bin_edges=None
+    ):
         (
             ingredient_positions,
             distances_from_center,
             distances_between_ingredients,
-        ) = self.get_distances(ingredient_name, center)
+        ) = self.get_distances(ingredient_name, center, bin_edges=bin_edges)
         if get_angles:
             angles = self.get_ingredient_angles(
                 ingredient_name, center, ingredient_positions
@@ -493,9 +551,10 @@ class Environment(CompartmentList):
             angles,
         )
 
-    def calc_pairwise_distances(self, ingr1name, ingr2name):
+    def calc_pairwise_distances(self, ingr1name, ingr2name, bin_edges=None):
         """
-        Returns pairwise distances between ingredients of different types
+        Returns pairwise distances between ingredients of different types,
+        binned up to the last of bin_edges when they are given
         """
         ingr_pos_1 = self.packed_objects.get_positions_for_ingredient(
             ingredient_name=ingr1name
@@ -503,21 +562,28 @@ class Environment(CompartmentList):
         ingr_pos_2 = self.packed_objects.get_positions_for_ingredient(
             ingredient_name=ingr2name
         )
+        if bin_edges is not None:
+            return self.get_binned_distances(
+                ingr_pos_1, bin_edges, other_positions=ingr_pos_2
+            )
         return numpy.ravel(spatial.distance.cdist(ingr_pos_1, ingr_pos_2))
 
     def save_result(
         self,
-        free_points,
-        distances,
         all_objects,
         save_grid_logs=False,
         save_result_as_file=False,
     ):
-        self.grid.free_points = free_points[:]
-        self.grid.distToClosestSurf = distances[:]
+        # the grid shares its distances and free points with the packing loop,
+        # so it already holds the current state
         # should check extension filename for type of saved file
-        if not os.path.isfile(self.grid_file_out) and self.load_from_grid_file:
-            # do not overwrite if grid was loaded from file
+        if (
+            self.grid_cache is None
+            and not os.path.isfile(self.grid_file_out)
+            and self.load_from_grid_file
+        ):
+            # do not overwrite if grid was loaded from file, the cached grids
+            # are written when they are built
             self.grid.result_filename = self.grid_file_out
             self.save_grids_to_pickle(self.grid_file_out)
         if save_grid_logs:
@@ -646,7 +712,7 @@ class Environment(CompartmentList):
         listingredient influenced
         """
         gradient_data = self.resolve_gradient_data_objects(gradient_data)
-        gradient = Gradient(gradient_data)
+        gradient = Gradient(gradient_data, compact_weights=self.compact_grid_state)
         # default gradient 1-linear Decoy X
         self.gradients[gradient_data["name"]] = gradient
 
@@ -838,6 +904,8 @@ class Environment(CompartmentList):
             "surfacePoints",
             "surfacePointsCoords",
             "surfacePointsNormals",
+            "surface_normal_rows",
+            "surface_normals",
             "ogsurfacePoints",
             "ogsurfacePointsNormals",
             "OGsrfPtsBht",
@@ -882,10 +950,11 @@ class Environment(CompartmentList):
                     and comp_obj.name == self.compartments[ct].name
                 ):
                     for update_attr in self.get_attributes_to_update():
+                        # grid files saved before an attribute was added miss it
                         setattr(
                             self.compartments[ct],
                             update_attr,
-                            getattr(comp_obj, update_attr),
+                            getattr(comp_obj, update_attr, None),
                         )
 
         # setup mesh store
@@ -899,6 +968,24 @@ class Environment(CompartmentList):
         # reset grid
         self.grid.reset()
 
+    def restore_grid_file(self, grid_file_path, grid_class):
+        """
+        Read and setup the grid from the given grid snapshot or pickle
+        """
+        if GridSnapshot.is_snapshot(grid_file_path):
+            GridSnapshot.load(self, grid_file_path, grid_class)
+        else:
+            self.restore_grids_from_pickle(grid_file_path)
+        # the grid may have been saved with other state dtypes
+        self.grid.set_state_dtypes(self.compact_grid_state)
+        self.grid.reset()
+
+    def save_grid_snapshot(self, grid_file_path):
+        """
+        Save the current grid and compartment grids to a grid snapshot directory
+        """
+        GridSnapshot.save(self, grid_file_path)
+
     def save_grids_to_pickle(self, grid_file_path):
         """
         Save the current grid and compartment grids to file. (pickle)
@@ -1146,28 +1233,33 @@ class Environment(CompartmentList):
 
     def get_closest_ingredients(self, point, cutoff=10.0):
         to_return = {"indices": [], "distances": []}
-        numpy.zeros(self.totalNbIngr).astype("i")
-        nb = 0
-        number_packed = len(self.packed_objects.get_ingredients())
-        if not number_packed:
-            return to_return
-        if self.close_ingr_bhtree is not None:
-            # request kdtree
-            nb = []
-            self.log.info("finding partners")
-
-            if number_packed >= 1:
-                distance, nb = self.close_ingr_bhtree.query(
-                    point, number_packed, distance_upper_bound=cutoff
-                )  # len of ingr posed so far
-                if number_packed == 1:
-                    distance = [distance]
-                    nb = [nb]
-                to_return["indices"] = nb
-                to_return["distances"] = distance  # sorted by distance short -> long
-            return to_return
-        else:
+        if not len(self.packed_objects.get_ingredients()):
             return to_return
+        self.log.info("finding partners")
+        indices, distances = self.update_packed_objects_index().query_ball_point(
+            point, cutoff, sort=True
+        )
+        to_return["indices"] = indices
+        to_return["distances"] = distances  # sorted by distance short -> long
+        return to_return
+
+    def update_packed_objects_index(self):
+        """
+        Adds the ingredients packed since the last call to the spatial index of
+        packed objects and returns the index
+        """
+        positions = self.packed_objects.get_positions()
+        radii = self.packed_objects.get_encapsulating_radii()
+        if self.packed_objects_index is None or len(self.packed_objects_index) > len(
+            positions
+        ):
+            cell_size = 2.0 * self.largestProteinSize
+            if cell_size <= 0:
+                cell_size = self.smallestProteinSize
+            self.packed_objects_index = SpatialHashGrid(cell_size)
+        for row in range(len(self.packed_objects_index), len(positions)):
+            self.packed_objects_index.add(positions[row], radii[row])
+        return self.packed_objects_index
 
     def setExteriorRecipe(self, recipe):
         """
@@ -1246,10 +1338,29 @@ class Environment(CompartmentList):
             from cellpack.autopack.BaseGrid import BaseGrid as Grid
 
         self.sortIngredient(reset=True)
-        if self.grid is None or self.nFill == 0:
+        grid_key = None
+        if self.grid_cache is not None and self.nFill == 0:
+            grid_key = GridCache.get_key(self, Grid, spacing)
+            self.previous_grid_file = self.grid_cache.get(grid_key)
+            self.grid_file_out = str(self.grid_cache.get_path(grid_key))
+            if self.previous_grid_file is not None:
+                self.previous_grid_file = str(self.previous_grid_file)
+
+        if self.previous_grid_file is not None and self.nFill == 0:
+            # first fill, after we can just reset
+            self.log.info("restore from file")
+            self.fillBB = boundingBox
+            self.restore_grid_file(self.previous_grid_file, Grid)
+            nbPoints = self.grid.gridVolume
+        elif self.grid is None or self.nFill == 0:
             self.log.info("####BUILD GRID - step %r", self.smallestProteinSize)
             self.fillBB = boundingBox
-            self.grid = Grid(boundingBox=boundingBox, spacing=spacing)
+            self.grid = Grid(
+                boundingBox=boundingBox,
+                spacing=spacing,
+                implicit_lattice=self.implicit_lattice,
+                compact_state=self.compact_grid_state,
+            )
             nbPoints = self.grid.gridVolume
             self.log.info("new Grid with %r %r", boundingBox, self.grid.gridVolume)
             if self.nFill == 0:
@@ -1264,16 +1375,16 @@ class Environment(CompartmentList):
 
         if self.previous_grid_file is not None:
             self.grid.filename = self.previous_grid_file
-            if self.nFill == 0:  # first fill, after we can just reset
-                self.log.info("restore from file")
-                self.restore_grids_from_pickle(self.previous_grid_file)
         else:
             self.build_compartment_grids()
 
-            # save grids to pickle
+            # save grids to file
             self.grid.filename = self.grid_file_out
             self.previous_grid_file = self.grid_file_out
-            self.save_grids_to_pickle(self.grid_file_out)
+            if grid_key is not None:
+                self.grid_cache.store(grid_key, self.save_grid_snapshot)
+            else:
+                self.save_grids_to_pickle(self.grid_file_out)
 
         self.exteriorVolume = self.grid.computeExteriorVolume(
             compartments=self.compartments,
@@ -1323,6 +1434,20 @@ class Environment(CompartmentList):
                     boundingBox, self.grid.masterGridPositions
                 )
 
+    def restore_grid_state(self):
+        """
+        Resets the distances and free points of the built grid for a new fill
+        without building the compartment grids again. The distances are copied
+        from distToClosestSurf_store, which can be a read-only shared array.
+        """
+        self.grid.distToClosestSurf = numpy.array(
+            self.grid.distToClosestSurf_store, dtype=self.grid.distance_dtype
+        )
+        self.grid.free_points = numpy.arange(
+            len(self.grid.distToClosestSurf), dtype=self.grid.index_dtype
+        )
+        self.grid.nbFreePoints = len(self.grid.free_points)
+
     def onePrevIngredient(self, i, mingrs, distance, nbFreePoints, marray):
         """
         Unused
@@ -1356,14 +1481,9 @@ class Environment(CompartmentList):
         )
         # should we reset the ingredient ? completion ?
         if not ingr.is_previous:
-            ingr.firstTimeUpdate = True
             ingr.counter = 0
             ingr.rejectionCounter = 0
             ingr.completion = 0.0  # should actually count it
-            if hasattr(
-                ingr, "allIngrPts"
-            ):  # Graham here on 5/16/12 are these two lines safe?
-                del ingr.allIngrPts  # Graham here on 5/16/12 are these two lines safe?
         return nbFreePoints
 
     def getSortedActiveIngredients(self, allIngredients):
@@ -1464,6 +1584,22 @@ class Environment(CompartmentList):
 
         return activeIngr0, activeIngr12
 
+    def set_ingredient_scheduler(self, ingredients):
+        """
+        Sorts the ingredients left to pack and builds the scheduler that picks
+        the next one. self.activeIngr is the list of the scheduler, so it stays
+        up to date as the ingredients complete.
+        """
+        self.activeIngr0, self.activeIngr12 = self.callFunction(
+            self.getSortedActiveIngredients, ([ingredients])
+        )
+        self.ingredient_scheduler = IngredientScheduler(
+            self.activeIngr0, self.activeIngr12, self.pickWeightedIngr
+        )
+        self.activeIngr = self.ingredient_scheduler.active_ingredients
+        self.log.info("len(activeIngr) %d", len(self.activeIngr))
+        return self.ingredient_scheduler
+
     def clearRBingredient(self, ingr):
         if ingr.bullet_nodes[0] is not None:
             self.delRB(ingr.bullet_nodes[0])
@@ -1474,16 +1610,22 @@ class Environment(CompartmentList):
         # before closing remoeall rigidbody
         self.loopThroughIngr(self.clearRBingredient)
 
-    def reset(self):
-        """Reset everything to empty and not done"""
+    def reset(self, keep_compartment_grids=False):
+        """
+        Reset everything to empty and not done. With keep_compartment_grids the
+        inside and surface points of the compartments are kept, for a fill on
+        a grid that is not built again
+        """
         self.fbox_bb = None
         self.totnbJitter = 0
         self.jitterLength = 0.0
         r = self.exteriorRecipe
         self.resetIngrRecip(r)
         self.packed_objects = PackedObjects()
+        self.packed_objects_index = None
         for orga in self.compartments:
-            orga.reset()
+            if not keep_compartment_grids:
+                orga.reset()
             rs = orga.surfaceRecipe
             self.resetIngrRecip(rs)
             ri = orga.innerRecipe
@@ -1499,21 +1641,17 @@ class Environment(CompartmentList):
         if recip:
             for ingr in recip.ingredients:
                 # ingr.results = []
-                ingr.firstTimeUpdate = True
                 ingr.counter = 0
                 ingr.rejectionCounter = 0
                 ingr.completion = 0.0
                 ingr.prev_alt = None
                 ingr.start_positions = []
-                if len(ingr.allIngrPts) > 0:
-                    ingr.allIngrPts = []
                 if hasattr(ingr, "isph"):
                     ingr.isph = None
                 if hasattr(ingr, "icyl"):
                     ingr.icyl = None
 
             for ingr in recip.exclude:
-                ingr.firstTimeUpdate = True
                 ingr.counter = 0
                 ingr.rejectionCounter = 0
                 ingr.completion = 0.0
@@ -1525,8 +1663,6 @@ class Environment(CompartmentList):
                     ingr.isph = None
                 if hasattr(ingr, "icyl"):
                     ingr.icyl = None
-                if len(ingr.allIngrPts) > 0:
-                    ingr.allIngrPts = []
 
     def getActiveIng(self):
         """Return all remaining active ingredients"""
@@ -1568,34 +1704,9 @@ class Environment(CompartmentList):
         Main function that decide the next ingredient the packing will try to
         drop. The picking is weighted or random
         """
-        if self.pickWeightedIngr:
-            if self.thresholdPriorities[0] == 2:
-                # Graham here: Walk through -priorities first
-                ingr = self.activeIngr[0]
-            else:
-                # prob = uniform(vRangeStart,1.0)
-                # #Graham 9/21/11 This is wrong...
-                # vRangeStart is the point index, need active list
-                # i.e. thresholdPriority to be limited
-                prob = uniform(0, 1.0)
-                ingrInd = 0
-                for threshProb in self.thresholdPriorities:
-                    if prob <= threshProb:
-                        break
-                    ingrInd = ingrInd + 1
-                if ingrInd < len(self.activeIngr):
-                    ingr = self.activeIngr[ingrInd]
-                else:
-                    log.error(f"Error in Environment pick Ingredient: {ingrInd}")
-                    ingr = self.activeIngr[0]
-                if verbose:
-                    print("weighted", prob, vThreshStart, ingrInd, ingr.name)
-        else:
-            r = random()  # randint(0, len(self.activeIngr)-1)#random()
-            # n=int(r*(len(self.activeIngr)-1))
-            n = int(r * len(self.activeIngr))
-            ingr = self.activeIngr[n]
-        #            print (r,n,ingr.name,len(self.activeIngr)) #Graham turned back on 5/16/12, but may be costly
+        ingr = self.ingredient_scheduler.pick()
+        if verbose:
+            print("picked", vThreshStart, ingr.name)
         return ingr
 
     def get_dpad(self, compartment_id):
@@ -1627,82 +1738,26 @@ class Environment(CompartmentList):
     def getPointToDrop(
         self,
         ingr,
-        free_points,
-        nbFreePoints,
-        distance,
+        grid_state,
         spacing,
-        compId,
         vRangeStart,
         vThreshStart,
     ):
         """
         Decide next point to use for dropping a given ingredent. The picking can be
         random, based on closest distance, based on gradients, ordered.
-        This function also update the available free point except when hack is on.
         """
-        allIngrPts, allIngrDist = ingr.get_list_of_free_indices(
-            distance,
-            free_points,
-            nbFreePoints,
-            spacing,
-            compId,
-            self.freePtsUpdateThreshold,
-        )
+        allIngrPts, allIngrDist = ingr.get_list_of_free_indices(grid_state, spacing)
 
         if len(allIngrPts) == 0:
-            t = time()
             ingr.completion = 1.0
-            ind = self.activeIngr.index(ingr)
-            # if ind == 0:
-            vRangeStart = vRangeStart + self.normalizedPriorities[0]
-            if ind > 0:
-                # j = 0
-                for j in range(ind):
-                    self.thresholdPriorities[j] = (
-                        self.thresholdPriorities[j] + self.normalizedPriorities[ind]
-                    )
-            self.activeIngr.pop(ind)
-            # Start of massive overruling section from corrected thesis file of Sept. 25, 2012
-            # this function also depend on the ingr.completiion that can be restored ?
-            self.activeIngr0, self.activeIngr12 = self.callFunction(
-                self.getSortedActiveIngredients, ([self.activeIngr])
+            vRangeStart = (
+                vRangeStart
+                + self.ingredient_scheduler.get_normalized_priority(self.activeIngr[0])
             )
+            self.ingredient_scheduler.remove(ingr)
             self.log.info(f"No point left for ingredient {ingr.name}")
             self.log.info("len(allIngredients %d", len(self.activeIngr))
-            self.log.info("len(self.activeIngr0) %d", len(self.activeIngr0))
-            self.log.info("len(self.activeIngr12) %d", len(self.activeIngr12))
-
-            self.activeIngre_saved = self.activeIngr[:]
-
-            self.totalPriorities = 0  # 0.00001
-            for priors in self.activeIngr12:
-                pp = priors.priority
-                self.totalPriorities = self.totalPriorities + pp
-            previousThresh = 0
-            self.normalizedPriorities = []
-            self.thresholdPriorities = []
-            # Graham- Once negatives are used, if picked random#
-            # is below a number in this list, that item becomes
-            # the active ingredient in the while loop below
-            for priors in self.activeIngr0:
-                self.normalizedPriorities.append(0)
-                if self.pickWeightedIngr:
-                    self.thresholdPriorities.append(2)
-            for priors in self.activeIngr12:
-                # pp1 = 0
-                pp = priors.priority
-                if self.totalPriorities != 0:
-                    np = float(pp) / float(self.totalPriorities)
-                else:
-                    np = 0.0
-                self.normalizedPriorities.append(np)
-                if verbose > 1:
-                    print("np is ", np, " pp is ", pp, " tp is ", np + previousThresh)
-                self.thresholdPriorities.append(np + previousThresh)
-                previousThresh = np + float(previousThresh)
-            self.activeIngr = self.activeIngr0 + self.activeIngr12
-            self.log.info("time to reject the picking %d", time() - t)
-
             return False, vRangeStart
 
         if self.pickRandPt:
@@ -1722,7 +1777,7 @@ class Environment(CompartmentList):
                 # use the gradient weighted map and get mot probabl point
                 self.log.info("pick point from gradients %d", (len(allIngrPts)))
                 ptInd = Gradient.pick_point_for_ingredient(
-                    ingr, allIngrPts, self.gradients
+                    ingr, allIngrPts, self.gradients, grid_state, spacing
                 )
             else:
                 # pick a point randomly among free points
@@ -1730,35 +1785,20 @@ class Environment(CompartmentList):
                 ptIndr = int(uniform(0.0, 1.0) * len(allIngrPts))
                 ptInd = allIngrPts[ptIndr]
             if ptInd is None:
-                t = time()
                 self.log.info(f"No point left for ingredient {ingr.name}")
                 ingr.completion = 1.0
-                ind = self.activeIngr.index(ingr)
-                # if ind == 0:
-                vRangeStart = vRangeStart + self.normalizedPriorities[0]
-                if ind > 0:
-                    # j = 0
-                    for j in range(ind):
-                        self.thresholdPriorities[j] = (
-                            self.thresholdPriorities[j] + self.normalizedPriorities[ind]
-                        )
-                self.activeIngr.pop(ind)
-                if verbose > 1:
-                    print(
-                        "popping this gradient ingredient array must be redone using Sept 25,",
-                        " 2011 thesis version as above for nongradient ingredients, TODO: July 5, 2012",
+                vRangeStart = (
+                    vRangeStart
+                    + self.ingredient_scheduler.get_normalized_priority(
+                        self.activeIngr[0]
                     )
-                self.thresholdPriorities.pop(ind)
-                self.normalizedPriorities.pop(ind)
-                if verbose > 1:
-                    print(("time to reject the picking", time() - t))
-                    print(("vRangeStart", vRangeStart))
+                )
+                self.ingredient_scheduler.remove(ingr)
                 return False, vRangeStart
 
         else:
             self.log.info("sorting index")
-            allIngrPts.sort()
-            ptInd = allIngrPts[0]
+            ptInd = int(numpy.min(allIngrPts))
         return True, ptInd
 
     def removeOnePoint(self, pt, free_points, nbFreePoints):
@@ -1787,11 +1827,12 @@ class Environment(CompartmentList):
                 self.set_partners_ingredient(ingr)
         return totalNbIngr
 
-    def prep_molecules_for_save(self, distances, free_points, nbFreePoints):
-        self.distancesAfterFill = distances[:]
-        self.freePointsAfterFill = free_points[:]
-        self.nbFreePointsAfterFill = nbFreePoints
-        self.distanceAfterFill = distances[:]
+    def prep_molecules_for_save(self, grid_state):
+        snapshot = grid_state.snapshot()
+        self.distancesAfterFill = snapshot.distances
+        self.freePointsAfterFill = snapshot.free_points
+        self.nbFreePointsAfterFill = snapshot.nb_free_points
+        self.distanceAfterFill = snapshot.distances
 
         if self.runTimeDisplay and autopack.helper.host == "simularium":
             autopack.helper.writeToFile("./realtime", self.boundingBox)
@@ -1903,10 +1944,11 @@ class Environment(CompartmentList):
         self.nFill += 1
         # seed random number generator
         self.setSeed(seedNum)
-        # create copies of the distance array as they change when molecules
-        # are added, this array can be restored/saved before filling
-        free_points = self.grid.free_points[:]
-        self.grid.nbFreePoints = nbFreePoints = len(free_points)  # -1
+        # the distances and free points are shared with the grid and updated
+        # in place when molecules are added, see BaseGrid.updateDistances
+        grid_state = self.grid.create_state()
+        free_points = grid_state.free_points
+        nbFreePoints = grid_state.nb_free_points
         if "fbox" in kw:
             self.fbox = kw["fbox"]
         if self.fbox is not None and not self.EnviroOnly:
@@ -1914,14 +1956,15 @@ class Environment(CompartmentList):
             bb_insidepoint = self.grid.getPointsInCube(self.fbox, [0, 0, 0], 1.0)[:]
             self.freePointMask[bb_insidepoint] = 0
             bb_outside = numpy.nonzero(self.freePointMask)
+            if not numpy.asarray(self.grid.compartment_ids).flags.writeable:
+                # shared with the other fills, see SharedGrid
+                self.grid.compartment_ids = numpy.array(self.grid.compartment_ids)
             self.grid.compartment_ids[bb_outside] = 99999
-        compartment_ids = self.grid.compartment_ids
 
         for compartment in self.compartments:
             compartment.store_packed_object(self)
 
-        # why a copy? --> can we split ?
-        distances = self.grid.distToClosestSurf[:]
+        distances = grid_state.distances
         spacing = self.spacing or self.smallestProteinSize
 
         # DEBUG stuff, should be removed later
@@ -1932,63 +1975,12 @@ class Environment(CompartmentList):
         self.successfullJitter = []
         self.failedJitter = []
 
-        # this function also depend on the ingr.completiion that can be restored ?
-        self.activeIngr0, self.activeIngr12 = self.callFunction(
-            self.getSortedActiveIngredients, ([allIngredients])
-        )
-
-        self.log.info("len(allIngredients %d", len(allIngredients))
-        self.log.info("len(self.activeIngr0) %d", len(self.activeIngr0))
-        self.log.info("len(self.activeIngr12) %d", len(self.activeIngr12))
-        self.activeIngre_saved = self.activeIngr[:]
-
-        self.totalPriorities = 0  # 0.00001
-        for priors in self.activeIngr12:
-            pp = priors.priority
-            self.totalPriorities = self.totalPriorities + pp
-            self.log.info("totalPriorities = %d", self.totalPriorities)
-        previousThresh = 0
-        self.normalizedPriorities = []
-        self.thresholdPriorities = []
-        # Graham- Once negatives are used, if picked random#
-        # is below a number in this list, that item becomes
-        # the active ingredient in the while loop below
-        for priors in self.activeIngr0:
-            self.normalizedPriorities.append(0)
-            if self.pickWeightedIngr:  # why ?
-                self.thresholdPriorities.append(2)
-        for priors in self.activeIngr12:
-            # pp1 = 0
-            pp = priors.priority
-            if self.totalPriorities != 0:
-                np = float(pp) / float(self.totalPriorities)
-            else:
-                np = 0.0
-            self.normalizedPriorities.append(np)
-            self.thresholdPriorities.append(np + previousThresh)
-            previousThresh = np + float(previousThresh)
-        self.activeIngr = self.activeIngr0 + self.activeIngr12
-
-        nls = 0
-        totalNumMols = 0
+        self.set_ingredient_scheduler(allIngredients)
         self.totalNbIngr = self.getTotalNbObject(allIngredients, update_partner=True)
-        if len(self.thresholdPriorities) == 0:
-            for ingr in allIngredients:
-                totalNumMols += ingr.left_to_place
-            self.log.info("totalNumMols pack_grid if = %d", totalNumMols)
-        else:
-            for threshProb in self.thresholdPriorities:
-                nameMe = self.activeIngr[nls]
-                totalNumMols += nameMe.left_to_place
-                self.log.info(
-                    "threshprop pack_grid else is %f for ingredient: %s %s %d",
-                    threshProb,
-                    nameMe,
-                    nameMe.name,
-                    nameMe.left_to_place,
-                )
-                self.log.info("totalNumMols pack_grid else = %d", totalNumMols)
-                nls += 1
+        totalNumMols = sum(
+            ingr.left_to_place for ingr in (self.activeIngr or allIngredients)
+        )
+        self.log.info("totalNumMols pack_grid = %d", totalNumMols)
 
         vRangeStart = 0.0
         tCancelPrev = time()
@@ -2068,11 +2060,8 @@ class Environment(CompartmentList):
             else:
                 res = self.getPointToDrop(
                     ingr,
-                    free_points,
-                    nbFreePoints,
-                    distances,
+                    grid_state,
                     spacing,
-                    compartment_ids,
                     vRangeStart,
                     vThreshStart,
                 )  # (Bool, ptInd)
@@ -2121,12 +2110,8 @@ class Environment(CompartmentList):
                 len(free_points),
             )
             if success:
-                nbFreePoints = BaseGrid.updateDistances(
-                    insidePoints, newDistPoints, free_points, nbFreePoints, distances
-                )
-                self.grid.distToClosestSurf = numpy.array(distances[:])
-                self.grid.free_points = numpy.array(free_points[:])
-                self.grid.nbFreePoints = len(free_points)  # -1
+                nbFreePoints = grid_state.update(insidePoints, newDistPoints)
+                self.grid.nbFreePoints = nbFreePoints
                 # update largest protein size
                 # problem when the encapsulating_radius is actually wrong
                 if ingr.encapsulating_radius > self.largestProteinSize:
@@ -2144,86 +2129,24 @@ class Environment(CompartmentList):
                 self.log.info("rejected %r", ingr.rejectionCounter)
 
             if ingr.completion >= 1.0:
-                ind = self.activeIngr.index(ingr)
-
                 self.log.info(f"completed*************** {ingr.name}")
                 self.log.info(f"PlacedMols = {PlacedMols}")
-                self.log.info(f"activeIngr index of {ingr.name}, {ind}")
-                self.log.info(
-                    f"threshold p len {len(self.thresholdPriorities)}, {len(self.normalizedPriorities)}"
-                )
-                if ind > 0:
-                    # j = 0
-                    for j in range(ind):
-                        if j >= len(self.thresholdPriorities) or j >= len(
-                            self.normalizedPriorities
-                        ):
-                            continue
-                        self.thresholdPriorities[j] = (
-                            self.thresholdPriorities[j] + self.normalizedPriorities[ind]
-                        )
-                self.activeIngr.pop(ind)
-                self.activeIngr0, self.activeIngr12 = self.callFunction(
-                    self.getSortedActiveIngredients, ([self.activeIngr])
-                )
-                self.log.info(f"len(self.activeIngr0) {len(self.activeIngr0)}")
-                self.log.info(f"len(self.activeIngr12) {len(self.activeIngr12)}")
-                self.activeIngre_saved = self.activeIngr[:]
-
-                self.totalPriorities = 0  # 0.00001
-                for priors in self.activeIngr12:
-                    pp = priors.priority
-                    self.totalPriorities = self.totalPriorities + pp
-                #                    print ('totalPriorities = ', self.totalPriorities)
-                previousThresh = 0
-                self.normalizedPriorities = []
-                self.thresholdPriorities = []
-                # Graham- Once negatives are used, if picked random#
-                # is below a number in this list, that item becomes
-                # the active ingredient in the while loop below
-                for priors in self.activeIngr0:
-                    self.normalizedPriorities.append(0)
-                    if self.pickWeightedIngr:
-                        self.thresholdPriorities.append(2)
-                for priors in self.activeIngr12:
-                    # pp1 = 0
-                    pp = priors.priority
-                    if self.totalPriorities != 0:
-                        np = float(pp) / float(self.totalPriorities)
-                    else:
-                        np = 0.0
-                    self.normalizedPriorities.append(np)
-                    #                    print ('np is ', np, ' pp is ', pp, ' tp is ', np + previousThresh)
-                    self.thresholdPriorities.append(np + previousThresh)
-                    previousThresh = np + float(previousThresh)
-                self.activeIngr = self.activeIngr0 + self.activeIngr12
+                self.ingredient_scheduler.remove(ingr)
 
             if dump and ((time() - stime) > dump_freq):
-                all_objects = self.prep_molecules_for_save(
-                    distances,
-                    free_points,
-                    nbFreePoints,
-                )
+                all_objects = self.prep_molecules_for_save(grid_state)
                 stime = time()
                 self.log.info(f"placed {len(self.packed_objects.get_ingredients())}")
                 if self.saveResult:
-                    self.save_result(
-                        free_points,
-                        distances=distances,
-                        all_objects=all_objects,
-                    )
+                    self.save_result(all_objects=all_objects)
 
         t2 = time()
         if self.show_progress_bar:
             pbar.close()
         self.log.info("time to fill %d", t2 - t1)
-        all_objects = self.prep_molecules_for_save(distances, free_points, nbFreePoints)
+        all_objects = self.prep_molecules_for_save(grid_state)
         if self.saveResult:
-            self.save_result(
-                free_points,
-                distances=distances,
-                all_objects=all_objects,
-            )
+            self.save_result(all_objects=all_objects)
 
         if kw.get("clean_grid_cache", False):
             grid_file_name = str(self.previous_grid_file).split(os.path.sep)[-1]
@@ -2290,9 +2213,7 @@ class Environment(CompartmentList):
                 o.molecules = molecules
         # consider that one filling have occured
         if len(self.packed_objects.get_ingredients()) and tree:
-            self.close_ingr_bhtree = spatial.cKDTree(
-                self.packed_objects.get_positions(), leafsize=10
-            )
+            self.update_packed_objects_index()
         self.cFill = self.nFill
         self.ingr_result = ingredients
         if len(freePoint):
@@ -2841,19 +2762,15 @@ class Environment(CompartmentList):
         image_data: numpy.ndarray
             The updated image data.
         """
-        channel_colors = {}
+        channel_names, channel_colors = self.get_voxelization_channels()
+        for channel_name in channel_names:
+            if channel_name not in image_writer.image_data:
+                image_writer.image_data[channel_name] = numpy.zeros(
+                    image_writer.image_size, dtype=numpy.uint8
+                )
 
         for obj in self.packed_objects.get_all():
             mesh_store = None
-            if obj.name not in image_writer.image_data:
-                image_writer.image_data[obj.name] = numpy.zeros(
-                    image_writer.image_size, dtype=numpy.uint8
-                )
-                if obj.color is not None:
-                    color = obj.color
-                    if all([x <= 1 for x in obj.color]):
-                        color = [int(col * 255) for col in obj.color]
-                    channel_colors[obj.name] = color
             if obj.is_compartment:
                 mesh_store = self.mesh_store
 
@@ -2870,3 +2787,92 @@ class Environment(CompartmentList):
         image_writer.channel_colors = channel_colors
 
         return image_writer
+
+    def get_voxelization_channels(self):
+        """
+        Returns the channel names, one per packed object name in packing order,
+        and the 0-255 colors of the channels of the objects with a color
+        """
+        channel_names = []
+        channel_colors = {}
+        for obj in self.packed_objects.get_all():
+            if obj.name in channel_names:
+                continue
+            channel_names.append(obj.name)
+            if obj.color is not None:
+                color = obj.color
+                if all([x <= 1 for x in obj.color]):
+                    color = [int(col * 255) for col in obj.color]
+                channel_colors[obj.name] = color
+        return channel_names, channel_colors
+
+    def get_voxelization_bounds(self, voxel_size):
+        """
+        Returns the first and last voxel indices each packed object can fill,
+        compartments can fill the whole image
+        """
+        packed_objects = self.packed_objects.get_all()
+        lower = numpy.full((len(packed_objects), 3), numpy.iinfo(int).min // 2)
+        upper = numpy.full((len(packed_objects), 3), numpy.iinfo(int).max // 2)
+        for row, obj in enumerate(packed_objects):
+            if obj.is_compartment:
+                continue
+            radius = obj.ingredient.get_voxelization_radius()
+            relative_position = numpy.ravel(obj.position)[:3] - self.boundingBox[0]
+            # one more voxel for the truncation of the negative indices
+            lower[row] = numpy.floor((relative_position - radius) / voxel_size) - 1
+            upper[row] = numpy.floor((relative_position + radius) / voxel_size) + 1
+        return lower, upper
+
+    def create_voxelization_tile(
+        self, image_writer, channel_names, tile_start, tile_size, bounds=None
+    ):
+        """
+        Voxelizes the packed objects in a tile of the image of image_writer.
+
+        Parameters
+        ----------
+        image_writer: ImageWriter
+            The image writer giving the voxel size, image size and hollow option.
+        channel_names: list
+            Names of the channels, from get_voxelization_channels.
+        tile_start: numpy.ndarray
+            Index in the image of the first voxel of the tile, the tile can
+            extend outside of the image where it stays empty.
+        tile_size: numpy.ndarray
+            Number of voxels of the tile along each axis.
+        bounds: tuple
+            Voxel bounds of the packed objects from get_voxelization_bounds,
+            only the objects overlapping the tile are voxelized.
+
+        Returns
+        ----------
+        tile: numpy.ndarray
+            (channels, *tile_size) uint8 image of the tile.
+        """
+        tile_start = numpy.asarray(tile_start, dtype=int)
+        tile_end = tile_start + tile_size
+        tile = numpy.zeros((len(channel_names), *tile_size), dtype=numpy.uint8)
+        channel_indices = {name: index for index, name in enumerate(channel_names)}
+        packed_objects = self.packed_objects.get_all()
+        if bounds is None:
+            bounds = self.get_voxelization_bounds(image_writer.voxel_size)
+        lower, upper = bounds
+        overlapping = numpy.all((lower < tile_end) & (upper >= tile_start), axis=1)
+        for row in numpy.nonzero(overlapping)[0]:
+            obj = packed_objects[row]
+            mesh_store = None
+            if obj.is_compartment:
+                mesh_store = self.mesh_store
+            obj.ingredient.create_voxelization(
+                image_data=tile[channel_indices[obj.name]],
+                bounding_box=self.boundingBox,
+                voxel_size=image_writer.voxel_size,
+                image_size=image_writer.image_size,
+                position=obj.position,
+                rotation=obj.rotation,
+                hollow=image_writer.hollow,
+                mesh_store=mesh_store,
+                image_offset=tile_start,
+            )
+        return tile
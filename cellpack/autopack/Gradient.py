@@ -47,11 +47,12 @@
 """
 
 import bisect
+import sys
 from random import random
 
 import numpy
 
-from cellpack.autopack.utils import get_distances_from_point
+from cellpack.autopack.utils import get_distances_from_point, map_positions
 
 
 class Gradient:
@@ -63,7 +64,17 @@ class Gradient:
     as well as the sampling function
     """
 
-    def __init__(self, gradient_data):
+    # random value drawn by each weighted random pick mode, from the same
+    # generator as the scan over the candidate weights it replaces
+    weighted_pick_values = {
+        "rnd": lambda: numpy.random.rand(1)[0],
+        "linear": random,
+        "binary": random,
+        "sub": random,
+        "combined": numpy.random.random_sample,
+    }
+
+    def __init__(self, gradient_data, compact_weights=False):
         self.name = gradient_data["name"]
         self.description = gradient_data["description"]
         self.mode = gradient_data["mode"]
@@ -75,6 +86,9 @@ class Gradient:
 
         self.weight = None
         self.bb = None  # this is set when weight map is built in the env
+        # store the weights as float16 and the distances as float32, the
+        # weights are read back as float64
+        self.compact_weights = compact_weights
 
         self.axes = {"X": 0, "-X": 0, "Y": 1, "-Y": 1, "Z": 2, "-Z": 2}
 
@@ -164,7 +178,7 @@ class Gradient:
         int
             the index of the picked point
         """
-        weights_to_use = numpy.take(weight, points)
+        weights_to_use = numpy.take(weight, points).astype(float)
         weights_to_use[numpy.isnan(weights_to_use)] = 0
         weights_to_use = Gradient.normalize_by_max_value(weights_to_use)
 
@@ -175,7 +189,35 @@ class Gradient:
         return point
 
     @staticmethod
-    def pick_point_for_ingredient(ingr, allIngrPts, all_gradients):
+    def get_ingredient_weight(ingr, all_gradients):
+        """
+        Returns the weight map of the ingredient gradient, the combined weight of
+        multiple gradients is computed once and cached on the ingredient
+        """
+        if not isinstance(ingr.gradient, list):
+            return all_gradients[ingr.gradient].weight
+        if len(ingr.gradient) == 1:
+            return all_gradients[ingr.gradient[0]].weight
+        if not hasattr(ingr, "combined_weight"):
+            gradient_list = []
+            for gradient_name in ingr.gradient:
+                if gradient_name not in all_gradients:
+                    raise ValueError(
+                        f"Gradient {gradient_name} not found in gradient list"
+                    )
+                gradient_list.append(all_gradients[gradient_name])
+
+            ingr.combined_weight = Gradient.get_combined_gradient_weight(
+                gradient_list, ingr.gradient_weights
+            )
+            if all(gradient.compact_weights for gradient in gradient_list):
+                ingr.combined_weight = ingr.combined_weight.astype(numpy.float16)
+        return ingr.combined_weight
+
+    @staticmethod
+    def pick_point_for_ingredient(
+        ingr, allIngrPts, all_gradients, grid_state=None, spacing=None
+    ):
         """
         Picks a point for an ingredient according to the gradient
 
@@ -190,36 +232,41 @@ class Gradient:
         all_gradients: dict
             dictionary of all gradient objects
 
+        grid_state: GridState
+            when given, the weighted random pick modes draw from a sum tree
+            over the candidate points of the ingredient instead of the
+            weights of allIngrPts
+
+        spacing: float
+            grid spacing, used with grid_state to find the candidate points
+
         Returns
         ----------
         int
             the index of the picked point
         """
-        if isinstance(ingr.gradient, list):
-            if len(ingr.gradient) > 1:
-                if not hasattr(ingr, "combined_weight"):
-                    gradient_list = []
-                    for gradient_name in ingr.gradient:
-                        if gradient_name not in all_gradients:
-                            raise ValueError(
-                                f"Gradient {gradient_name} not found in gradient list"
-                            )
-                        gradient_list.append(all_gradients[gradient_name])
-
-                    combined_weight = Gradient.get_combined_gradient_weight(
-                        gradient_list, ingr.gradient_weights
-                    )
-                    ingr.combined_weight = combined_weight
-
-                ptInd = Gradient.pick_point_from_weight(
-                    ingr.combined_weight, allIngrPts
-                )
-            else:
-                ptInd = all_gradients[ingr.gradient[0]].pickPoint(allIngrPts)
+        if isinstance(ingr.gradient, list) and len(ingr.gradient) > 1:
+            pick_mode = "combined"
         else:
-            ptInd = all_gradients[ingr.gradient].pickPoint(allIngrPts)
+            gradient_name = (
+                ingr.gradient[0] if isinstance(ingr.gradient, list) else ingr.gradient
+            )
+            gradient = all_gradients[gradient_name]
+            pick_mode = gradient.pick_mode
+        weight = Gradient.get_ingredient_weight(ingr, all_gradients)
 
-        return ptInd
+        if grid_state is not None and pick_mode in Gradient.weighted_pick_values:
+            weighted_candidates = ingr.get_weighted_candidates(
+                grid_state, spacing, weight
+            )
+            value = Gradient.weighted_pick_values[pick_mode]()
+            # a value of 0 still has to pick a point with a positive weight
+            return weighted_candidates.find(
+                max(value * weighted_candidates.total(), sys.float_info.min)
+            )
+        if pick_mode == "combined":
+            return Gradient.pick_point_from_weight(weight, allIngrPts)
+        return gradient.pickPoint(allIngrPts)
 
     def get_center(self):
         """get the center of the gradient grid"""
@@ -283,7 +330,10 @@ class Gradient:
         diag = numpy.linalg.norm(bb[1] - bb[0])
         center = self.mode_settings.get("center", self.get_center())
         radius = self.mode_settings.get("radius", diag)
-        distances = get_distances_from_point(master_grid_positions, center)
+        distances = map_positions(
+            lambda positions: get_distances_from_point(positions, center),
+            master_grid_positions,
+        )
         self.distances = numpy.where(distances < radius, distances, radius)
         self.set_weights_by_mode()
 
@@ -312,7 +362,10 @@ class Gradient:
         direction = self.normalize_vector(direction)
         self.weight = []
         center = self.mode_settings.get("center", self.get_center())
-        self.distances = numpy.abs(numpy.dot(master_grid_positions - center, direction))
+        self.distances = map_positions(
+            lambda positions: numpy.abs(numpy.dot(positions - center, direction)),
+            master_grid_positions,
+        )
         self.set_weights_by_mode()
 
     def build_axis_weight_map(self, bb, master_grid_positions):
@@ -324,7 +377,10 @@ class Gradient:
         ind = self.axes[self.mode]
         mini = min(bb[1][ind], bb[0][ind])
         self.weight = []
-        self.distances = numpy.abs((master_grid_positions[:, ind] - mini))
+        self.distances = map_positions(
+            lambda positions: numpy.abs((positions[:, ind] - mini)),
+            master_grid_positions,
+        )
         self.set_weights_by_mode()
 
     def build_uniform_weight_map(self, master_grid_positions):
@@ -332,7 +388,10 @@ class Gradient:
         Build a uniform weight map
         """
         self.distances = numpy.zeros(len(master_grid_positions), dtype=numpy.uint8)
-        self.weight = numpy.ones(len(master_grid_positions))
+        self.weight = numpy.ones(
+            len(master_grid_positions),
+            dtype=numpy.float16 if self.compact_weights else float,
+        )
 
     def set_weights_by_mode(self):
 
@@ -382,8 +441,21 @@ class Gradient:
         if self.invert == "weight":
             self.weight = 1.0 - self.weight
 
+        if self.compact_weights:
+            self.weight = self.weight.astype(numpy.float16)
+            self.distances = self.distances.astype(numpy.float32, copy=False)
+            self.scaled_distances = self.scaled_distances.astype(
+                numpy.float32, copy=False
+            )
+
         # TODO: talk to Ludo about calculating gaussian weights
 
+    def get_weights(self, points):
+        """
+        Returns the weights of the given grid points as float64
+        """
+        return numpy.take(self.weight, points).astype(float, copy=False)
+
     def getMaxWeight(self, listPts):
         """
         from the given list of grid point indice, get the point with the maximum weight
@@ -420,7 +492,7 @@ class Gradient:
         the chance to pick the index i
         is give by the weight weights[i].
         """
-        weight = numpy.take(self.weight, list_of_pts)
+        weight = self.get_weights(list_of_pts)
         t = numpy.cumsum(weight)
         s = numpy.sum(weight)
         i = numpy.searchsorted(t, numpy.random.rand(1) * s)[0]
@@ -442,7 +514,7 @@ class Gradient:
         """
         totals = []
         running_total = 0
-        weights = numpy.take(self.weight, listPts)
+        weights = self.get_weights(listPts)
         for w in weights:
             running_total += w
             totals.append(running_total)
@@ -464,7 +536,7 @@ class Gradient:
         totals = []
         running_total = 0
 
-        weights = numpy.take(self.weight, listPts)
+        weights = self.get_weights(listPts)
         for w in weights:
             running_total += w
             totals.append(running_total)
@@ -494,7 +566,7 @@ class Gradient:
         the total weight will be skipped in the beginning.
         """
 
-        weights = numpy.take(self.weight, listPts)
+        weights = self.get_weights(listPts)
         rnd = random() * sum(weights)
         for i, w in enumerate(weights):
             rnd -= w
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+
+import numpy
+
+log = logging.getLogger(__name__)
+
+
+class GridCache:
+    """
+    Directory of grid snapshots named by a hash of everything the grid is built
+    from: the compartment geometry and placement, the spacing, the bounding box
+    and the grid method. Recipes that share a cell shape get the same key and
+    reuse the grid instead of building it again, and a change to any of these
+    inputs gives a new key instead of a stale grid.
+
+    The snapshots are evicted least recently used first once the directory
+    holds more than max_size bytes. A hit updates the modification time of the
+    snapshot, which is the time the eviction orders the snapshots by.
+    """
+
+    # bump when the content of the grid snapshots changes
+    version = 2
+    suffix = "_grid"
+    key_length = hashlib.sha256().digest_size * 2
+
+    def __init__(self, directory, max_size):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def _update_with_array(sha, array):
+        array = numpy.ascontiguousarray(array)
+        sha.update(f"{array.dtype.str}{array.shape}".encode())
+        sha.update(array.tobytes())
+
+    @staticmethod
+    def get_compartment_geometry(compartment, mesh_store):
+        """
+        Returns the vertices and faces of the compartment mesh, or None for the
+        compartments without a mesh, whose shape is set by their placement
+        """
+        if compartment.type == "mesh" and compartment.representations.has_mesh():
+            geometry = mesh_store.get_mesh(compartment.gname, compartment.filename)
+            if geometry is not None:
+                return geometry.vertices, geometry.faces
+        return None
+
+    @staticmethod
+    def get_key(env, grid_class, spacing):
+        sha = hashlib.sha256()
+        settings = {
+            "version": GridCache.version,
+            "grid": grid_class.__name__,
+            "inner_grid_method": env.innerGridMethod,
+            # the snapshot stores the lattice or the dense positions
+            "implicit_lattice": bool(env.implicit_lattice),
+            "spacing": float(spacing),
+            "bounding_box": numpy.asarray(env.boundingBox, dtype=float).tolist(),
+            "fbox_bb": (
+                None
+                if env.fbox_bb is None
+                else numpy.asarray(env.fbox_bb, dtype=float).tolist()
+            ),
+        }
+        sha.update(json.dumps(settings, sort_keys=True).encode())
+        for compartment in env.compartments:
+            placement = {
+                "name": compartment.name,
+                "type": compartment.type,
+                "gname": compartment.gname,
+                "ghost": bool(compartment.ghost),
+                "radius": float(compartment.radius),
+                "position": numpy.asarray(compartment.position, dtype=float).tolist(),
+                "scale": float(compartment.scale),
+                "bounding_box": (
+                    None
+                    if compartment.bounding_box is None
+                    else numpy.asarray(compartment.bounding_box, dtype=float).tolist()
+                ),
+            }
+            sha.update(json.dumps(placement, sort_keys=True).encode())
+            geometry = GridCache.get_compartment_geometry(compartment, env.mesh_store)
+            if geometry is not None:
+                vertices, faces = geometry
+                GridCache._update_with_array(sha, numpy.asarray(vertices, dtype=float))
+                GridCache._update_with_array(sha, numpy.asarray(faces, dtype=int))
+        return sha.hexdigest()
+
+    def get_path(self, key):
+        return self.directory / f"{key}{self.suffix}"
+
+    def get(self, key):
+        """
+        Returns the path of the grid snapshot of the key, or None if it is not
+        in the cache
+        """
+        path = self.get_path(key)
+        if path.is_dir():
+            self.hits += 1
+            os.utime(path)
+            log.info(f"Grid cache hit {key}")
+            return path
+        self.misses += 1
+        log.info(f"Grid cache miss {key}")
+        return None
+
+    def store(self, key, save):
+        """
+        Writes the grid snapshot of the key with save(path) and evicts the
+        least recently used snapshots over the size limit. The snapshot is
+        written under a temporary name first, so a process reading the cache
+        never sees it half written.
+        """
+        path = self.get_path(key)
+        temporary_path = self.directory / f"{key}.{os.getpid()}.tmp"
+        try:
+            save(str(temporary_path))
+            try:
+                os.replace(temporary_path, path)
+            except OSError:
+                # another process stored the same grid first
+                log.info(f"Grid cache already has {key}")
+        finally:
+            if temporary_path.exists():
+                shutil.rmtree(temporary_path)
+        self.evict(keep=path)
+        return path
+
+    @staticmethod
+    def get_size(path):
+        return sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(path)
+            for name in names
+        )
+
+    def evict(self, keep=None):
+        files = []
+        for path in self.directory.glob(f"*{self.suffix}"):
+            # leave the other grid files of the directory alone
+            if len(path.name) != self.key_length + len(self.suffix):
+                continue
+            try:
+                files.append((path.stat().st_mtime, self.get_size(path), path))
+            except FileNotFoundError:
+                # removed by another process
+                continue
+        total_size = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files, key=lambda file: file[0]):
+            if total_size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            log.info(f"Evicting grid cache snapshot {path}")
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+
+    def get_stats(self):
+        return {"hits": self.hits, "misses": self.misses}
@@ -0,0 +1,318 @@
+import json
+import logging
+import os
+
+import numpy
+import trimesh
+from scipy import spatial
+
+from cellpack.autopack.BaseGrid import BaseGrid, LatticeIndices, LatticePositions
+
+log = logging.getLogger(__name__)
+
+
+def _to_json(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, os.PathLike):
+        return str(value)
+    if isinstance(value, numpy.generic):
+        # numpy and python scalars don't promote the same way in numpy
+        # operations, keep the type
+        return {"dtype": value.dtype.str, "value": value.item()}
+    return numpy.asarray(value).tolist()
+
+
+def _from_json(value):
+    if isinstance(value, dict):
+        return numpy.dtype(value["dtype"]).type(value["value"])
+    return value
+
+
+class LazyKDTree:
+    """
+    cKDTree over points that is only built the first time it is queried, so a
+    restored grid doesn't pay for the trees it never uses
+    """
+
+    def __init__(self, data, leafsize=10):
+        self.data = data
+        self.leafsize = leafsize
+        self.tree = None
+
+    def __getattr__(self, name):
+        # only called for the attributes the wrapper doesn't have
+        if name.startswith("__") or "data" not in self.__dict__:
+            raise AttributeError(name)
+        if self.tree is None:
+            self.tree = spatial.cKDTree(self.data, leafsize=self.leafsize)
+        return getattr(self.tree, name)
+
+
+class GridSnapshotWriter:
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest = {"arrays": {}, "values": {}, "trees": {}, "dicts": {}}
+
+    def save_array(self, name, value):
+        if value is None:
+            self.manifest["arrays"][name] = None
+            return
+        if isinstance(value, LatticePositions):
+            # only the axes and the off-grid positions are stored
+            for part in ("x", "y", "z", "off_grid_positions"):
+                self.save_array(f"{name}.{part}", getattr(value, part))
+            self.manifest["arrays"][name] = {"lattice_positions": value.dtype.str}
+            return
+        if isinstance(value, LatticeIndices):
+            self.manifest["arrays"][name] = {"lattice_indices": value.nb_grid_points}
+            return
+        value = numpy.asarray(value)
+        if value.dtype == object:
+            raise TypeError(f"{name} can't be saved as a numeric array")
+        file_name = f"{name}.npy"
+        numpy.save(os.path.join(self.directory, file_name), value, allow_pickle=False)
+        self.manifest["arrays"][name] = file_name
+
+    def save_value(self, name, value):
+        self.manifest["values"][name] = _to_json(value)
+
+    def save_tree(self, name, tree):
+        points = None if tree is None else tree.data
+        self.save_array(f"{name}.data", points)
+        self.manifest["trees"][name] = f"{name}.data"
+
+    def save_dict(self, name, value):
+        keys = numpy.array(list(value.keys()), dtype=int)
+        values = numpy.array(list(value.values()), dtype=float).reshape(-1, 3)
+        self.save_array(f"{name}.keys", keys)
+        self.save_array(f"{name}.values", values)
+        self.manifest["dicts"][name] = [f"{name}.keys", f"{name}.values"]
+
+
+class GridSnapshotReader:
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.manifest = manifest
+
+    def load_array(self, name):
+        file_name = self.manifest["arrays"][name]
+        if file_name is None:
+            return None
+        if isinstance(file_name, dict):
+            if "lattice_indices" in file_name:
+                return LatticeIndices(file_name["lattice_indices"])
+            return LatticePositions(
+                *[
+                    self.load_array(f"{name}.{part}")
+                    for part in ("x", "y", "z", "off_grid_positions")
+                ],
+                dtype=file_name["lattice_positions"],
+            )
+        return numpy.load(os.path.join(self.directory, file_name), mmap_mode="r")
+
+    def load_value(self, name):
+        return _from_json(self.manifest["values"][name])
+
+    def load_tree(self, name):
+        points = self.load_array(self.manifest["trees"][name])
+        return None if points is None else LazyKDTree(points)
+
+    def load_dict(self, name):
+        keys_name, values_name = self.manifest["dicts"][name]
+        return dict(
+            zip(
+                self.load_array(keys_name).tolist(),
+                numpy.asarray(self.load_array(values_name)),
+            )
+        )
+
+
+class GridSnapshot:
+    """
+    Directory holding a built grid as one .npy file per array and a JSON
+    manifest for the other values. The arrays are loaded memory mapped and
+    read-only, so opening a grid doesn't read it and the processes that open
+    the same snapshot share its pages. The KD-trees are stored as the points
+    they are built on and are built again when they are first queried.
+    """
+
+    version = 1
+    manifest_name = "manifest.json"
+
+    grid_arrays = (
+        "masterGridPositions",
+        "compartment_ids",
+        "distToClosestSurf",
+        "distToClosestSurf_store",
+        "free_points",
+        "ijkPtIndice",
+        "_x",
+        "_y",
+        "_z",
+        "lattice_origin",
+    )
+    grid_values = (
+        "boundingBox",
+        "gridSpacing",
+        "nbGridPoints",
+        "gridVolume",
+        "diag",
+        "nbSurfacePoints",
+        "nbFreePoints",
+        "encapsulatingGrid",
+        "center",
+        "filename",
+        "result_filename",
+    )
+    grid_array_lists = ("aInteriorGrids", "aSurfaceGrids")
+    grid_trees = ("surfPtsBht",)
+
+    compartment_values = (
+        "filename",
+        "ref_obj",
+        "bb",
+        "encapsulating_radius",
+        "radius",
+    )
+    compartment_dicts = ("surfacePointsNormals",)
+    compartment_trees = ("OGsrfPtsBht",)
+
+    @staticmethod
+    def get_compartment_arrays(attributes):
+        skipped = (
+            GridSnapshot.compartment_values
+            + GridSnapshot.compartment_dicts
+            + GridSnapshot.compartment_trees
+        )
+        return [name for name in attributes if name not in skipped]
+
+    @staticmethod
+    def save(env, directory):
+        """
+        Writes the grid of the environment and the grid data of its compartments
+        to the directory
+        """
+        log.info("Saving grid snapshot to %s", directory)
+        os.makedirs(directory, exist_ok=True)
+        writer = GridSnapshotWriter(directory)
+        grid = env.grid
+        for name in GridSnapshot.grid_arrays:
+            writer.save_array(f"grid.{name}", getattr(grid, name))
+        for name in GridSnapshot.grid_values:
+            writer.save_value(f"grid.{name}", getattr(grid, name))
+        for name in GridSnapshot.grid_array_lists:
+            arrays = getattr(grid, name)
+            writer.save_value(f"grid.{name}", len(arrays))
+            for index, array in enumerate(arrays):
+                writer.save_array(f"grid.{name}.{index}", array)
+        for name in GridSnapshot.grid_trees:
+            writer.save_tree(f"grid.{name}", getattr(grid, name))
+
+        attributes = env.get_attributes_to_update()
+        compartment_names = []
+        for index, compartment in enumerate(env.compartments):
+            compartment_names.append(compartment.name)
+            prefix = f"compartment.{index}"
+            for name in GridSnapshot.get_compartment_arrays(attributes):
+                writer.save_array(f"{prefix}.{name}", getattr(compartment, name, None))
+            for name in GridSnapshot.compartment_values:
+                writer.save_value(f"{prefix}.{name}", getattr(compartment, name, None))
+            for name in GridSnapshot.compartment_dicts:
+                writer.save_dict(f"{prefix}.{name}", getattr(compartment, name) or {})
+            for name in GridSnapshot.compartment_trees:
+                writer.save_tree(f"{prefix}.{name}", getattr(compartment, name, None))
+
+        manifest = writer.manifest
+        manifest["version"] = GridSnapshot.version
+        manifest["grid_class"] = type(grid).__name__
+        manifest["compartments"] = compartment_names
+        # the manifest is written last, a snapshot without one is incomplete
+        with open(os.path.join(directory, GridSnapshot.manifest_name), "w") as f:
+            json.dump(manifest, f)
+
+    @staticmethod
+    def is_snapshot(path):
+        return os.path.isfile(os.path.join(path, GridSnapshot.manifest_name))
+
+    @staticmethod
+    def load(env, directory, grid_class):
+        """
+        Sets the grid of the environment and the grid data of its compartments
+        from the snapshot in directory. The arrays are read-only memory maps.
+        """
+        log.debug(f"Loading grid snapshot from {directory}")
+        with open(os.path.join(directory, GridSnapshot.manifest_name)) as f:
+            manifest = json.load(f)
+        if manifest["version"] != GridSnapshot.version:
+            raise ValueError(
+                f"Grid snapshot version {manifest['version']} is not supported: {directory}"
+            )
+        if manifest["grid_class"] != grid_class.__name__:
+            raise ValueError(
+                f"Grid snapshot of a {manifest['grid_class']} can't be loaded as a {grid_class.__name__}"
+            )
+        reader = GridSnapshotReader(directory, manifest)
+
+        # the attributes of the grid are all set from the snapshot, the lattice
+        # is not built again
+        grid = grid_class.__new__(grid_class)
+        BaseGrid.__init__(
+            grid,
+            boundingBox=reader.load_value("grid.boundingBox"),
+            spacing=reader.load_value("grid.gridSpacing"),
+            setup=False,
+        )
+        for name in GridSnapshot.grid_values:
+            setattr(grid, name, reader.load_value(f"grid.{name}"))
+        grid.boundingBox = numpy.array(grid.boundingBox)
+        for name in GridSnapshot.grid_arrays:
+            setattr(grid, name, reader.load_array(f"grid.{name}"))
+        for name in GridSnapshot.grid_array_lists:
+            setattr(
+                grid,
+                name,
+                [
+                    reader.load_array(f"grid.{name}.{index}")
+                    for index in range(reader.load_value(f"grid.{name}"))
+                ],
+            )
+        for name in GridSnapshot.grid_trees:
+            setattr(grid, name, reader.load_tree(f"grid.{name}"))
+        grid.setupBoundaryPeriodicity()
+        env.grid = grid
+
+        attributes = env.get_attributes_to_update()
+        for index, compartment_name in enumerate(manifest["compartments"]):
+            prefix = f"compartment.{index}"
+            for compartment in env.compartments:
+                if compartment.name != compartment_name:
+                    continue
+                for name in GridSnapshot.get_compartment_arrays(attributes):
+                    setattr(compartment, name, reader.load_array(f"{prefix}.{name}"))
+                for name in GridSnapshot.compartment_values:
+                    setattr(compartment, name, reader.load_value(f"{prefix}.{name}"))
+                for name in GridSnapshot.compartment_dicts:
+                    setattr(compartment, name, reader.load_dict(f"{prefix}.{name}"))
+                for name in GridSnapshot.compartment_trees:
+                    setattr(compartment, name, reader.load_tree(f"{prefix}.{name}"))
+                GridSnapshot.add_compartment_mesh(compartment, env.mesh_store)
+        grid.reset()
+
+    @staticmethod
+    def add_compartment_mesh(compartment, mesh_store):
+        """
+        Adds the mesh of the compartment to the mesh store from the restored
+        vertices and faces, if the store doesn't have it yet
+        """
+        if compartment.vertices is None or not len(compartment.vertices):
+            return
+        if mesh_store.get_object(compartment.gname) is not None:
+            return
+        mesh = trimesh.Trimesh(
+            vertices=numpy.asarray(compartment.vertices),
+            faces=numpy.asarray(compartment.faces),
+            vertex_normals=numpy.asarray(compartment.vnormals),
+            process=False,
+        )
+        mesh_store.add_mesh_to_scene(mesh, compartment.gname)
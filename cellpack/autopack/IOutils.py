@@ -104,7 +104,7 @@ def updatePositionsRadii(ingr):
         toupdate["positions"].append(
             {"coords": numpy.array(ingr.positions[i]).flatten().tolist()}
         )
-        toupdate["radii"].append({"radii": ingr.radii[i]})
+        toupdate["radii"].append({"radii": numpy.array(ingr.radii[i]).tolist()})
     return toupdate
 
 
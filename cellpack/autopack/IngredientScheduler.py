@@ -0,0 +1,127 @@
+import logging
+import sys
+from random import random, uniform
+
+log = logging.getLogger(__name__)
+
+
+class FenwickTree:
+    """
+    Binary indexed tree over non-negative weights, with O(log n) updates, prefix
+    sums and search of the first index whose cumulative weight reaches a value
+    """
+
+    def __init__(self, weights):
+        self.size = len(weights)
+        self.weights = [float(weight) for weight in weights]
+        self.tree = [0.0] * (self.size + 1)
+        for index, weight in enumerate(self.weights):
+            self.add(index, weight)
+
+    def add(self, index, delta):
+        position = index + 1
+        while position <= self.size:
+            self.tree[position] += delta
+            position += position & -position
+
+    def set(self, index, weight):
+        self.add(index, weight - self.weights[index])
+        self.weights[index] = weight
+
+    def prefix_sum(self, end):
+        """sum of the weights before end"""
+        total = 0.0
+        while end > 0:
+            total += self.tree[end]
+            end -= end & -end
+        return total
+
+    def total(self):
+        return self.prefix_sum(self.size)
+
+    def find(self, value):
+        """
+        Returns the first index whose cumulative weight is at least value, or
+        None if value is larger than the total weight
+        """
+        position = 0
+        remaining = value
+        step = 1 << self.size.bit_length()
+        while step:
+            next_position = position + step
+            if next_position <= self.size and self.tree[next_position] < remaining:
+                position = next_position
+                remaining -= self.tree[next_position]
+            step >>= 1
+        if position == self.size:
+            return None
+        return position
+
+
+class IngredientScheduler:
+    """
+    Picks the next ingredient the packing tries to drop. Ingredients with a
+    negative priority are packed first, one at a time in the sorted order. The
+    others are picked at random, weighted by their priority, with a Fenwick tree
+    over the priorities so a pick and the weight update of a completed or
+    reweighted ingredient are O(log n) instead of rebuilding the cumulative
+    thresholds. The picks use the same calls to the random module
+    as the cumulative threshold list they replace, so a seed gives the same
+    sequence of ingredients.
+    """
+
+    def __init__(self, negative_ingredients, weighted_ingredients, pick_weighted=True):
+        self.pick_weighted = pick_weighted
+        self.negative_ingredients = list(negative_ingredients)
+        self.weighted_ingredients = list(weighted_ingredients)
+        self.weighted_index = {
+            id(ingredient): index
+            for index, ingredient in enumerate(self.weighted_ingredients)
+        }
+        self.weights = FenwickTree(
+            [ingredient.priority for ingredient in self.weighted_ingredients]
+        )
+        # the active ingredients in picking order, updated in place
+        self.active_ingredients = self.negative_ingredients + self.weighted_ingredients
+
+    def __len__(self):
+        return len(self.active_ingredients)
+
+    def get_normalized_priority(self, ingredient):
+        """
+        Probability for the ingredient to be picked, 0 for the ingredients with a
+        negative priority
+        """
+        index = self.weighted_index.get(id(ingredient))
+        if index is None:
+            return 0.0
+        total = self.weights.total()
+        if total == 0:
+            return 0.0
+        return self.weights.weights[index] / total
+
+    def pick(self):
+        if not self.pick_weighted:
+            return self.active_ingredients[int(random() * len(self.active_ingredients))]
+        if len(self.negative_ingredients):
+            return self.negative_ingredients[0]
+        prob = uniform(0, 1.0)
+        # the first ingredient with a positive weight is picked for prob = 0
+        index = self.weights.find(max(prob * self.weights.total(), sys.float_info.min))
+        if index is None:
+            log.error(f"Error in IngredientScheduler pick: {prob}")
+            return self.active_ingredients[0]
+        return self.weighted_ingredients[index]
+
+    def reweight(self, ingredient, priority):
+        index = self.weighted_index[id(ingredient)]
+        self.weights.set(index, float(priority))
+
+    def remove(self, ingredient):
+        """removes a completed ingredient from the picking"""
+        self.active_ingredients.remove(ingredient)
+        index = self.weighted_index.pop(id(ingredient), None)
+        if index is None:
+            self.negative_ingredients.remove(ingredient)
+        else:
+            self.weights.set(index, 0.0)
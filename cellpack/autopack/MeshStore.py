@@ -293,6 +293,16 @@ class MeshStore:
             triangle_id = triangle_ids[0]
             return mesh.vertex_normals[triangle_id]
 
+    def get_normals(self, geomname, positions):
+        """
+        Normals of the closest mesh vertex of each position, the batched version
+        of get_normal
+        """
+        mesh = self.get_object(geomname)
+        if mesh is not None:
+            _, vertex_ids = mesh.kdtree.query(positions)
+            return mesh.vertex_normals[vertex_ids]
+
     def get_centroid(self, geomname):
         mesh = self.get_object(geomname)
         if mesh is not None:
@@ -332,7 +342,49 @@ class MeshStore:
         return geometry
 
     @staticmethod
-    def calc_scaled_distances_for_positions(position_list, inner_mesh, outer_mesh):
+    def get_first_ray_hits(mesh, ray_origins, ray_directions, chunk_size=10000):
+        """
+        Location of the first intersection of each ray with the mesh, or nan
+        for the rays that don't hit it. The rays are cast chunk_size at a time
+        to bound the memory of the intersection query.
+        """
+        ray_origins = numpy.asarray(ray_origins, dtype=float)
+        ray_directions = numpy.asarray(ray_directions, dtype=float)
+        hits = numpy.full(ray_origins.shape, numpy.nan)
+        for start in range(0, len(ray_origins), chunk_size):
+            end = start + chunk_size
+            locations, index_ray, _ = mesh.ray.intersects_location(
+                ray_origins=ray_origins[start:end],
+                ray_directions=ray_directions[start:end],
+                multiple_hits=False,
+            )
+            hits[start + index_ray] = locations
+        return hits
+
+    @staticmethod
+    def get_ray_hits(mesh, ray_origins, ray_directions, chunk_size=10000):
+        """
+        Locations of all the intersections of the rays with the mesh and the
+        index of the ray of each one, cast chunk_size rays at a time
+        """
+        ray_origins = numpy.asarray(ray_origins, dtype=float)
+        ray_directions = numpy.asarray(ray_directions, dtype=float)
+        all_locations = [numpy.zeros((0, 3))]
+        all_ray_indices = [numpy.zeros(0, dtype=int)]
+        for start in range(0, len(ray_origins), chunk_size):
+            end = start + chunk_size
+            locations, index_ray, _ = mesh.ray.intersects_location(
+                ray_origins=ray_origins[start:end],
+                ray_directions=ray_directions[start:end],
+            )
+            all_locations.append(locations)
+            all_ray_indices.append(start + index_ray)
+        return numpy.concatenate(all_locations), numpy.concatenate(all_ray_indices)
+
+    @staticmethod
+    def calc_scaled_distances_for_positions(
+        position_list, inner_mesh, outer_mesh, chunk_size=10000
+    ):
         # first, calculates intersection points and distances
         # between given position_list and inner_mesh
         # then, calculates the distances between inner_mesh and outer_mesh
@@ -344,11 +396,12 @@ class MeshStore:
         inner_loc, inner_surface_distances, _ = query.on_surface(position_list)
 
         # intersecting points on the outer surface
-        outer_loc = numpy.zeros(inner_loc.shape)
-        for ind, position in enumerate(position_list):
-            outer_loc[ind], _, _ = outer_mesh.ray.intersects_location(
-                ray_origins=[inner_loc[ind]], ray_directions=[position - inner_loc[ind]]
-            )
+        outer_loc = MeshStore.get_first_ray_hits(
+            outer_mesh,
+            inner_loc,
+            numpy.asarray(position_list) - inner_loc,
+            chunk_size=chunk_size,
+        )
 
         distance_between_surfaces = numpy.linalg.norm(outer_loc - inner_loc, axis=1)
         scaled_distance_between_surfaces = (
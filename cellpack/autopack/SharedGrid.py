@@ -0,0 +1,79 @@
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy
+
+
+class SharedGrid:
+    """
+    Copies the arrays of a built grid that don't change during a fill (grid point
+    positions, compartment ids and the distances before any ingredient is
+    placed) to shared memory blocks. The processes that pack the seeds of a
+    recipe attach to the blocks instead of building the grid again; the attached
+    arrays are read-only and each fill works on its own copy of the distances.
+    """
+
+    array_names = ("masterGridPositions", "compartment_ids", "distToClosestSurf_store")
+    # per fill state, set again from the shared arrays before each fill
+    fill_array_names = ("distToClosestSurf", "free_points")
+
+    def __init__(self, grid):
+        self.blocks = []
+        self.specs = {}
+        for name in self.array_names:
+            array = getattr(grid, name)
+            if not isinstance(array, numpy.ndarray):
+                # positions computed from the lattice are sent with the grid
+                continue
+            array = numpy.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared_array = numpy.ndarray(
+                array.shape, dtype=array.dtype, buffer=block.buf
+            )
+            shared_array[...] = array
+            self.blocks.append(block)
+            self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    @contextmanager
+    def detached(self, grid):
+        """
+        Removes the shared and per fill arrays from the grid while it is sent
+        to the worker processes, so they are not pickled with it
+        """
+        names = tuple(self.specs) + self.fill_array_names
+        arrays = {name: getattr(grid, name) for name in names}
+        for name in names:
+            setattr(grid, name, None)
+        try:
+            yield grid
+        finally:
+            for name, array in arrays.items():
+                setattr(grid, name, array)
+
+    @staticmethod
+    def attach(grid, specs):
+        """
+        Sets the shared arrays described by specs on the grid as read-only arrays
+        """
+        blocks = []
+        for name, (block_name, shape, dtype) in specs.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            array = numpy.ndarray(shape, dtype=dtype, buffer=block.buf)
+            array.flags.writeable = False
+            setattr(grid, name, array)
+            blocks.append(block)
+        # the blocks have to stay open as long as the grid uses the arrays
+        grid.shared_memory_blocks = blocks
+        return blocks
@@ -0,0 +1,110 @@
+import numpy
+
+
+class SpatialHashGrid:
+    """
+    Uniform hash grid over the positions of packed objects. Objects are added in
+    O(1) as they are placed, instead of rebuilding a KD-tree after every placement,
+    and radius queries only look at the cells overlapping the query sphere.
+    """
+
+    # number of point and object pairs compared at once
+    max_pairs = 1 << 20
+
+    def __init__(self, cell_size, capacity=1024):
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        self.positions = numpy.zeros((capacity, 3))
+        self.radii = numpy.zeros(capacity)
+        self.count = 0
+        self.max_radius = 0.0
+
+    def __len__(self):
+        return self.count
+
+    def get_cell(self, position):
+        return tuple(
+            numpy.floor(numpy.asarray(position, dtype=float) / self.cell_size)
+            .astype(int)
+            .tolist()
+        )
+
+    def add(self, position, radius=0.0):
+        """adds a point with its radius and returns its index"""
+        if self.count == len(self.positions):
+            self.positions = numpy.resize(self.positions, (2 * self.count, 3))
+            self.radii = numpy.resize(self.radii, 2 * self.count)
+        index = self.count
+        self.positions[index] = numpy.asarray(position, dtype=float).ravel()[:3]
+        self.radii[index] = radius
+        self.cells.setdefault(self.get_cell(self.positions[index]), []).append(index)
+        self.count += 1
+        self.max_radius = max(self.max_radius, radius)
+        return index
+
+    def get_candidates(self, point, radius):
+        return self.get_candidates_in_box(point - radius, point + radius)
+
+    def get_candidates_in_box(self, lower_corner, upper_corner):
+        lower = numpy.floor(lower_corner / self.cell_size).astype(int)
+        upper = numpy.floor(upper_corner / self.cell_size).astype(int)
+        if numpy.prod(upper - lower + 1) >= len(self.cells):
+            # the query covers more cells than are occupied
+            return numpy.arange(self.count)
+        candidates = []
+        for i in range(lower[0], upper[0] + 1):
+            for j in range(lower[1], upper[1] + 1):
+                for k in range(lower[2], upper[2] + 1):
+                    cell = self.cells.get((i, j, k))
+                    if cell is not None:
+                        candidates.extend(cell)
+        return numpy.array(candidates, dtype=int)
+
+    def query_ball_point(self, point, radius, sort=False):
+        """
+        Returns the indices and distances of the points within radius of point,
+        sorted by distance if sort is True
+        """
+        point = numpy.asarray(point, dtype=float).ravel()[:3]
+        candidates = self.get_candidates(point, radius)
+        distances = numpy.linalg.norm(self.positions[candidates] - point, axis=1)
+        within = distances <= radius
+        indices, distances = candidates[within], distances[within]
+        if sort:
+            order = numpy.argsort(distances, kind="stable")
+            indices, distances = indices[order], distances[order]
+        return indices, distances
+
+    def query_ball_points(self, points, radius):
+        """
+        Returns the pairs of point index, object index and distance of the
+        objects within radius of each of the points, ordered by point index
+        """
+        points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+        if not len(points):
+            return (
+                numpy.array([], dtype=int),
+                numpy.array([], dtype=int),
+                numpy.array([]),
+            )
+        candidates = self.get_candidates_in_box(
+            points.min(0) - radius, points.max(0) + radius
+        )
+        candidate_positions = self.positions[candidates]
+        chunk_size = max(self.max_pairs // max(len(candidates), 1), 1)
+        point_indices, indices, distances = [], [], []
+        for start in range(0, len(points), chunk_size):
+            chunk_distances = numpy.linalg.norm(
+                candidate_positions[None, :, :]
+                - points[start : start + chunk_size, None, :],
+                axis=2,
+            )
+            rows, columns = numpy.nonzero(chunk_distances <= radius)
+            point_indices.append(rows + start)
+            indices.append(candidates[columns])
+            distances.append(chunk_distances[rows, columns])
+        return (
+            numpy.concatenate(point_indices),
+            numpy.concatenate(indices),
+            numpy.concatenate(distances),
+        )
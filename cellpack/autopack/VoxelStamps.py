@@ -0,0 +1,139 @@
+import numpy
+
+
+class VoxelStamp:
+    """
+    Boolean mask of a shape in a small box of voxels. offset is the index of
+    the first voxel of the box relative to the voxel the stamp is written at,
+    the mask is only written in the part of the box inside the image, so a
+    stamp costs the volume of its shape whatever the size of the image.
+
+    The stamps of the spheres only depend on the radius and the voxel size,
+    they are computed once and shared by all the spheres of that radius.
+
+    image_data can also be a window of the whole image, image_offset is then
+    the index in the whole image of its first voxel, as for the tiles of the
+    chunked image export.
+    """
+
+    sphere_stamps = {}
+
+    def __init__(self, mask, offset):
+        self.mask = mask
+        self.offset = numpy.asarray(offset, dtype=int)
+
+    @staticmethod
+    def get_voxel(position, bounding_box, voxel_size):
+        """index of the voxel of a position, as in the whole image masks"""
+        relative_position = numpy.asarray(position) - bounding_box[0]
+        return (relative_position / voxel_size).astype(int)
+
+    @staticmethod
+    def get_sphere_stamp(radius, voxel_size):
+        """
+        Stamp of the voxels within radius of the center voxel, the same voxels
+        as SingleSphereIngr.create_circular_mask
+        """
+        voxel_size = numpy.asarray(voxel_size)
+        key = (float(radius), tuple(voxel_size.tolist()))
+        stamp = VoxelStamp.sphere_stamps.get(key)
+        if stamp is None:
+            reach = numpy.floor(radius / voxel_size).astype(int) + 1
+            X, Y, Z = numpy.ogrid[
+                -reach[0] : reach[0] + 1,
+                -reach[1] : reach[1] + 1,
+                -reach[2] : reach[2] + 1,
+            ]
+            dist_from_center = numpy.sqrt(
+                (X * voxel_size[0]) ** 2
+                + (Y * voxel_size[1]) ** 2
+                + (Z * voxel_size[2]) ** 2
+            )
+            stamp = VoxelStamp(dist_from_center <= radius, -reach)
+            VoxelStamp.sphere_stamps[key] = stamp
+        return stamp
+
+    @staticmethod
+    def from_shape(
+        lower,
+        upper,
+        bounding_box,
+        voxel_size,
+        image_size,
+        is_inside,
+        image_offset=None,
+        window_size=None,
+    ):
+        """
+        Stamp of the voxels of the image between the lower and upper corners
+        whose positions are inside the shape. is_inside takes an array of
+        positions and returns one boolean per position. The stamp is written
+        at voxel (0, 0, 0). With image_offset and window_size only the voxels
+        of that window of the image are tested.
+        """
+        origin = numpy.asarray(bounding_box[0], dtype=float)
+        voxel_size = numpy.asarray(voxel_size)
+        start = numpy.maximum(numpy.floor((lower - origin) / voxel_size), 0)
+        end = numpy.minimum(numpy.floor((upper - origin) / voxel_size) + 1, image_size)
+        if image_offset is not None:
+            start = numpy.maximum(start, image_offset)
+            end = numpy.minimum(end, numpy.add(image_offset, window_size))
+        start = start.astype(int)
+        shape = numpy.maximum(end.astype(int) - start, 0)
+        if not numpy.all(shape):
+            return VoxelStamp(numpy.zeros(shape, dtype=bool), start)
+        X, Y, Z = numpy.meshgrid(
+            *[numpy.arange(start[i], start[i] + shape[i]) for i in range(3)],
+            indexing="ij",
+        )
+        positions = (
+            numpy.stack([X.ravel(), Y.ravel(), Z.ravel()], axis=1) * voxel_size + origin
+        )
+        return VoxelStamp(is_inside(positions).reshape(shape), start)
+
+    def write(
+        self, image_data, voxel=(0, 0, 0), value=255, image_offset=None, image_size=None
+    ):
+        """
+        sets the voxels of the mask to value, clipped to image_data and to the
+        whole image of size image_size when image_data is a window of it
+        """
+        start = numpy.asarray(voxel, dtype=int) + self.offset
+        end = start + self.mask.shape
+        if image_offset is None:
+            image_offset = numpy.zeros(3, dtype=int)
+        image_offset = numpy.asarray(image_offset, dtype=int)
+        lower = numpy.maximum(numpy.maximum(start, 0), image_offset)
+        upper = numpy.minimum(end, image_offset + image_data.shape)
+        if image_size is not None:
+            upper = numpy.minimum(upper, image_size)
+        if numpy.any(upper <= lower):
+            return image_data
+        image_slices = tuple(
+            slice(lower[i] - image_offset[i], upper[i] - image_offset[i])
+            for i in range(3)
+        )
+        mask_slices = tuple(
+            slice(lower[i] - start[i], upper[i] - start[i]) for i in range(3)
+        )
+        image_data[image_slices][self.mask[mask_slices]] = value
+        return image_data
+
+
+def inside_cylinders(positions, bottoms, tops, radii):
+    """
+    Returns which positions are inside any of the cylinders going from the
+    bottoms to the tops
+    """
+    inside = numpy.zeros(len(positions), dtype=bool)
+    for bottom, top, radius in zip(bottoms, tops, radii):
+        axis = numpy.asarray(top, dtype=float) - bottom
+        length_sq = numpy.dot(axis, axis)
+        relative_positions = positions - bottom
+        if length_sq > 0:
+            t = relative_positions @ axis / length_sq
+        else:
+            t = numpy.zeros(len(positions))
+        distances = numpy.linalg.norm(relative_positions - numpy.outer(t, axis), axis=1)
+        inside |= (t >= 0.0) & (t <= 1.0) & (distances <= radius)
+    return inside
@@ -390,7 +390,13 @@ def get_local_file_location(
     return input_file_location
 
 
-def read_text_file(filename, destination="", cache="collisionTrees", force=None):
+def get_text_file_location(
+    filename, destination="", cache="collisionTrees", force=None
+):
+    """
+    Returns the local path of a text file, downloaded to the cache first if
+    it is remote
+    """
     if is_remote_path(filename):
         database_name, file_path = convert_db_shortname_to_url(filename)
         if database_name == "firebase":
@@ -405,6 +411,13 @@ def read_text_file(filename, destination="", cache="collisionTrees", force=None)
         local_file_path = get_local_file_location(
             filename, destination=destination, cache=cache, force=force
         )
+    return local_file_path
+
+
+def read_text_file(filename, destination="", cache="collisionTrees", force=None):
+    local_file_path = get_text_file_location(
+        filename, destination=destination, cache=cache, force=force
+    )
     f = open(local_file_path)
     sphere_data = f.readlines()
     f.close()
@@ -45,12 +45,11 @@
 import logging
 import math
 from math import pi
-from random import gauss, random, uniform
+from random import gauss, getstate, random, setstate, uniform
 from time import time
 
 import collada
 import numpy
-from scipy import spatial
 from scipy.spatial.transform import Rotation as R
 
 import cellpack.autopack as autopack
@@ -307,9 +306,6 @@ class Ingredient(Agent):
             jitter_attempts  # number of jitter attempts for translation
         )
         self.nbPts = 0
-        self.allIngrPts = (
-            []
-        )  # the list of available grid points for this ingredient to pack
         self.counter = 0  # target number of molecules for a fill
         self.completion = 0.0  # ratio of counter/count
         self.rejectionCounter = 0
@@ -546,6 +542,13 @@ class Ingredient(Agent):
             if self.mesh:
                 return self.mesh.faces, self.mesh.vertices, self.mesh.vertex_normals
 
+    def get_voxelization_radius(self):
+        """
+        radius around the position of the ingredient of the voxels its
+        create_voxelization can fill
+        """
+        return self.encapsulating_radius
+
     def get_rb_model(self, alt=False):
         ret = 0
         if alt:
@@ -762,45 +765,18 @@ class Ingredient(Agent):
         self.min_distance = cut
         return cut
 
-    def checkIfUpdate(self, nbFreePoints, threshold):
-        """Check if we need to update the distance array. Part of the hack free points"""
-        if hasattr(self, "nbPts"):
-            if hasattr(self, "firstTimeUpdate") and not self.firstTimeUpdate:
-                # if it has been updated before
-                # check the number of inside points for this ingredient over the total
-                # number of free points left
-                ratio = float(self.nbPts) / float(nbFreePoints)
-                # threshold defaults to zero. It's set by the env, `freePtsUpdateThreshold`
-                if ratio > threshold:
-                    return True
-                else:
-                    if self.haveBeenRejected and self.rejectionCounter > 5:
-                        self.haveBeenRejected = False
-                        return True
-                    # do we check to total freepts? or crowded state ?
-                    else:
-                        return False
-            else:
-                self.firstTimeUpdate = False
-                return True
-        else:
-            return True
-
-    def get_list_of_free_indices(
-        self,
-        distances,
-        free_points,
-        nbFreePoints,
-        spacing,
-        comp_ids,
-        threshold,
-    ):
-        allIngrPts = []
+    def get_list_of_free_indices(self, grid_state, spacing):
+        """
+        Returns the free grid points this ingredient can be dropped at and, in
+        "close" mode, their distances to the closest surface
+        """
         allIngrDist = []
         current_comp_id = self.compartment_id
         # gets min distance an object has to be away to allow packing for this object
         cuttoff = self.get_cuttoff_value(spacing)
         if self.packing_mode == "close":
+            distances = grid_state.distances
+            free_points = grid_state.free_points
             # Get an array of free points where the distance is greater than half the cuttoff value
             # and less than the cutoff. Ie an array where the distances are all very small.
             # this also masks the array to only include points in the current commpartment
@@ -810,43 +786,29 @@ class Ingredient(Agent):
                 numpy.greater_equal(all_distances, cuttoff / 2.0),
             )
             # mask compartments Id as well
-            compartment_mask = numpy.array(comp_ids)[free_points] == current_comp_id
+            compartment_mask = (
+                numpy.array(grid_state.compartment_ids)[free_points] == current_comp_id
+            )
             mask_ind = numpy.nonzero(
                 numpy.logical_and(distance_mask, compartment_mask)
             )[0]
             allIngrPts = numpy.array(free_points)[mask_ind].tolist()
             allIngrDist = numpy.array(distances)[mask_ind].tolist()
         else:
-            starting_array = free_points
-            array_length = nbFreePoints
-            # if this ingredient has a grid point array already from a previous pass, and it's shorter
-            # than the total number of free points, start there for picking points, because it means
-            # we've already filtered out some points that are too close to surfaces for this ingredient to
-            # pack and we don't want to have to filter them out again.
-            if len(self.allIngrPts) > 0 and len(self.allIngrPts) < nbFreePoints:
-                starting_array = self.allIngrPts
-                array_length = len(self.allIngrPts)
-
-            # use periodic update according size ratio grid
-            update = self.checkIfUpdate(nbFreePoints, threshold)
-            self.log.info(f"check if update: {update}")
-            if update:
-                # Only return points that aren't so close to a surface that we know the
-                # ingredient won't fit
-                for i in range(array_length):
-                    pt_index = starting_array[i]
-                    d = distances[pt_index]
-                    if comp_ids[pt_index] == current_comp_id and d >= cuttoff:
-                        allIngrPts.append(pt_index)
-                self.allIngrPts = allIngrPts
-            else:
-                if len(self.allIngrPts) > 0:
-                    allIngrPts = self.allIngrPts
-                else:
-                    allIngrPts = free_points[:nbFreePoints]
-                    self.allIngrPts = allIngrPts
+            # Only return points that aren't so close to a surface that we know the
+            # ingredient won't fit
+            allIngrPts = grid_state.get_candidates(current_comp_id, cuttoff)
         return allIngrPts, allIngrDist
 
+    def get_weighted_candidates(self, grid_state, spacing, weights):
+        """
+        Returns a sum tree over the weights of the points returned by
+        get_list_of_free_indices, that is kept up to date as points are filled
+        """
+        return grid_state.get_weighted_candidates(
+            self.name, weights, self.compartment_id, self.get_cuttoff_value(spacing)
+        )
+
     def perturbAxis(self, amplitude):
         # modify axis using gaussian distribution but clamp
         # at amplitutde
@@ -1001,6 +963,91 @@ class Ingredient(Agent):
                 new_dist_points[grid_point_index] = signed_distance_to_surface
         return inside_points, new_dist_points
 
+    @staticmethod
+    def reduce_duplicate_points(points, values, reduce):
+        """
+        Combines the values of repeated grid points with the reduce ufunc, keeping
+        the points in the order they first appear
+        """
+        if len(points) == 0:
+            return points, values
+        unique_points, first, inverse = numpy.unique(
+            points, return_index=True, return_inverse=True
+        )
+        if len(unique_points) == len(points):
+            return points, values
+        reduced = numpy.full(len(unique_points), values[first])
+        reduce.at(reduced, inverse, values)
+        order = numpy.argsort(first)
+        return unique_points[order], reduced[order]
+
+    def get_new_distances_and_inside_points_from_arrays(
+        self, points, signed_distances, grid_distance_values
+    ):
+        """
+        Batched version of get_new_distances_and_inside_points. Takes the grid point
+        indices and their signed distance to the surface of the dropped ingredient
+        and returns (indices, distances) arrays for the inside points and the
+        points whose distance decreases, in the order they are first found
+        """
+        inside = signed_distances <= 0
+        inside_points = Ingredient.reduce_duplicate_points(
+            points[inside], signed_distances[inside], numpy.maximum
+        )
+        closer = ~inside
+        closer[closer] = signed_distances[closer] < grid_distance_values[points[closer]]
+        new_dist_points = Ingredient.reduce_duplicate_points(
+            points[closer], signed_distances[closer], numpy.minimum
+        )
+        return inside_points, new_dist_points
+
+    def collide_spheres_with_grid(
+        self,
+        centers,
+        radii,
+        env,
+        current_grid_distances,
+        dpad,
+        collision_only=False,
+    ):
+        """
+        Batched collision test of spheres against the grid. All the grid points
+        within radius + dpad of each sphere are tested at once and the test stops
+        at the first sphere reaching an occupied grid point.
+        Returns (collision, inside_points, new_dist_points) where the points are
+        (indices, signed distances) arrays, or None on collision or collision_only
+        """
+        grid_positions = env.grid.masterGridPositions
+        all_points = []
+        all_distances = []
+        for center, radius in zip(centers, radii):
+            points = numpy.asarray(
+                env.grid.getPointsInSphere(center, radius + dpad), dtype=int
+            )
+            distances = numpy.linalg.norm(grid_positions[points] - center, axis=1)
+            collision = current_grid_distances[points] + distances <= radius
+            if collision.any():
+                self.log.info(
+                    "grid point already occupied %f",
+                    current_grid_distances[points[numpy.argmax(collision)]],
+                )
+                return True, None, None
+            all_points.append(points)
+            all_distances.append(distances - radius)
+        if collision_only:
+            return False, None, None
+        if not len(all_points):
+            empty = (numpy.array([], dtype=int), numpy.array([]))
+            return False, empty, empty
+        inside_points, new_dist_points = (
+            self.get_new_distances_and_inside_points_from_arrays(
+                numpy.concatenate(all_points),
+                numpy.concatenate(all_distances),
+                current_grid_distances,
+            )
+        )
+        return False, inside_points, new_dist_points
+
     def is_point_in_correct_region(self, point):
         # crude location check (using nearest grid point)
         nearest_grid_point_compartment_id = (
@@ -1083,6 +1130,64 @@ class Ingredient(Agent):
         else:
             return False
 
+    def are_points_in_correct_region(self, points):
+        """is_point_in_correct_region for an array of points"""
+        points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+        compartment_ingr_belongs_in = self.compartment_id
+        if compartment_ingr_belongs_in > 0:  # surface ingredient
+            if self.type == "Grow" and len(self.compMask):
+                return numpy.isin(
+                    self.env.compartment_id_for_nearest_grid_point(points),
+                    self.compMask,
+                )
+            return numpy.ones(len(points), dtype=bool)
+        elif compartment_ingr_belongs_in < 0:
+            compartment = self.env.compartments[abs(compartment_ingr_belongs_in) - 1]
+            return compartment.are_points_inside_mesh(points, self.env.mesh_store)
+        # shouldnt be in any compartments
+        in_region = (
+            self.env.compartment_id_for_nearest_grid_point(points)
+            == compartment_ingr_belongs_in
+        )
+        for o in self.env.compartments:
+            if not in_region.any():
+                break
+            in_region[in_region] = ~o.are_points_inside_mesh(
+                points[in_region], self.env.mesh_store
+            )
+        return in_region
+
+    def are_far_enough_from_surfaces(self, points, cutoff):
+        """far_enough_from_surfaces for an array of points"""
+        points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+        far_enough = numpy.ones(len(points), dtype=bool)
+        ingredient_compartment = self.get_compartment(self.env)
+        for compartment in self.env.compartments:
+            if (
+                self.compartment_id > 0
+                and ingredient_compartment.name == compartment.name
+            ):
+                continue
+            distances, _ = compartment.OGsrfPtsBht.query(points)
+            far_enough &= ~(distances < cutoff)
+        return far_enough
+
+    def are_points_available(self, points):
+        """point_is_available for an array of points"""
+        points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+        available = self.env.grid.are_points_inside_bb(
+            points,
+            dist=self.cutoff_boundary,
+            jitter=getNormedVectorOnes(self.max_jitter),
+        )
+        if available.any():
+            available[available] = self.are_points_in_correct_region(points[available])
+        if available.any():
+            available[available] = self.are_far_enough_from_surfaces(
+                points[available], cutoff=self.cutoff_surface
+            )
+        return available
+
     def oneJitter(self, env, trans, rotMat):
         jtrans = self.randomize_translation(env, trans, rotMat)
         rotMatj = self.randomize_rotation(rotMat, env)
@@ -1098,6 +1203,47 @@ class Ingredient(Agent):
 
         return self.oneJitter(env, starting_pos, starting_rotation)
 
+    @staticmethod
+    def get_random_state(env):
+        return getstate(), env.randomRot.seedTable.get_state()
+
+    @staticmethod
+    def set_random_state(env, state):
+        setstate(state[0])
+        env.randomRot.seedTable.set_state(state[1])
+
+    def get_jitter_candidates(
+        self, env, starting_pos, starting_rotation, nb_attempts=None
+    ):
+        """
+        Draws the locations and rotations of all the jitter attempts at once.
+        The draws can't be vectorized without changing the random stream, they
+        are made in the order the one attempt at a time loop makes them.
+        """
+        if nb_attempts is None:
+            nb_attempts = self.jitter_attempts
+        locations = []
+        rotations = []
+        for _ in range(nb_attempts):
+            location, rotation = self.get_new_jitter_location_and_rotation(
+                env, starting_pos, starting_rotation
+            )
+            locations.append(location)
+            rotations.append(rotation)
+        return locations, rotations
+
+    def rewind_jitter_candidates(
+        self, env, random_state, starting_pos, starting_rotation, nb_attempts
+    ):
+        """
+        Sets the random generators back to the state before the candidates
+        were drawn and draws the first nb_attempts again, which leaves the
+        stream where the one attempt at a time loop leaves it after the first
+        successful attempt. Cheaper than saving the state after every draw.
+        """
+        self.set_random_state(env, random_state)
+        self.get_jitter_candidates(env, starting_pos, starting_rotation, nb_attempts)
+
     def getIngredientsInBox(self, env, jtrans, rotMat, compartment):
         if env.windowsSize_overwrite:
             radius = env.windowsSize
@@ -1214,51 +1360,25 @@ class Ingredient(Agent):
             positions_to_adjust = ingr.positions[0]
         return self.transformPoints(pos, rot, positions_to_adjust)
 
-    def check_against_one_packed_ingr(self, index, level, search_tree):
-        ingredient_instance = self.env.packed_objects.get_ingredients()[index]
-        ingredient_class = ingredient_instance.ingredient
-        positions_of_packed_ingr_spheres = self.get_new_pos(
-            ingredient_class,
-            ingredient_instance.position,
-            ingredient_instance.rotation,
-            ingredient_class.positions[level],
-        )
-        # check distances between the spheres at this level in the ingr we are packing
-        # to the spheres at this level in the ingr already placed
-        # return the number of distances for the spheres we are trying to place
-        dist_from_packed_spheres_to_new_spheres, ind = search_tree.query(
-            positions_of_packed_ingr_spheres, len(self.positions[level])
-        )
-        # return index of sph1 closest to pos of packed ingr
-        cradii = numpy.array(self.radii[level])[ind]
-        oradii = numpy.array(
-            self.env.packed_objects.get_ingredients()[index].ingredient.radii[level]
-        )
-        sumradii = numpy.add(cradii.transpose(), oradii).transpose()
-        sD = dist_from_packed_spheres_to_new_spheres - sumradii
-        return len(numpy.nonzero(sD < 0.0)[0]) != 0
-
     def np_check_collision(self, packing_location, rotation):
         has_collision = False
+        packed_objects_index = self.env.update_packed_objects_index()
         # no ingredients packed yet
-        packed_objects = self.env.packed_objects.get_ingredients()
-        if not len(packed_objects):
+        if not len(packed_objects_index):
             return has_collision
-        else:
-            if self.env.close_ingr_bhtree is None:
-                self.env.close_ingr_bhtree = spatial.cKDTree(
-                    self.env.packed_objects.get_positions(), leafsize=10
-                )
         # starting at level 0, check encapsulating radii
         level = 0
         total_levels = 0 if not hasattr(self, "positions") else len(self.positions)
+        # only the packed ingredients closer than the sum of the encapsulating
+        # radii can overlap
         (
-            distances_from_packing_location_to_all_ingr,
             ingr_indexes,
-        ) = self.env.close_ingr_bhtree.query(packing_location, len(packed_objects))
-        radii_of_placed_ingr = numpy.array(
-            self.env.packed_objects.get_encapsulating_radii()
-        )[ingr_indexes]
+            distances_from_packing_location_to_all_ingr,
+        ) = packed_objects_index.query_ball_point(
+            packing_location,
+            self.encapsulating_radius + packed_objects_index.max_radius,
+        )
+        radii_of_placed_ingr = packed_objects_index.radii[ingr_indexes]
         overlap_distance = distances_from_packing_location_to_all_ingr - (
             self.encapsulating_radius + radii_of_placed_ingr
         )
@@ -1269,31 +1389,66 @@ class Ingredient(Agent):
             level = level + 1
             # single sphere ingr will exit here.
             if level >= total_levels:
-                has_collision = True
-            # for each packed ingredient that had a collision, we want to check the more
-            # detailed geometry, ie walk down the sphere tree file.
-            while level < total_levels:
-                pos_of_attempting_ingr = self.get_new_pos(
-                    self, packing_location, rotation, self.positions[level]
-                )
-                search_tree_for_new_ingr = spatial.cKDTree(pos_of_attempting_ingr)
-                collision_at_this_level = False
-                # NOTE: At certain lengths of overlap_indices, it might help to remove items from the list
-                # if they dont have a collision at a non max level, but for short arrays, removing indices
-                # takes longer than not checking it.
-                for overlap_index in overlap_indexes:
-                    index = ingr_indexes[overlap_index]
-                    collision_at_this_level = self.check_against_one_packed_ingr(
-                        index, level, search_tree_for_new_ingr
-                    )
-                    if collision_at_this_level:
-                        break
-                level += 1
-                if collision_at_this_level:
-                    if level == total_levels:
-                        # found collision at lowest level, break all the way out
-                        return True
-                del search_tree_for_new_ingr
+                return True
+            # only the deepest level of the sphere tree decides the collision,
+            # its spheres are checked against the cached world space spheres of
+            # all the overlapping packed ingredients at once
+            level = total_levels - 1
+            pos_of_attempting_ingr = self.get_new_pos(
+                self, packing_location, rotation, self.positions[level]
+            )
+            has_collision = self.env.packed_objects.get_level_spheres(level).overlaps(
+                numpy.asarray(ingr_indexes)[overlap_indexes],
+                pos_of_attempting_ingr,
+                self.radii[level],
+            )
+        return has_collision
+
+    def np_check_collisions(self, packing_locations, rotations):
+        """
+        np_check_collision for several locations and rotations at once, returns
+        one boolean per location
+        """
+        packing_locations = numpy.asarray(packing_locations, dtype=float).reshape(-1, 3)
+        has_collision = numpy.zeros(len(packing_locations), dtype=bool)
+        packed_objects_index = self.env.update_packed_objects_index()
+        if not len(packed_objects_index) or not len(packing_locations):
+            return has_collision
+        total_levels = 0 if not hasattr(self, "positions") else len(self.positions)
+        (
+            location_indexes,
+            ingr_indexes,
+            distances_from_packing_location_to_all_ingr,
+        ) = packed_objects_index.query_ball_points(
+            packing_locations,
+            self.encapsulating_radius + packed_objects_index.max_radius,
+        )
+        overlap_distance = distances_from_packing_location_to_all_ingr - (
+            self.encapsulating_radius + packed_objects_index.radii[ingr_indexes]
+        )
+        overlapping = overlap_distance < 0.0
+        location_indexes = location_indexes[overlapping]
+        ingr_indexes = ingr_indexes[overlapping]
+        if not len(location_indexes):
+            return has_collision
+        if total_levels <= 1:
+            has_collision[location_indexes] = True
+            return has_collision
+        # the deepest level of the locations with overlapping encapsulating
+        # radii, checked in one call
+        level = total_levels - 1
+        checked, query_indexes = numpy.unique(location_indexes, return_inverse=True)
+        pos_of_attempting_ingr = [
+            self.get_new_pos(
+                self, packing_locations[index], rotations[index], self.positions[level]
+            )
+            for index in checked
+        ]
+        has_collision[checked] = self.env.packed_objects.get_level_spheres(
+            level
+        ).overlaps_queries(
+            query_indexes, ingr_indexes, pos_of_attempting_ingr, self.radii[level]
+        )
         return has_collision
 
     def checkDistance(self, liste_nodes, point, cutoff):
@@ -1397,10 +1552,7 @@ class Ingredient(Agent):
         return nodes
 
     def update_data_tree(self):
-        if len(self.env.packed_objects.get_ingredients()) >= 1:
-            self.env.close_ingr_bhtree = spatial.cKDTree(
-                self.env.packed_objects.get_positions(), leafsize=10
-            )
+        self.env.update_packed_objects_index()
 
     def pack_at_grid_pt_location(
         self,
@@ -1568,10 +1720,12 @@ class Ingredient(Agent):
         collision_possible = True
         if collision_possible or is_fiber:
             if is_fiber:
+                # grow_place works on its own copy of the free points, the grid
+                # is updated by the packing loop once the fiber is placed
                 success, jtrans, rotMatj, insidePoints, newDistPoints = self.grow_place(
                     env,
                     ptInd,
-                    env.grid.free_points,
+                    env.grid.free_points.copy(),
                     env.grid.nbFreePoints,
                     grid_point_distances,
                     dpad,
@@ -1969,6 +2123,10 @@ class Ingredient(Agent):
 
         packing_location = None
         is_realtime = moving is not None
+        if env.batched_jitter and not is_realtime:
+            return self.batched_jitter_place(
+                env, targeted_master_grid_point, rot_mat, distance, dpad, pt_index
+            )
         level = self.collisionLevel
         for attempt_number in range(self.jitter_attempts):
             insidePoints = {}
@@ -2054,6 +2212,88 @@ class Ingredient(Agent):
                 )
         return False, packing_location, packing_rotation, {}, {}
 
+    def batched_jitter_place(
+        self,
+        env,
+        targeted_master_grid_point,
+        rot_mat,
+        distance,
+        dpad,
+        pt_index,
+    ):
+        """
+        jitter_place with all the jitter attempts drawn up front. The bounds and
+        compartment checks run on all the attempts at once, the collisions are
+        checked on the available attempts in order until one succeeds.
+        """
+        random_state = self.get_random_state(env)
+        packing_locations, packing_rotations = self.get_jitter_candidates(
+            env, targeted_master_grid_point, rot_mat
+        )
+        if not packing_locations:
+            return False, None, None, {}, {}
+        available = self.are_points_available(packing_locations)
+        level = self.collisionLevel
+        for attempt_number in numpy.nonzero(available)[0]:
+            packing_location = packing_locations[attempt_number]
+            packing_rotation = packing_rotations[attempt_number]
+            insidePoints = {}
+            newDistPoints = {}
+            collision = False
+            points_to_check = self.get_all_positions_to_check(packing_location)
+            for pt in points_to_check:
+                (
+                    collision,
+                    new_inside_points,
+                    new_dist_points,
+                ) = self.collision_jitter(
+                    pt,
+                    packing_rotation,
+                    level,
+                    env.grid.masterGridPositions,
+                    distance,
+                    env,
+                    dpad,
+                )
+                if collision:
+                    break
+                insidePoints = self.merge_place_results(
+                    new_inside_points,
+                    insidePoints,
+                )
+                newDistPoints = self.merge_place_results(
+                    new_dist_points,
+                    newDistPoints,
+                )
+            if collision or self.collides_with_compartment(
+                env, packing_location, packing_rotation
+            ):
+                continue
+
+            self.rewind_jitter_candidates(
+                env,
+                random_state,
+                targeted_master_grid_point,
+                rot_mat,
+                attempt_number + 1,
+            )
+            self.log.info(
+                "no collision at jitter attempt %d, new points %d, %d",
+                attempt_number,
+                len(insidePoints),
+                len(newDistPoints),
+            )
+            for pt in points_to_check:
+                self.store_packed_object(pt, packing_rotation, pt_index)
+            return (
+                True,
+                packing_location,
+                packing_rotation,
+                insidePoints,
+                newDistPoints,
+            )
+        return False, packing_locations[-1], packing_rotations[-1], {}, {}
+
     def lookForNeighbours(self, env, trans, rotMat, organelle):
         near_by_ingredients, placed_partners = self.get_partners(
             env, trans, rotMat, organelle
@@ -2178,6 +2418,10 @@ class Ingredient(Agent):
         # we may increase the jitter, or pick from xyz->Id free for its radius
         # create the rb only once and not at ever jitter
         # rbnode = histoVol.callFunction(self.env.addRB,(self, jtrans, rotMat,),{"rtype":self.type},)
+        if env.batched_jitter and not is_realtime:
+            return self.batched_spheres_SST_place(
+                env, ptInd, targetPoint, rotation_matrix, distance, dpad
+            )
         # jitter loop
         # level = self.collisionLevel
         for attempt_number in range(self.jitter_attempts):
@@ -2256,3 +2500,81 @@ class Ingredient(Agent):
 
         success = False
         return success, packing_location, packing_rotation, insidePoints, newDistPoints
+
+    def batched_spheres_SST_place(
+        self,
+        env,
+        ptInd,
+        target_point,
+        rotation_matrix,
+        distance,
+        dpad,
+    ):
+        """
+        spheres_SST_place with all the jitter attempts drawn up front. The
+        bounds and compartment checks run on all the attempts at once and the
+        collisions of the available attempts are checked in one call, the first
+        attempt without collision is packed.
+        """
+        random_state = self.get_random_state(env)
+        packing_locations, packing_rotations = self.get_jitter_candidates(
+            env, target_point, rotation_matrix
+        )
+        if not packing_locations:
+            return False, None, None, {}, {}
+        available = numpy.nonzero(self.are_points_available(packing_locations))[0]
+
+        # every position to check of the available attempts, with the periodic
+        # copies of the attempts close to the edges
+        positions_to_check = {}
+        attempt_numbers = []
+        positions = []
+        rotations = []
+        for attempt_number in available:
+            positions_to_check[attempt_number] = self.get_all_positions_to_check(
+                packing_locations[attempt_number]
+            )
+            for pt in positions_to_check[attempt_number]:
+                attempt_numbers.append(attempt_number)
+                positions.append(numpy.ravel(pt)[:3])
+                rotations.append(packing_rotations[attempt_number])
+        collisions = self.np_check_collisions(positions, rotations)
+        collided = set(numpy.array(attempt_numbers, dtype=int)[collisions].tolist())
+
+        for attempt_number in available:
+            if attempt_number in collided:
+                continue
+            env.totnbJitter += attempt_number + 1
+            self.rewind_jitter_candidates(
+                env, random_state, target_point, rotation_matrix, attempt_number + 1
+            )
+            self.log.info("no collision at jitter attempt %d", attempt_number)
+            packing_rotation = packing_rotations[attempt_number]
+            env.static.append(self.get_rb_model())
+            env.moving = None
+
+            insidePoints = {}
+            newDistPoints = {}
+            for pt in positions_to_check[attempt_number]:
+                new_inside_pts, new_dist_points = self.pack_at_grid_pt_location(
+                    env,
+                    pt,
+                    packing_rotation,
+                    dpad,
+                    distance,
+                    insidePoints,
+                    newDistPoints,
+                    ptInd,
+                )
+                insidePoints = self.merge_place_results(new_inside_pts, insidePoints)
+                newDistPoints = self.merge_place_results(new_dist_points, newDistPoints)
+            return (
+                True,
+                packing_locations[attempt_number],
+                packing_rotation,
+                insidePoints,
+                newDistPoints,
+            )
+
+        env.totnbJitter += len(packing_locations)
+        return False, packing_locations[-1], packing_rotations[-1], {}, {}
@@ -903,9 +903,7 @@ class GrowIngredient(MultiCylindersIngr):
         self.env.result.pop(len(self.env.result) - 1)
         # rebuild kdtree
         if len(self.env.rTrans) > 1:
-            self.env.close_ingr_bhtree = spatial.cKDTree(
-                self.env.packed_objects.get_positions(), leafsize=10
-            )
+            self.env.update_packed_objects_index()
 
         # also remove from the result ?
         self.results.pop(len(self.results) - 1)
@@ -1315,9 +1313,7 @@ class GrowIngredient(MultiCylindersIngr):
 
         # rebuild kdtree
         if len(self.env.rTrans) > 1:
-            self.env.close_ingr_bhtree = spatial.cKDTree(
-                self.env.packed_objects.get_positions(), leafsize=10
-            )
+            self.env.update_packed_objects_index()
 
         self.currentLength = 0.0
         #        self.Ptis=[ptInd,histoVol.grid.getPointFrom3D(secondPoint)]
@@ -1,6 +1,8 @@
 import numpy
 import math
 from math import pi, sqrt
+from cellpack.autopack.VoxelStamps import VoxelStamp, inside_cylinders
+
 from .Ingredient import Ingredient
 import cellpack.autopack as autopack
 
@@ -372,3 +374,50 @@ class MultiCylindersIngr(Ingredient):
                             insidePoints[pt] = d
             cylNum += 1
         return False, insidePoints, newDistPoints
+
+    def get_voxelization_radius(self):
+        radii = numpy.ravel(self.radii[-1])
+        return float(
+            max(
+                numpy.max(numpy.linalg.norm(positions, axis=1) + radii)
+                for positions in (
+                    numpy.asarray(self.positions[-1], dtype=float).reshape(-1, 3),
+                    numpy.asarray(self.positions2[-1], dtype=float).reshape(-1, 3),
+                )
+            )
+        )
+
+    def create_voxelization(
+        self,
+        image_data,
+        bounding_box,
+        voxel_size,
+        image_size,
+        position,
+        rotation=None,
+        **kwargs,
+    ):
+        """
+        Creates a voxelization for the cylinders of the deepest level, only the
+        voxels of the box around them are tested
+        """
+        if rotation is None:
+            rotation = numpy.identity(4)
+        bottoms = numpy.array(
+            self.transformPoints(position, rotation, self.positions[-1])
+        )
+        tops = numpy.array(
+            self.transformPoints(position, rotation, self.positions2[-1])
+        )
+        radii = numpy.ravel(self.radii[-1])
+        stamp = VoxelStamp.from_shape(
+            numpy.minimum(bottoms, tops).min(0) - radii.max(),
+            numpy.maximum(bottoms, tops).max(0) + radii.max(),
+            bounding_box,
+            voxel_size,
+            image_size,
+            lambda points: inside_cylinders(points, bottoms, tops, radii),
+            image_offset=kwargs.get("image_offset"),
+            window_size=image_data.shape,
+        )
+        return stamp.write(image_data, image_offset=kwargs.get("image_offset"))
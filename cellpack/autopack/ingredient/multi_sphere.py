@@ -1,6 +1,8 @@
 from math import pi
 import numpy
 
+from cellpack.autopack.VoxelStamps import VoxelStamp
+
 from .Ingredient import Ingredient
 import cellpack.autopack as autopack
 
@@ -144,107 +146,45 @@ class MultiSphereIngr(Ingredient):
         # should we also check for outside the main grid ?
         # wouldnt be faster to do sphere-sphere distance test ? than points/points from the grid
         transformed_centers = self.transformPoints(jtrans, rotMat, centers)  # centers)
-        # sphNum = 0  # which sphere in the sphere tree we're checking
-        # self.distances_temp = []
-        insidePoints = {}
-        newDistPoints = {}
         at_max_level = level == self.deepest_level and (level + 1) == len(
             self.positions
         )
-        for radius_of_ing_being_packed, posc in zip(radii, transformed_centers):
-            x, y, z = posc
-            radius_of_area_to_check = (
-                radius_of_ing_being_packed + dpad
-            )  # extends the packing ingredient's bounding box to be large enough to include masked gridpoints of the largest possible ingrdient in the receipe
-            #  TODO: add realtime render here that shows all the points being checked by the collision
-
-            pointsToCheck = env.grid.getPointsInSphere(
-                posc, radius_of_area_to_check
-            )  # indices
-            # check for collisions by looking at grid points in the sphere of radius radc
-            delta = numpy.take(gridPointsCoords, pointsToCheck, 0) - posc
-            delta *= delta
-            distA = numpy.sqrt(delta.sum(1))
-
-            for pti in range(len(pointsToCheck)):
-                grid_point_index = pointsToCheck[
-                    pti
-                ]  # index of master grid point that is inside the sphere
-                distance_to_packing_location = distA[
-                    pti
-                ]  # is that point's distance from the center of the sphere (packing location)
-                # distance is an array of distance of closest contact to anything currently in the grid
-                collision = (
-                    current_grid_distances[grid_point_index]
-                    + distance_to_packing_location
-                    <= radius_of_ing_being_packed
-                )
-
-                if collision:
-                    # an object is too close to the sphere at this level
-                    if not at_max_level:
-                        # if we haven't made it all the way down the sphere tree,
-                        # check a level down
-                        new_level = level + 1
-                        # NOTE: currently with sphere trees, no children seem present
-                        # get sphere that are children of this one
-                        # ccenters = []
-                        # cradii = []
-                        # for sphInd in self.children[level][sphNum]:
-                        #     ccenters.append(nxtLevelSpheres[sphInd])
-                        #     cradii.append(nxtLevelRadii[sphInd])
-                        return self.collision_jitter(
-                            jtrans,
-                            rotMat,
-                            new_level,
-                            gridPointsCoords,
-                            current_grid_distances,
-                            env,
-                            dpad,
-                        )
-                    else:
-                        self.log.info(
-                            "grid point already occupied %f",
-                            current_grid_distances[grid_point_index],
-                        )
-                        return True, {}, {}
-                if not at_max_level:
-                    # we don't want to calculate new distances if we are not
-                    # at the highest geo
-                    # but getting here means there was no collision detected
-                    # so the loop can continue
-                    continue
-                signed_distance_to_sphere_surface = (
-                    distance_to_packing_location - radius_of_ing_being_packed
-                )
-
-                (
-                    insidePoints,
-                    newDistPoints,
-                ) = self.get_new_distances_and_inside_points(
-                    env,
-                    jtrans,
-                    rotMat,
-                    grid_point_index,
-                    current_grid_distances,
-                    newDistPoints,
-                    insidePoints,
-                    signed_distance_to_sphere_surface,
-                )
-
-            if not at_max_level:
-                # we didn't find any colisions with the this level, but we still want
-                # the inside points to be based on the most detailed geom
-                new_level = self.deepest_level
-                return self.collision_jitter(
-                    jtrans,
-                    rotMat,
-                    new_level,
-                    gridPointsCoords,
-                    current_grid_distances,
-                    env,
-                    dpad,
-                )
+        if not len(radii):
+            return False, {}, {}
+        if not at_max_level:
+            # only the first sphere of this level is checked. On a collision check a
+            # level down, otherwise we still want the inside points to be based on
+            # the most detailed geom
+            # NOTE: currently with sphere trees, no children seem present
+            collision, _, _ = self.collide_spheres_with_grid(
+                transformed_centers[:1],
+                radii[:1],
+                env,
+                current_grid_distances,
+                dpad,
+                collision_only=True,
+            )
+            new_level = level + 1 if collision else self.deepest_level
+            return self.collision_jitter(
+                jtrans,
+                rotMat,
+                new_level,
+                gridPointsCoords,
+                current_grid_distances,
+                env,
+                dpad,
+            )
+        # the radius of the area to check is extended by dpad to be large enough to
+        # include masked grid points of the largest possible ingredient in the recipe
+        collision, inside_points, new_dist_points = self.collide_spheres_with_grid(
+            transformed_centers, radii, env, current_grid_distances, dpad
+        )
+        if collision:
+            return True, {}, {}
+        insidePoints = dict(zip(inside_points[0].tolist(), inside_points[1].tolist()))
+        newDistPoints = dict(
+            zip(new_dist_points[0].tolist(), new_dist_points[1].tolist())
+        )
         return False, insidePoints, newDistPoints
 
     def get_signed_distance(
@@ -352,3 +292,36 @@ class MultiSphereIngr(Ingredient):
             if len(wrongPt):
                 return True
         return False
+
+    def get_voxelization_radius(self):
+        level = self.deepest_level
+        positions = numpy.asarray(self.positions[level], dtype=float).reshape(-1, 3)
+        radii = numpy.ravel(self.radii[level])
+        return float(numpy.max(numpy.linalg.norm(positions, axis=1) + radii))
+
+    def create_voxelization(
+        self,
+        image_data,
+        bounding_box,
+        voxel_size,
+        image_size,
+        position,
+        rotation=None,
+        **kwargs,
+    ):
+        """
+        Creates a voxelization for the spheres of the deepest level, each
+        sphere writes the stamp of its radius
+        """
+        if rotation is None:
+            rotation = numpy.identity(4)
+        level = self.deepest_level
+        centers = self.transformPoints(position, rotation, self.positions[level])
+        for center, radius in zip(centers, self.radii[level]):
+            VoxelStamp.get_sphere_stamp(radius, voxel_size).write(
+                image_data,
+                VoxelStamp.get_voxel(center, bounding_box, voxel_size),
+                image_offset=kwargs.get("image_offset"),
+                image_size=image_size,
+            )
+        return image_data
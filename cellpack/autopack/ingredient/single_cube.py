@@ -1,5 +1,7 @@
 from math import sqrt, pi
 import numpy
+from cellpack.autopack.VoxelStamps import VoxelStamp
+
 from .Ingredient import Ingredient
 from .utils import ApplyMatrix
 import cellpack.autopack as autopack
@@ -391,3 +393,46 @@ class SingleCubeIngr(Ingredient):
         signed_distance_to_surface = self.cube_surface_distance(transformed_point[0])
 
         return signed_distance_to_surface
+
+    def get_voxelization_radius(self):
+        # the cube is centered on position + R.center
+        return self.encapsulating_radius + numpy.linalg.norm(self.center)
+
+    def create_voxelization(
+        self,
+        image_data,
+        bounding_box,
+        voxel_size,
+        image_size,
+        position,
+        rotation=None,
+        **kwargs,
+    ):
+        """
+        Creates a voxelization for the cube, only the voxels of the box around
+        its encapsulating sphere are tested
+        """
+        if rotation is None:
+            rotation = numpy.identity(4)
+        inv_rotation_matrix = numpy.linalg.inv(rotation)[:3, :3]
+        side_lengths = numpy.abs(self.edges) / 2.0
+        position = numpy.asarray(position, dtype=float)
+
+        # the cube is centered on position + R.center, as in the collision code
+        center = self.transformPoints(position, rotation, [self.center])[0]
+
+        def is_inside(points):
+            local_points = (points - center) @ inv_rotation_matrix.T
+            return numpy.all(numpy.abs(local_points) <= side_lengths, axis=1)
+
+        stamp = VoxelStamp.from_shape(
+            center - self.encapsulating_radius,
+            center + self.encapsulating_radius,
+            bounding_box,
+            voxel_size,
+            image_size,
+            is_inside,
+            image_offset=kwargs.get("image_offset"),
+            window_size=image_data.shape,
+        )
+        return stamp.write(image_data, image_offset=kwargs.get("image_offset"))
@@ -3,6 +3,8 @@ import math
 from math import pi, sqrt
 from cellpack.autopack.utils import get_distance
 
+from cellpack.autopack.VoxelStamps import VoxelStamp, inside_cylinders
+
 from .Ingredient import Ingredient
 import cellpack.autopack as autopack
 
@@ -87,6 +89,7 @@ class SingleCylinderIngr(Ingredient):
         self.name = name
         self.model_type = "Cylinders"
         self.collisionLevel = 0
+        self.radius = radius
         self.min_radius = self.radius
         self.length = get_distance(bounds[1], bounds[0])
         self.nbCurve = 2
@@ -441,3 +444,36 @@ class SingleCylinderIngr(Ingredient):
                 x_dist = dist_to_bottom * bottom_cos
                 y_dist = perp_dist - radius
                 return numpy.sqrt(x_dist**2 + y_dist**2)
+
+    def create_voxelization(
+        self,
+        image_data,
+        bounding_box,
+        voxel_size,
+        image_size,
+        position,
+        rotation=None,
+        **kwargs,
+    ):
+        """
+        Creates a voxelization for the cylinder centered on position, only the
+        voxels of the box around it are tested
+        """
+        if rotation is None:
+            rotation = numpy.identity(4)
+        bottom, top = numpy.array(
+            self.transformPoints(
+                position, rotation, [pt - self.center for pt in self.listePtLinear]
+            )
+        )
+        stamp = VoxelStamp.from_shape(
+            numpy.minimum(bottom, top) - self.radius,
+            numpy.maximum(bottom, top) + self.radius,
+            bounding_box,
+            voxel_size,
+            image_size,
+            lambda points: inside_cylinders(points, [bottom], [top], [self.radius]),
+            image_offset=kwargs.get("image_offset"),
+            window_size=image_data.shape,
+        )
+        return stamp.write(image_data, image_offset=kwargs.get("image_offset"))
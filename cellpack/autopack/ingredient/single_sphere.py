@@ -2,6 +2,8 @@ import numpy
 from math import pi
 import cellpack.autopack as autopack
 
+from cellpack.autopack.VoxelStamps import VoxelStamp
+
 from .Ingredient import Ingredient
 
 helper = autopack.helper
@@ -146,61 +148,17 @@ class SingleSphereIngr(Ingredient):
         """
         Check spheres for collision
         """
-
-        insidePoints = {}
-        newDistPoints = {}
-
-        radius_of_ing_being_packed = self.radius
-        position = jtrans
-        radius_of_area_to_check = (
-            radius_of_ing_being_packed + dpad
-        )  # extends the packing ingredient's bounding box to be large enough to include masked gridpoints of the largest possible ingrdient in the receipe
-        #  TODO: add realtime render here that shows all the points being checked by the collision
-
-        pointsToCheck = env.grid.getPointsInSphere(
-            position, radius_of_area_to_check
-        )  # indices
-        # check for collisions by looking at grid points in the sphere of radius radc
-        distance_to_grid_points = numpy.linalg.norm(
-            gridPointsCoords[pointsToCheck] - position, axis=1
+        # the radius of the area to check is extended by dpad to be large enough to
+        # include masked grid points of the largest possible ingredient in the recipe
+        collision, inside_points, new_dist_points = self.collide_spheres_with_grid(
+            [jtrans], [self.radius], env, current_grid_distances, dpad
+        )
+        if collision:
+            return True, {}, {}
+        insidePoints = dict(zip(inside_points[0].tolist(), inside_points[1].tolist()))
+        newDistPoints = dict(
+            zip(new_dist_points[0].tolist(), new_dist_points[1].tolist())
         )
-
-        for pti, grid_point_index in enumerate(pointsToCheck):
-            distance_to_packing_location = distance_to_grid_points[
-                pti
-            ]  # is that point's distance from the center of the sphere (packing location)
-            # distance is an array of distance of closest contact to anything currently in the grid
-
-            collision = (
-                current_grid_distances[grid_point_index] + distance_to_packing_location
-                <= radius_of_ing_being_packed
-            )
-
-            if collision:
-                # an object is too close to the sphere at this level
-                self.log.info(
-                    "grid point already occupied %f",
-                    current_grid_distances[grid_point_index],
-                )
-                return True, {}, {}
-
-            signed_distance_to_sphere_surface = (
-                distance_to_packing_location - radius_of_ing_being_packed
-            )
-
-            (
-                insidePoints,
-                newDistPoints,
-            ) = self.get_new_distances_and_inside_points(
-                env,
-                jtrans,
-                rotMat,
-                grid_point_index,
-                current_grid_distances,
-                newDistPoints,
-                insidePoints,
-                signed_distance_to_sphere_surface,
-            )
         return False, insidePoints, newDistPoints
 
     def collides_with_compartment(
@@ -280,16 +238,13 @@ class SingleSphereIngr(Ingredient):
         **kwargs,
     ):
         """
-        Creates a voxelization for the sphere
+        Creates a voxelization for the sphere, the stamp of its radius is only
+        written around its position
         """
-        relative_position = position - bounding_box[0]
-        voxelized_position = (relative_position / voxel_size).astype(int)
-        mask = self.create_circular_mask(
-            *image_size,
-            center=voxelized_position,
-            radius=self.radius,
-            voxel_size=voxel_size,
+        stamp = VoxelStamp.get_sphere_stamp(self.radius, voxel_size)
+        return stamp.write(
+            image_data,
+            VoxelStamp.get_voxel(position, bounding_box, voxel_size),
+            image_offset=kwargs.get("image_offset"),
+            image_size=image_size,
         )
-        image_data[mask] = 255
-
-        return image_data
@@ -1,4 +1,5 @@
 import numpy
+from scipy import spatial
 
 
 class PackedObject:
@@ -22,57 +23,278 @@ class PackedObject:
         self.ingredient = ingredient
 
 
+def _read_only(array):
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+class LevelSpheres:
+    """
+    World space spheres of one sphere tree level of the placed ingredients, in
+    growable arrays. The spheres of the ingredient in row i of the packed
+    objects are the rows offsets[i]:offsets[i + 1], next to their owner row.
+    """
+
+    # number of sphere pairs compared at once
+    max_pairs = 1 << 20
+
+    def __init__(self, capacity=1024):
+        self.positions = numpy.zeros((capacity, 3))
+        self.radii = numpy.zeros(capacity)
+        self.owners = numpy.zeros(capacity, dtype=int)
+        self.offsets = numpy.zeros(257, dtype=int)
+        self.nb_objects = 0
+
+    def __len__(self):
+        return int(self.offsets[self.nb_objects])
+
+    def add(self, positions, radii):
+        positions = numpy.asarray(positions, dtype=float).reshape(-1, 3)
+        start = len(self)
+        end = start + len(positions)
+        if end > len(self.positions):
+            capacity = max(end, 2 * len(self.positions))
+            self.positions = numpy.resize(self.positions, (capacity, 3))
+            self.radii = numpy.resize(self.radii, capacity)
+            self.owners = numpy.resize(self.owners, capacity)
+        if self.nb_objects + 1 == len(self.offsets):
+            self.offsets = numpy.resize(self.offsets, 2 * len(self.offsets))
+        self.positions[start:end] = positions
+        self.radii[start:end] = numpy.ravel(radii)
+        self.owners[start:end] = self.nb_objects
+        self.nb_objects += 1
+        self.offsets[self.nb_objects] = end
+
+    def get_spheres(self, rows):
+        """
+        Returns the positions, radii and owners of the spheres of the given
+        object rows
+        """
+        rows = numpy.asarray(rows, dtype=int)
+        starts = self.offsets[rows]
+        counts = self.offsets[rows + 1] - starts
+        # start of each sphere's object repeated, plus its rank in the object
+        indices = numpy.repeat(starts - numpy.cumsum(counts) + counts, counts)
+        indices += numpy.arange(len(indices))
+        return self.positions[indices], self.radii[indices], self.owners[indices]
+
+    def overlaps(self, rows, positions, radii):
+        """
+        Returns True if any of the spheres of positions and radii overlaps a
+        sphere of the given object rows
+        """
+        positions = numpy.asarray(positions, dtype=float).reshape(-1, 3)
+        radii = numpy.ravel(numpy.asarray(radii, dtype=float))
+        packed_positions, packed_radii, _ = self.get_spheres(rows)
+        if not len(packed_positions) or not len(positions):
+            return False
+        # only the packed spheres closer to their nearest sphere than the sum of
+        # their radius and the largest radius can overlap
+        max_radius = radii.max()
+        nearest, _ = spatial.cKDTree(positions).query(
+            packed_positions, distance_upper_bound=packed_radii.max() + max_radius
+        )
+        close = nearest <= packed_radii + max_radius
+        packed_positions = packed_positions[close]
+        packed_radii = packed_radii[close]
+        chunk_size = max(self.max_pairs // len(positions), 1)
+        for start in range(0, len(packed_positions), chunk_size):
+            delta = (
+                packed_positions[start : start + chunk_size, None, :]
+                - positions[None, :, :]
+            )
+            distances = numpy.sqrt((delta * delta).sum(2))
+            sum_radii = radii[None, :] + packed_radii[start : start + chunk_size, None]
+            if numpy.any(distances - sum_radii < 0.0):
+                return True
+        return False
+
+    def overlaps_queries(self, query_indices, rows, positions, radii):
+        """
+        Batched overlaps: positions holds the spheres of several queries, one
+        (number of spheres, 3) block per query, all with the given radii. Each
+        query is checked against the object rows paired with it in query_indices
+        and rows. Returns one boolean per query.
+        """
+        positions = numpy.asarray(positions, dtype=float).reshape(len(positions), -1, 3)
+        radii = numpy.ravel(numpy.asarray(radii, dtype=float))
+        result = numpy.zeros(len(positions), dtype=bool)
+        rows = numpy.asarray(rows, dtype=int)
+        if not len(rows) or not positions.shape[1]:
+            return result
+        # the spheres of every object row, next to the query it is paired with
+        packed_positions, packed_radii, _ = self.get_spheres(rows)
+        counts = self.offsets[rows + 1] - self.offsets[rows]
+        packed_queries = numpy.repeat(query_indices, counts)
+        # only the packed spheres closer to the center of the query spheres than
+        # their radius and the extent of the query can overlap
+        centers = positions.mean(1)
+        extents = (
+            numpy.linalg.norm(positions - centers[:, None, :], axis=2).max(1)
+            + radii.max()
+        )
+        close = numpy.linalg.norm(
+            packed_positions - centers[packed_queries], axis=1
+        ) <= (packed_radii + extents[packed_queries])
+        packed_positions = packed_positions[close]
+        packed_radii = packed_radii[close]
+        packed_queries = packed_queries[close]
+        chunk_size = max(self.max_pairs // positions.shape[1], 1)
+        for start in range(0, len(packed_positions), chunk_size):
+            end = start + chunk_size
+            delta = (
+                packed_positions[start:end, None, :]
+                - positions[packed_queries[start:end]]
+            )
+            distances = numpy.sqrt((delta * delta).sum(2))
+            sum_radii = radii[None, :] + packed_radii[start:end, None]
+            overlapping = numpy.any(distances - sum_radii < 0.0, axis=1)
+            result[packed_queries[start:end][overlapping]] = True
+        return result
+
+
 class PackedObjects:
-    def __init__(self):
+    """
+    Packed objects in the order they were added. The placed ingredients are also
+    stored column by column in growable arrays (positions, rotations, radii,
+    encapsulating radii, ingredient id and grid point index) so the getters return
+    read-only views instead of filtering the whole list on every call.
+    Compartments are only kept in the object list.
+    """
+
+    def __init__(self, capacity=256):
         self._packed_objects = []
+        self._ingredients = []
+        self._compartments = []
+        self._positions = numpy.zeros((capacity, 3))
+        self._rotations = numpy.zeros((capacity, 4, 4))
+        self._radii = numpy.zeros(capacity)
+        self._encapsulating_radii = numpy.zeros(capacity)
+        self._ingredient_ids = numpy.zeros(capacity, dtype=int)
+        self._pt_indices = numpy.zeros(capacity, dtype=int)
+        # ingredient name -> ingredient id, and rows of each ingredient id
+        self._ingredient_id_by_name = {}
+        self._rows_by_ingredient_id = []
+        # sphere tree level -> LevelSpheres
+        self._level_spheres = {}
+
+    def __len__(self):
+        return len(self._packed_objects)
+
+    def _grow(self):
+        capacity = 2 * len(self._positions)
+        self._positions = numpy.resize(self._positions, (capacity, 3))
+        self._rotations = numpy.resize(self._rotations, (capacity, 4, 4))
+        self._radii = numpy.resize(self._radii, capacity)
+        self._encapsulating_radii = numpy.resize(self._encapsulating_radii, capacity)
+        self._ingredient_ids = numpy.resize(self._ingredient_ids, capacity)
+        self._pt_indices = numpy.resize(self._pt_indices, capacity)
 
     def add(self, new_object: PackedObject):
         self._packed_objects.append(new_object)
+        if new_object.is_compartment:
+            self._compartments.append(new_object)
+            return
+        row = len(self._ingredients)
+        if row == len(self._positions):
+            self._grow()
+        self._ingredients.append(new_object)
+        self._positions[row] = numpy.ravel(new_object.position)[:3]
+        self._rotations[row] = numpy.identity(4)
+        if new_object.rotation is not None:
+            rotation = numpy.asarray(new_object.rotation, dtype=float)
+            size = min(rotation.shape[0], 4)
+            self._rotations[row, :size, :size] = rotation[:size, :size]
+        radius = new_object.radius
+        self._radii[row] = numpy.nan if radius is None else radius
+        self._encapsulating_radii[row] = new_object.encapsulating_radius
+        self._pt_indices[row] = (
+            -1 if new_object.pt_index is None else new_object.pt_index
+        )
+        ingredient_id = self.get_ingredient_id(new_object.name, add=True)
+        self._ingredient_ids[row] = ingredient_id
+        self._rows_by_ingredient_id[ingredient_id].append(row)
+
+    def get_ingredient_id(self, ingredient_name, add=False):
+        if ingredient_name not in self._ingredient_id_by_name:
+            if not add:
+                return None
+            self._ingredient_id_by_name[ingredient_name] = len(
+                self._rows_by_ingredient_id
+            )
+            self._rows_by_ingredient_id.append([])
+        return self._ingredient_id_by_name[ingredient_name]
+
+    def get_rows_for_ingredient(self, ingredient_name):
+        """rows of the placed ingredients with this name in the column arrays"""
+        ingredient_id = self.get_ingredient_id(ingredient_name)
+        if ingredient_id is None:
+            return numpy.array([], dtype=int)
+        return numpy.array(self._rows_by_ingredient_id[ingredient_id], dtype=int)
 
     def get_radii(self):
-        radii = []
-        for obj in self._packed_objects:
-            if not obj.is_compartment:
-                radii.append(obj.radius)
-        return radii
+        return _read_only(self._radii[: len(self._ingredients)])
 
     def get_encapsulating_radii(self):
-        radii = []
-        for obj in self._packed_objects:
-            if not obj.is_compartment:
-                radii.append(obj.encapsulating_radius)
-        return radii
+        return _read_only(self._encapsulating_radii[: len(self._ingredients)])
 
     def get_positions(self):
-        positions = []
-        for obj in self._packed_objects:
-            if not obj.is_compartment:
-                positions.append(obj.position)
-        return positions
+        return _read_only(self._positions[: len(self._ingredients)])
+
+    def get_rotations(self):
+        return _read_only(self._rotations[: len(self._ingredients)])
+
+    def get_ingredient_ids(self):
+        return _read_only(self._ingredient_ids[: len(self._ingredients)])
+
+    def get_pt_indices(self):
+        return _read_only(self._pt_indices[: len(self._ingredients)])
 
     def get_positions_for_ingredient(self, ingredient_name):
-        return numpy.array(
-            [
-                self._packed_objects[i].position
-                for i in range(len(self._packed_objects))
-                if self._packed_objects[i].name == ingredient_name
-            ]
-        )
+        return self._positions[self.get_rows_for_ingredient(ingredient_name)]
 
     def get_rotations_for_ingredient(self, ingredient_name):
-        return numpy.array(
-            [
-                self._packed_objects[i].rotation
-                for i in range(len(self._packed_objects))
-                if self._packed_objects[i].name == ingredient_name
-            ]
-        )
+        return self._rotations[self.get_rows_for_ingredient(ingredient_name)]
+
+    def get_level_spheres(self, level):
+        """
+        World space spheres of the sphere tree level of the placed ingredients.
+        The spheres of each ingredient are transformed once, the ingredients
+        placed since the last call are added first. The ingredients with a
+        shallower tree add their deepest level, and the ingredients without a
+        tree their encapsulating sphere.
+        """
+        level_spheres = self._level_spheres.get(level)
+        if level_spheres is None:
+            level_spheres = self._level_spheres[level] = LevelSpheres()
+        for row in range(level_spheres.nb_objects, len(self._ingredients)):
+            packed_object = self._ingredients[row]
+            ingredient = packed_object.ingredient
+            positions = getattr(ingredient, "positions", None)
+            if positions is None or not len(positions):
+                level_spheres.add(
+                    [numpy.ravel(packed_object.position)[:3]],
+                    [packed_object.encapsulating_radius],
+                )
+                continue
+            object_level = min(level, len(positions) - 1)
+            level_spheres.add(
+                ingredient.transformPoints(
+                    packed_object.position,
+                    packed_object.rotation,
+                    positions[object_level],
+                ),
+                ingredient.radii[object_level],
+            )
+        return level_spheres
 
     def get_ingredients(self):
-        return [obj for obj in self._packed_objects if obj.is_compartment is False]
+        # the returned list is shared, it should not be modified
+        return self._ingredients
 
     def get_compartment(self):
-        return [obj for obj in self._packed_objects if obj.is_compartment is True]
+        return self._compartments
 
     def get_all(self):
         return self._packed_objects
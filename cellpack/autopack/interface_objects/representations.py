@@ -1,8 +1,9 @@
 from math import sqrt
-import cellpack.autopack as autopack
 import numpy as np
 import sys
 
+from cellpack.autopack.loaders.sphere_tree_loader import SphereTreeLoader
+
 
 class Representations:
     DATABASE = "https://raw.githubusercontent.com/mesoscope/cellPACK_data/master/cellPACK_database_1.1.0"
@@ -29,45 +30,10 @@ class Representations:
     @staticmethod
     def _read_sphere_file(file):
         """
-        get spherical approximation of shape
+        get spherical approximation of shape, as the arrays of the centers and
+        the radii of each level, see SphereTreeLoader
         """
-        # file format is space separated
-        # float:Rmin float:Rmax
-        # int:number of levels
-        # int: number of spheres in first level
-        # x y z r i j k ...# first sphere in first level and 0-based indices
-        # of spheres in next level covererd by this sphere
-        # ...
-        # int: number of spheres in second level
-
-        sphere_data = autopack.read_text_file(file)
-        # strip comments
-        data = [x for x in sphere_data if x[0] != "#" and len(x) > 1 and x[0] != "\r"]
-        rmin, rmax = list(map(float, data[0].split()))
-        nblevels = int(data[1])
-        radii = []
-        centers = []
-        children = []
-        line = 2
-        for level in range(nblevels):
-            rl = []
-            cl = []
-            ch = []
-            nbs = int(data[line])
-            line += 1
-            for n in range(nbs):
-                w = data[line].split()
-                x, y, z, r = list(map(float, w[:4]))
-                if level < nblevels - 1:  # get sub spheres indices
-                    ch.append(list(map(int, w[4:])))
-                cl.append((x, y, z))
-                rl.append(r)
-                line += 1
-            centers.append(cl)
-            radii.append(rl)
-            children.append(ch)
-        # we ignore the hierarchy for now
-        return centers, radii
+        return SphereTreeLoader.load(file)
 
     def _get_spheres(self):
         if "path" in self.packing:
@@ -172,5 +138,6 @@ class Representations:
         delta = np.array(positions[0])
         r_max = sqrt(max(np.sum(delta * delta, 1)))
         r_max = max(r_max, r_max_level_zero)
-        r_min = min(min(radii))
+        # compares the levels as lists, like when the radii were nested lists
+        r_min = min(min([list(level) for level in radii]))
         return r_min, r_max
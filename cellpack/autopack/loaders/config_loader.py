@@ -25,8 +25,13 @@ class Inner_Grid_Methods(MetaEnum):
 
 class ConfigLoader(object):
     default_values = {
+        "batched_jitter": False,
         "clean_grid_cache": False,
+        "compact_grid_state": False,
         "format": "simularium",
+        "grid_cache_dir": None,
+        "grid_cache_max_size_mb": 2048,
+        "implicit_lattice": False,
         "load_from_grid_file": True,
         "inner_grid_method": "trimesh",
         "live_packing": False,
@@ -0,0 +1,121 @@
+import hashlib
+import logging
+import os
+from pathlib import Path
+
+import numpy
+
+import cellpack.autopack as autopack
+
+log = logging.getLogger(__name__)
+
+
+class SphereTreeLoader:
+    """
+    Reads sphere tree files (.sph) into one array of centers and one array of
+    radii per level. The trees are memoized by file path, modification time
+    and size, so the ingredients and the seeds that use the same file parse it
+    once, and a binary .npz copy is written to the collisionTrees cache that
+    the next runs load instead of the text file.
+
+    The file format is space separated:
+        float:Rmin float:Rmax
+        int:number of levels
+        int:number of spheres in the first level
+        x y z r i j k ... for each sphere, followed by the 0-based indices of
+        the spheres of the next level it covers
+        int:number of spheres in the second level
+        ...
+    Lines starting with # are comments. The hierarchy is ignored.
+    """
+
+    # bump when the content of the .npz files changes
+    version = 1
+    trees = {}
+
+    @staticmethod
+    def parse(lines):
+        # strip comments
+        data = [x for x in lines if x[0] != "#" and len(x) > 1 and x[0] != "\r"]
+        nb_levels = int(data[1])
+        centers = []
+        radii = []
+        line = 2
+        for _ in range(nb_levels):
+            nb_spheres = int(data[line])
+            line += 1
+            spheres = numpy.zeros((0, 4))
+            if nb_spheres:
+                spheres = numpy.loadtxt(
+                    data[line : line + nb_spheres], usecols=(0, 1, 2, 3), ndmin=2
+                )
+            centers.append(numpy.ascontiguousarray(spheres[:, :3]))
+            radii.append(numpy.ascontiguousarray(spheres[:, 3]))
+            line += nb_spheres
+        return centers, radii
+
+    @staticmethod
+    def get_cache_path(path, stat):
+        key = f"{SphereTreeLoader.version}:{path}:{stat.st_mtime_ns}:{stat.st_size}"
+        digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+        return Path(autopack.CACHE_DIR["collisionTrees"]) / f"{path.stem}_{digest}.npz"
+
+    @staticmethod
+    def read_cache_file(cache_path):
+        with numpy.load(cache_path, allow_pickle=False) as data:
+            nb_levels = int(data["nb_levels"])
+            return (
+                [data[f"centers_{level}"] for level in range(nb_levels)],
+                [data[f"radii_{level}"] for level in range(nb_levels)],
+            )
+
+    @staticmethod
+    def write_cache_file(cache_path, centers, radii):
+        arrays = {"nb_levels": numpy.array(len(centers))}
+        for level, (level_centers, level_radii) in enumerate(zip(centers, radii)):
+            arrays[f"centers_{level}"] = level_centers
+            arrays[f"radii_{level}"] = level_radii
+        # written under a temporary name, another process never reads it half
+        # written
+        temporary_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        try:
+            with open(temporary_path, "wb") as f:
+                numpy.savez(f, **arrays)
+            os.replace(temporary_path, cache_path)
+        except OSError as error:
+            log.warning(f"Could not write sphere tree cache {cache_path}: {error}")
+            if temporary_path.exists():
+                temporary_path.unlink()
+
+    @staticmethod
+    def load(file, use_cache_file=True):
+        """
+        Returns the centers and the radii of the spheres of each level of the
+        sphere tree file, as read-only arrays shared by all the callers
+        """
+        path = Path(autopack.get_text_file_location(file)).resolve()
+        stat = path.stat()
+        key = (str(path), stat.st_mtime_ns, stat.st_size)
+        tree = SphereTreeLoader.trees.get(key)
+        if tree is not None:
+            return tuple(list(arrays) for arrays in tree)
+
+        cache_path = SphereTreeLoader.get_cache_path(path, stat)
+        tree = None
+        if use_cache_file and cache_path.is_file():
+            try:
+                tree = SphereTreeLoader.read_cache_file(cache_path)
+            except (OSError, ValueError, KeyError) as error:
+                log.warning(f"Ignoring sphere tree cache {cache_path}: {error}")
+        if tree is None:
+            log.debug(f"Parsing sphere tree {path}")
+            with open(path) as f:
+                tree = SphereTreeLoader.parse(f.readlines())
+            if use_cache_file:
+                SphereTreeLoader.write_cache_file(cache_path, *tree)
+
+        for arrays in tree:
+            for array in arrays:
+                array.flags.writeable = False
+        SphereTreeLoader.trees[key] = tree
+        return tuple(list(arrays) for arrays in tree)
@@ -2,6 +2,7 @@ import collections
 import copy
 
 import numpy
+from scipy import spatial
 
 
 def get_distance(pt1, pt2):
@@ -12,6 +13,159 @@ def get_distances_from_point(np_array_of_pts, pt):
     return numpy.linalg.norm(np_array_of_pts - pt, axis=1)
 
 
+def map_positions(function, positions, chunk_size=1000000):
+    """
+    Applies function to the positions chunk_size rows at a time and
+    concatenates the results, so the grid positions that are computed from the
+    lattice are never all in memory at once. Arrays are passed as they are.
+    """
+    if isinstance(positions, numpy.ndarray) or len(positions) <= chunk_size:
+        return function(positions[:])
+    return numpy.concatenate(
+        [
+            function(positions[start : start + chunk_size])
+            for start in range(0, len(positions), chunk_size)
+        ]
+    )
+
+
+def get_binned_distances(
+    positions, bin_edges, other_positions=None, volume=None, dimensions=3
+):
+    """
+    Histogram of the distances between the positions, or from the positions to
+    other_positions, with the statistics of the nearest neighbour distances.
+    The pairs are counted with KD-trees up to the last bin edge, the distances
+    of all the pairs are never computed. Bin i counts the distances in
+    (bin_edges[i], bin_edges[i + 1]], the first bin also counts distances of 0.
+    volume is the volume (or area in 2D) the positions are packed in, used to
+    normalize the radial distribution function.
+    """
+    bin_edges = numpy.asarray(bin_edges, dtype=float)
+    positions = numpy.asarray(positions, dtype=float).reshape(-1, 3)
+    same_positions = other_positions is None
+    if same_positions:
+        other_positions = positions
+        number_of_pairs = len(positions) * (len(positions) - 1) // 2
+    else:
+        other_positions = numpy.asarray(other_positions, dtype=float).reshape(-1, 3)
+        number_of_pairs = len(positions) * len(other_positions)
+
+    counts = numpy.zeros(len(bin_edges) - 1, dtype=int)
+    nearest_distances = numpy.array([])
+    if number_of_pairs:
+        tree = spatial.cKDTree(positions)
+        other_tree = tree if same_positions else spatial.cKDTree(other_positions)
+        cumulative_counts = tree.count_neighbors(other_tree, bin_edges)
+        if same_positions:
+            # without the pairs of a position with itself, each pair once
+            cumulative_counts = (cumulative_counts - len(positions)) // 2
+            nearest_distances = tree.query(positions, k=2)[0][:, 1]
+        else:
+            nearest_distances = other_tree.query(positions, k=1)[0]
+        counts = numpy.diff(cumulative_counts)
+        counts[0] += cumulative_counts[0]
+
+    return {
+        "bin_edges": bin_edges.tolist(),
+        "counts": counts.tolist(),
+        "number_of_pairs": int(number_of_pairs),
+        "volume": volume,
+        "dimensions": dimensions,
+        "nearest_neighbor": {
+            "count": len(nearest_distances),
+            "sum": float(nearest_distances.sum()),
+            "sum_of_squares": float((nearest_distances**2).sum()),
+            "min": float(nearest_distances.min()) if len(nearest_distances) else None,
+            "max": float(nearest_distances.max()) if len(nearest_distances) else None,
+        },
+    }
+
+
+def is_binned_distances(distances):
+    return isinstance(distances, dict)
+
+
+def combine_binned_distances(binned_distances_list):
+    """
+    Sums the histograms of get_binned_distances, they must share their bins
+    """
+    combined = None
+    for binned_distances in binned_distances_list:
+        if combined is None:
+            combined = copy.deepcopy(binned_distances)
+            continue
+        if binned_distances["bin_edges"] != combined["bin_edges"]:
+            raise ValueError("Binned distances with different bins can't be combined")
+        combined["counts"] = numpy.add(
+            combined["counts"], binned_distances["counts"]
+        ).tolist()
+        combined["number_of_pairs"] += binned_distances["number_of_pairs"]
+        nearest = combined["nearest_neighbor"]
+        other_nearest = binned_distances["nearest_neighbor"]
+        for key in ["count", "sum", "sum_of_squares"]:
+            nearest[key] += other_nearest[key]
+        for key, function in [("min", min), ("max", max)]:
+            values = [
+                value
+                for value in (nearest[key], other_nearest[key])
+                if value is not None
+            ]
+            nearest[key] = function(values) if values else None
+    return combined
+
+
+def get_nearest_neighbor_statistics(binned_distances):
+    """
+    Returns the number, mean, standard deviation, minimum and maximum of the
+    nearest neighbour distances of binned distances
+    """
+    nearest = binned_distances["nearest_neighbor"]
+    count = nearest["count"]
+    if not count:
+        return {"count": 0, "mean": None, "std": None, "min": None, "max": None}
+    mean = nearest["sum"] / count
+    variance = max(nearest["sum_of_squares"] / count - mean**2, 0.0)
+    return {
+        "count": count,
+        "mean": mean,
+        "std": numpy.sqrt(variance),
+        "min": nearest["min"],
+        "max": nearest["max"],
+    }
+
+
+def get_radial_distribution(binned_distances):
+    """
+    Returns the bin centers and the radial distribution function g(r) of binned
+    distances: the pairs of each bin over the pairs of uniformly distributed
+    positions in the same volume, without correction for the volume edges
+    """
+    bin_edges = numpy.array(binned_distances["bin_edges"])
+    bin_centers = 0.5 * (bin_edges[1:] + bin_edges[:-1])
+    volume = binned_distances["volume"]
+    if not volume or not binned_distances["number_of_pairs"]:
+        return bin_centers, numpy.zeros(len(bin_centers))
+    if binned_distances["dimensions"] == 2:
+        shell_volumes = numpy.pi * numpy.diff(bin_edges**2)
+    else:
+        shell_volumes = 4.0 / 3.0 * numpy.pi * numpy.diff(bin_edges**3)
+    expected_counts = binned_distances["number_of_pairs"] * shell_volumes / volume
+    return bin_centers, numpy.array(binned_distances["counts"]) / expected_counts
+
+
+def get_binned_count_below(binned_distances, distance):
+    """
+    Number of distances below distance, interpolated in its bin
+    """
+    cumulative_counts = numpy.concatenate(
+        [[0], numpy.cumsum(binned_distances["counts"])]
+    )
+    return float(
+        numpy.interp(distance, binned_distances["bin_edges"], cumulative_counts)
+    )
+
+
 def ingredient_compare1(x, y):
     """
     sort ingredients using decreasing priority and decreasing radii for
@@ -1,9 +1,15 @@
+import concurrent.futures
+import itertools
 import logging
 from pathlib import Path
 
 import numpy
+import tifffile
 from bioio_ome_tiff.writers import OmeTiffWriter
-from scipy.ndimage import convolve
+from bioio_ome_tiff.writers.ome_tiff_writer import BIGTIFF_BYTE_LIMIT
+from ome_types import to_xml
+from scipy.ndimage import convolve, convolve1d
+from scipy.signal import fftconvolve
 
 log = logging.getLogger(__name__)
 
@@ -22,6 +28,8 @@ class ImageWriter:
         hollow=False,
         convolution_options=None,
         projection_axis="z",
+        chunk_size=None,
+        image_format="ome.tiff",
     ):
         self.env = env
 
@@ -58,6 +66,13 @@ class ImageWriter:
 
         self.projection_axis = projection_axis
 
+        # voxels per tile along each axis for the chunked export, None exports
+        # the whole image at once
+        if chunk_size is not None:
+            chunk_size = numpy.broadcast_to(chunk_size, 3).astype(int)
+        self.chunk_size = chunk_size
+        self.image_format = image_format
+
     @staticmethod
     def create_gaussian_psf(sigma=1.5, size=None):
         """
@@ -111,8 +126,43 @@ class ImageWriter:
 
         return psf
 
+    # psfs of at most this many voxels are convolved directly by auto
+    direct_convolution_max_size = 27
+
+    @staticmethod
+    def get_separable_psf(psf):
+        """
+        Returns the 1-D kernels along each axis whose outer product is the psf,
+        or None if the psf is not separable. The gaussian and box psfs are.
+        """
+        psf = numpy.asarray(psf, dtype=float)
+        total = psf.sum()
+        if psf.ndim != 3 or total <= 0:
+            return None
+        kernels = [
+            psf.sum(axis=tuple(other for other in range(3) if other != axis)) / total
+            for axis in range(3)
+        ]
+        separable_psf = total * numpy.einsum("i,j,k->ijk", *kernels)
+        if not numpy.allclose(separable_psf, psf, rtol=1e-5, atol=1e-8 * psf.max()):
+            return None
+        return kernels
+
+    @staticmethod
+    def choose_convolution_backend(psf, allow_fft=True):
+        """
+        Direct convolution for the small psfs, separable 1-D passes for the
+        separable psfs and fft convolution for the others, or direct
+        convolution without allow_fft
+        """
+        if numpy.size(psf) <= ImageWriter.direct_convolution_max_size:
+            return "direct"
+        if ImageWriter.get_separable_psf(psf) is not None:
+            return "separable"
+        return "fft" if allow_fft else "direct"
+
     @staticmethod
-    def convolve_channel(channel, psf):
+    def convolve_channel(channel, psf, backend="direct"):
         """
         Convolves a channel with a psf
 
@@ -122,6 +172,9 @@ class ImageWriter:
             channel to be convolved
         psf: numpy.ndarray
             psf
+        backend: str
+            direct, separable or fft. The separable and fft convolutions are
+            the direct one up to float rounding
 
         Returns
         ----------
@@ -129,28 +182,52 @@ class ImageWriter:
             convolved channel
         """
         scaled_channel = channel.astype(numpy.float32) / 255.0
-        conv_channel = convolve(scaled_channel, psf, mode="constant", cval=0.0)
+        if backend == "direct":
+            conv_channel = convolve(scaled_channel, psf, mode="constant", cval=0.0)
+        elif backend == "separable":
+            kernels = ImageWriter.get_separable_psf(psf)
+            if kernels is None:
+                raise ValueError("The psf is not separable")
+            conv_channel = scaled_channel
+            for axis, kernel in enumerate(kernels):
+                conv_channel = convolve1d(
+                    conv_channel, kernel, axis=axis, mode="constant", cval=0.0
+                )
+        elif backend == "fft":
+            # the full convolution shifted by the psf center, as convolve places it
+            full_channel = fftconvolve(
+                scaled_channel, numpy.asarray(psf, dtype=numpy.float32), mode="full"
+            )
+            center = numpy.array(numpy.shape(psf)) // 2
+            conv_channel = full_channel[
+                tuple(slice(center[i], center[i] + channel.shape[i]) for i in range(3))
+            ]
+        else:
+            raise NotImplementedError(f"Convolution backend {backend} not implemented")
         conv_channel = (conv_channel * 255).astype(numpy.uint8)
         return conv_channel
 
+    # axes of the (channel, x, y, z) image in the ZCYX order of the exported
+    # image for each projection axis
+    projection_axes = {
+        "x": (1, 0, 3, 2),
+        "y": (2, 0, 3, 1),
+        "z": (3, 0, 2, 1),
+    }
+
     @staticmethod
     def transpose_image_for_projection(image, projection_axis):
-        if projection_axis == "x":
-            image = numpy.transpose(image, axes=(1, 0, 3, 2))
-        elif projection_axis == "y":
-            image = numpy.transpose(image, axes=(2, 0, 3, 1))
-        elif projection_axis == "z":
-            image = numpy.transpose(image, axes=(3, 0, 2, 1))
+        axes = ImageWriter.projection_axes.get(projection_axis)
+        if axes is not None:
+            image = numpy.transpose(image, axes=axes)
         return image
 
-    def convolve_image(self, image, psf="gaussian", psf_parameters=None):
+    def create_psf(self, psf="gaussian", psf_parameters=None):
         """
-        Convolves the image with a psf
+        Creates the psf from the convolution options
 
         Parameters
         ----------
-        image: numpy.ndarray
-            image to be convolved
         psf: str or numpy.ndarray
             psf type
         psf_parameters: dict
@@ -159,7 +236,7 @@ class ImageWriter:
         Returns
         ----------
         numpy.ndarray
-            convolved image
+            psf
         """
         # TODO: add checking for psf_parameters
         if psf_parameters is None:
@@ -174,10 +251,59 @@ class ImageWriter:
                 psf = self.create_box_psf(psf_parameters.get("size", None))
             else:
                 raise NotImplementedError(f"PSF type {psf} not implemented")
+        return psf
+
+    def convolve_image(
+        self,
+        image,
+        psf="gaussian",
+        psf_parameters=None,
+        backend="auto",
+        max_workers=None,
+        executor=None,
+    ):
+        """
+        Convolves the image with a psf, the channels are convolved in parallel
+
+        Parameters
+        ----------
+        image: numpy.ndarray
+            image to be convolved
+        psf: str or numpy.ndarray
+            psf type
+        psf_parameters: dict
+            psf parameters
+        backend: str
+            direct, separable, fft or auto to choose by the size of the psf
+        max_workers: int
+            number of threads convolving channels, defaults to the
+            ThreadPoolExecutor default
+        executor: concurrent.futures.Executor
+            executor convolving the channels instead of a new thread pool
+
+        Returns
+        ----------
+        numpy.ndarray
+            convolved image
+        """
+        psf = self.create_psf(psf, psf_parameters)
+        if backend == "auto":
+            backend = self.choose_convolution_backend(psf)
+
+        if executor is None:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers
+            ) as executor:
+                return self.convolve_image(
+                    image, psf, backend=backend, executor=executor
+                )
 
         conv_img = numpy.zeros(image.shape, dtype=image.dtype)
-        for channel in range(image.shape[0]):
-            conv_img[channel] = self.convolve_channel(image[channel], psf)
+        conv_channels = executor.map(
+            lambda channel: self.convolve_channel(channel, psf, backend), image
+        )
+        for channel, conv_channel in enumerate(conv_channels):
+            conv_img[channel] = conv_channel
         return conv_img
 
     def concatenate_image_data(self):
@@ -227,3 +353,172 @@ class ImageWriter:
                 channel_names=channel_names,
                 channel_colors=channel_colors,
             )
+
+    def get_export_path(self):
+        return self.output_path / f"voxelized_image_{self.name}.{self.image_format}"
+
+    def create_tiff_store(self, shape, channel_names, channel_colors):
+        """
+        Creates an uncompressed OME-TIFF file with the metadata of export_image
+        and returns it memory mapped, the tiles written to it are flushed to
+        the file instead of being kept in memory
+        """
+        ome = OmeTiffWriter.build_ome(
+            [shape],
+            [numpy.dtype(numpy.uint8)],
+            dimension_order=["ZCYX"],
+            channel_names=[channel_names],
+            image_name=[None],
+            channel_colors=[channel_colors],
+        )
+        return tifffile.memmap(
+            self.get_export_path(),
+            shape=shape,
+            dtype=numpy.uint8,
+            bigtiff=numpy.prod(shape) > BIGTIFF_BYTE_LIMIT,
+            photometric="minisblack",
+            description=to_xml(ome).encode(),
+            metadata=None,
+        )
+
+    def create_zarr_store(self, shape, channel_names, channel_colors):
+        """
+        Creates an OME-Zarr image chunked like the tiles and returns its array.
+        OME-Zarr puts the channel axis first, the array is the CZYX transpose
+        of the OME-TIFF image
+        """
+        try:
+            import zarr
+        except ImportError:
+            raise ImportError(
+                "zarr is needed to export ome.zarr images, install it with the "
+                "zarr extra: `pip install cellpack[zarr]`"
+            )
+        # tiles of chunk_size voxels, in the CZYX order
+        axes = self.projection_axes.get(self.projection_axis, (0, 1, 2, 3))
+        tile_shape = (shape[1], *self.chunk_size)
+        chunks = tuple(tile_shape[axis] for axis in axes)
+        group = zarr.open_group(self.get_export_path(), mode="w", zarr_format=2)
+        array = group.create_array(
+            "0",
+            shape=(shape[1], shape[0], *shape[2:]),
+            chunks=(chunks[1], chunks[0], *chunks[2:]),
+            dtype=numpy.uint8,
+        )
+        voxel_size = [float(size) for size in self.voxel_size]
+        group.attrs["multiscales"] = [
+            {
+                "version": "0.4",
+                "name": self.name,
+                "axes": [
+                    {"name": "c", "type": "channel"},
+                    {"name": "z", "type": "space"},
+                    {"name": "y", "type": "space"},
+                    {"name": "x", "type": "space"},
+                ],
+                "datasets": [
+                    {
+                        "path": "0",
+                        "coordinateTransformations": [
+                            {"type": "scale", "scale": [1.0, *voxel_size[::-1]]}
+                        ],
+                    }
+                ],
+            }
+        ]
+        group.attrs["omero"] = {
+            "channels": [
+                {
+                    "label": name,
+                    "color": "".join(f"{int(value):02X}" for value in color),
+                    "window": {"min": 0, "max": 255, "start": 0, "end": 255},
+                    "active": True,
+                }
+                for name, color in zip(channel_names, channel_colors)
+            ]
+        }
+        return array
+
+    def export_image_chunked(self):
+        """
+        Voxelizes, convolves and saves the packing tile by tile, only one tile
+        of chunk_size voxels, with a halo of the psf size, is in memory at a
+        time. The image is the same as the one of export_image with the direct
+        or separable convolution, the auto backend does not pick the fft
+        convolution whose float rounding depends on the size of the tiles. The
+        channels of all the tiles are convolved by one thread pool.
+        """
+        log.debug(f"Exporting image to {self.output_path} in chunks")
+        channel_names, channel_color_map = self.env.get_voxelization_channels()
+        self.channel_colors = channel_color_map
+        if len(channel_color_map) == 0:
+            return
+        channel_colors = [
+            channel_color_map.get(name, [255, 255, 255]) for name in channel_names
+        ]
+
+        psf = None
+        backend = None
+        max_workers = None
+        halo = numpy.zeros(3, dtype=int)
+        if self.convolution_options is not None:
+            psf = self.create_psf(
+                self.convolution_options.get("psf", "gaussian"),
+                self.convolution_options.get("psf_parameters", None),
+            )
+            backend = self.convolution_options.get("backend", "auto")
+            if backend == "auto":
+                backend = self.choose_convolution_backend(psf, allow_fft=False)
+            max_workers = self.convolution_options.get("max_workers", None)
+            # the voxels of the tile that the psf reaches from its edges
+            halo = numpy.array(psf.shape) // 2
+        axes = self.projection_axes.get(self.projection_axis, (0, 1, 2, 3))
+        image_shape = (len(channel_names), *self.image_size)
+        shape = tuple(image_shape[axis] for axis in axes)
+        if self.image_format == "ome.zarr":
+            store = self.create_zarr_store(shape, channel_names, channel_colors)
+        elif self.image_format == "ome.tiff":
+            store = self.create_tiff_store(shape, channel_names, channel_colors)
+        else:
+            raise NotImplementedError(
+                f"Image format {self.image_format} not implemented"
+            )
+
+        bounds = self.env.get_voxelization_bounds(self.voxel_size)
+        image_size = numpy.array(self.image_size)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for tile_start in itertools.product(
+                *[range(0, image_size[i], self.chunk_size[i]) for i in range(3)]
+            ):
+                tile_start = numpy.array(tile_start)
+                tile_size = (
+                    numpy.minimum(tile_start + self.chunk_size, image_size) - tile_start
+                )
+                tile = self.env.create_voxelization_tile(
+                    self,
+                    channel_names,
+                    tile_start - halo,
+                    tile_size + 2 * halo,
+                    bounds=bounds,
+                )
+                if psf is not None:
+                    tile = self.convolve_image(
+                        tile, psf, backend=backend, executor=executor
+                    )
+                tile = tile[
+                    :,
+                    halo[0] : halo[0] + tile_size[0],
+                    halo[1] : halo[1] + tile_size[1],
+                    halo[2] : halo[2] + tile_size[2],
+                ]
+                image_slices = (slice(None),) + tuple(
+                    slice(tile_start[i], tile_start[i] + tile_size[i]) for i in range(3)
+                )
+                slices = tuple(image_slices[axis] for axis in axes)
+                tile = self.transpose_image_for_projection(tile, self.projection_axis)
+                if self.image_format == "ome.zarr":
+                    store[(slices[1], slices[0], *slices[2:])] = tile.swapaxes(0, 1)
+                else:
+                    store[slices] = tile
+        if self.image_format == "ome.tiff":
+            store.flush()
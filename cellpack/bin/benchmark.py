@@ -0,0 +1,892 @@
+# micro-benchmarks for the packing hot spots
+import logging
+import multiprocessing
+import os
+import resource
+import tempfile
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+from time import perf_counter
+
+import fire
+import numpy
+import tifffile
+import trimesh
+from scipy import spatial
+
+from cellpack import autopack
+from cellpack.autopack import upy
+from cellpack.autopack.BaseGrid import BaseGrid
+from cellpack.autopack.Compartment import Compartment
+from cellpack.autopack.Environment import Environment
+from cellpack.autopack.Gradient import Gradient
+from cellpack.autopack.MeshStore import MeshStore
+from cellpack.autopack.ingredient.Ingredient import Ingredient
+from cellpack.autopack.ingredient.single_sphere import SingleSphereIngr
+from cellpack.autopack.interface_objects.packed_objects import (
+    PackedObject,
+    PackedObjects,
+)
+from cellpack.autopack.loaders.config_loader import ConfigLoader
+from cellpack.autopack.loaders.recipe_loader import RecipeLoader
+from cellpack.autopack.loaders.sphere_tree_loader import SphereTreeLoader
+from cellpack.autopack.utils import (
+    get_binned_distances,
+    get_distances_from_point,
+    map_positions,
+)
+from cellpack.autopack.writers.ImageWriter import ImageWriter
+
+logger = logging.getLogger(__name__)
+
+
+def _best_time(function, repeat, setup=None):
+    best = float("inf")
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = perf_counter()
+        function(*args)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def _legacy_update_distances(
+    insidePoints, newDistPoints, free_points, nbFreePoints, distance
+):
+    # per point loop used before BaseGrid.update_distances
+    for pt, dist in insidePoints.items():
+        free_points, nbFreePoints = BaseGrid.reorder_free_points(
+            pt, free_points, nbFreePoints
+        )
+        distance[pt] = dist
+    for pt, dist in newDistPoints.items():
+        if pt not in insidePoints:
+            distance[pt] = dist
+    return nbFreePoints
+
+
+def update_distances(grid_size=100, radius=6, placements=20, repeat=3, seed=0):
+    """
+    Compares the per point update of the free points and distances with the
+    batched BaseGrid.update_distances for spheres of `radius` grid points
+    placed in a grid_size^3 grid
+    """
+    rng = numpy.random.default_rng(seed)
+    nb_points = grid_size**3
+    ijk = numpy.indices((2 * radius + 1,) * 3).reshape(3, -1).T - radius
+    offset_distances = numpy.linalg.norm(ijk, axis=1)
+    ijk = ijk[offset_distances <= 2 * radius]
+    offset_distances = offset_distances[offset_distances <= 2 * radius]
+    strides = numpy.array([grid_size * grid_size, grid_size, 1])
+    # spheres don't overlap, like placements that passed the collision check
+    cells = numpy.arange(2 * radius, grid_size - 2 * radius, 4 * radius + 1)
+    centers = numpy.stack(numpy.meshgrid(cells, cells, cells), -1).reshape(-1, 3)
+    centers = rng.permutation(centers)[:placements]
+    placements = len(centers)
+    placed = []
+    for center in centers:
+        indices = (center + ijk) @ strides
+        inside = offset_distances <= radius
+        placed.append(
+            (
+                indices[inside],
+                offset_distances[inside] - radius,
+                indices[~inside],
+                offset_distances[~inside] - radius,
+            )
+        )
+
+    placed_dicts = [
+        (
+            dict(zip(inside.tolist(), inside_d.tolist())),
+            dict(zip(around.tolist(), around_d.tolist())),
+        )
+        for inside, inside_d, around, around_d in placed
+    ]
+
+    def new_grid():
+        return numpy.arange(nb_points), numpy.full(nb_points, float(grid_size))
+
+    def run_legacy(free_points, distance):
+        nb_free = nb_points
+        for insidePoints, newDistPoints in placed_dicts:
+            nb_free = _legacy_update_distances(
+                insidePoints, newDistPoints, free_points, nb_free, distance
+            )
+        return free_points, nb_free, distance
+
+    def run_dicts(free_points, distance):
+        nb_free = nb_points
+        for insidePoints, newDistPoints in placed_dicts:
+            nb_free = BaseGrid.updateDistances(
+                insidePoints, newDistPoints, free_points, nb_free, distance
+            )
+        return free_points, nb_free, distance
+
+    def run_batched(free_points, distance):
+        nb_free = nb_points
+        for inside, inside_d, around, around_d in placed:
+            nb_free = BaseGrid.update_distances(
+                inside, inside_d, around, around_d, free_points, nb_free, distance
+            )
+        return free_points, nb_free, distance
+
+    legacy = run_legacy(*new_grid())
+    print(f"grid points: {nb_points}")
+    print(f"points removed per placement: {len(placed[0][0])}")
+    time_legacy = _best_time(run_legacy, repeat, new_grid)
+    print(f"per point loop: {time_legacy / placements * 1000:.3f} ms/placement")
+    for name, function in (("updateDistances", run_dicts), ("batched", run_batched)):
+        result = function(*new_grid())
+        same = (
+            legacy[1] == result[1]
+            and numpy.array_equal(legacy[0], result[0])
+            and numpy.array_equal(legacy[2], result[2])
+        )
+        elapsed = _best_time(function, repeat, new_grid)
+        print(
+            f"{name}: {elapsed / placements * 1000:.3f} ms/placement, "
+            f"speedup {time_legacy / elapsed:.1f}x, same result: {same}"
+        )
+
+
+def _peak_memory_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def points_in_sphere(grid_size=256, radius=4.5, queries=2000, seed=0):
+    """
+    Compares the stencil lookup of BaseGrid.getPointsInSphere with the KD-tree
+    query on a grid_size^3 grid of spacing 1, for spheres of `radius`
+    """
+    rng = numpy.random.default_rng(seed)
+    grid = BaseGrid(boundingBox=([0, 0, 0], [grid_size] * 3), spacing=1.0)
+    points = rng.uniform(0, grid_size, size=(queries, 3))
+    print(f"grid points: {grid.gridVolume}")
+    print(f"peak memory after grid setup: {_peak_memory_mb():.0f} MB")
+
+    def run(function):
+        return [function(point, radius) for point in points]
+
+    stencil_results = run(grid.getPointsInSphere)
+    elapsed = _best_time(run, 3, lambda: (grid.getPointsInSphere,))
+    stencil_bytes = sum(
+        box_indices.nbytes + flat_offsets.nbytes
+        for box_indices, flat_offsets, _ in grid.sphere_stencils.values()
+    )
+    print(
+        f"stencil: {elapsed / queries * 1e6:.1f} us/query, "
+        f"{stencil_bytes / 1024:.1f} kB of stencils, "
+        f"peak memory {_peak_memory_mb():.0f} MB"
+    )
+
+    start = perf_counter()
+    grid.getPointsInSphereTree(points[0], radius)
+    build_time = perf_counter() - start
+    tree_results = run(grid.getPointsInSphereTree)
+    elapsed_tree = _best_time(run, 3, lambda: (grid.getPointsInSphereTree,))
+    print(
+        f"KD-tree: {elapsed_tree / queries * 1e6:.1f} us/query, "
+        f"built in {build_time:.1f} s, peak memory {_peak_memory_mb():.0f} MB"
+    )
+    same = all(
+        numpy.array_equal(stencil, numpy.sort(tree))
+        for stencil, tree in zip(stencil_results, tree_results)
+    )
+    print(f"speedup {elapsed_tree / elapsed:.1f}x, same points: {same}")
+
+
+def _grid_memory_run(grid_size, implicit_lattice, queries, seed, results):
+    rng = numpy.random.default_rng(seed)
+    start = perf_counter()
+    grid = BaseGrid(
+        boundingBox=([0, 0, 0], [grid_size] * 3),
+        spacing=1.0,
+        implicit_lattice=implicit_lattice,
+    )
+    setup_time = perf_counter() - start
+    setup_memory = _peak_memory_mb()
+
+    # the radial distances of a gradient weight map and the positions of the
+    # points around random drop points, as the packing reads them
+    center = numpy.full(3, grid_size / 2.0)
+    start = perf_counter()
+    distances = map_positions(
+        lambda positions: get_distances_from_point(positions, center),
+        grid.masterGridPositions,
+    )
+    gradient_time = perf_counter() - start
+    start = perf_counter()
+    gathered = 0.0
+    for point in rng.uniform(0, grid_size, size=(queries, 3)):
+        points = grid.getPointsInSphere(point, 4.5)
+        gathered += grid.masterGridPositions[points].sum()
+    gather_time = perf_counter() - start
+    results.put(
+        (
+            setup_time,
+            setup_memory,
+            gradient_time,
+            gather_time,
+            _peak_memory_mb(),
+            float(distances.sum()),
+            gathered,
+        )
+    )
+
+
+def grid_memory(grid_size=200, queries=2000, seed=0):
+    """
+    Compares the grid with stored point positions and ijk indices with the grid
+    that computes them from the lattice: setup time, peak memory, the distances
+    of a radial gradient and the gather of the positions around drop points.
+    Each mode runs in its own process so the peak memory is its own.
+    """
+    print(f"grid points: {grid_size ** 3}")
+    context = multiprocessing.get_context("spawn")
+    checks = {}
+    for implicit_lattice in (False, True):
+        results = context.Queue()
+        process = context.Process(
+            target=_grid_memory_run,
+            args=(grid_size, implicit_lattice, queries, seed, results),
+        )
+        process.start()
+        (
+            setup_time,
+            setup_memory,
+            gradient_time,
+            gather_time,
+            peak_memory,
+            *checks[implicit_lattice],
+        ) = results.get()
+        process.join()
+        name = "implicit" if implicit_lattice else "dense"
+        print(
+            f"{name}: setup {setup_time:.2f} s, peak memory {setup_memory:.0f} MB, "
+            f"gradient distances {gradient_time:.2f} s, "
+            f"gather {gather_time / queries * 1e6:.1f} us/query, "
+            f"peak memory {peak_memory:.0f} MB"
+        )
+    print(f"same results: {numpy.allclose(checks[False], checks[True])}")
+
+
+def grid_state_memory(grid_size=100):
+    """
+    Compares the bytes per grid point of the fill state (distances, free
+    points and the weights of a radial gradient) with and without a compact
+    grid state
+    """
+    print(f"grid points: {grid_size ** 3}")
+    for compact_state in (False, True):
+        grid = BaseGrid(
+            boundingBox=([0, 0, 0], [grid_size] * 3),
+            spacing=1.0,
+            compact_state=compact_state,
+        )
+        grid.create_state()
+        gradient = Gradient(
+            {
+                "name": "radial",
+                "description": "",
+                "mode": "radial",
+                "weight_mode": "linear",
+                "pick_mode": "rnd",
+                "mode_settings": {"center": [grid_size / 2.0] * 3},
+                "weight_mode_settings": {},
+                "invert": None,
+            },
+            compact_weights=compact_state,
+        )
+        gradient.build_weight_map(
+            numpy.array(grid.boundingBox), grid.masterGridPositions
+        )
+        arrays = {
+            "distances": grid.distToClosestSurf,
+            "free points": grid.free_points,
+            "gradient weights": gradient.weight,
+            "gradient distances": gradient.distances,
+        }
+        name = "compact" if compact_state else "default"
+        print(
+            f"{name}: "
+            + ", ".join(
+                f"{key} {array.nbytes / grid.gridVolume:.0f} B"
+                for key, array in arrays.items()
+            )
+            + f", total {sum(a.nbytes for a in arrays.values()) / grid.gridVolume:.0f} B/point"
+        )
+
+
+def _legacy_outer_hits(position_list, inner_loc, outer_mesh):
+    # one ray per position, used before MeshStore.get_first_ray_hits
+    outer_loc = numpy.zeros(inner_loc.shape)
+    for ind, position in enumerate(position_list):
+        outer_loc[ind], _, _ = outer_mesh.ray.intersects_location(
+            ray_origins=[inner_loc[ind]], ray_directions=[position - inner_loc[ind]]
+        )
+    return outer_loc
+
+
+def scaled_distances(
+    inner="cellpack/tests/geometry/sphere_2.obj",
+    outer="cellpack/tests/geometry/sphere_4.obj",
+    points=5000,
+    chunk_size=10000,
+    repeat=3,
+    seed=0,
+):
+    """
+    Compares the per position ray casts with the batched ones of
+    MeshStore.calc_scaled_distances_for_positions, for random positions
+    between the inner and the outer mesh
+    """
+    rng = numpy.random.default_rng(seed)
+    inner_mesh = trimesh.load(inner)
+    outer_mesh = trimesh.load(outer)
+    bounds = outer_mesh.bounds
+    positions = rng.uniform(bounds[0], bounds[1], size=(4 * points, 3))
+    # contains casts rays too, a few hundred points at a time bound its memory
+    between = numpy.concatenate(
+        [
+            outer_mesh.contains(chunk) & ~inner_mesh.contains(chunk)
+            for chunk in numpy.array_split(positions, max(len(positions) // 500, 1))
+        ]
+    )
+    positions = positions[between][:points]
+    print(f"positions between the surfaces: {len(positions)}")
+    inner_loc, _, _ = trimesh.proximity.ProximityQuery(inner_mesh).on_surface(positions)
+    legacy = _legacy_outer_hits(positions, inner_loc, outer_mesh)
+    batched = MeshStore.get_first_ray_hits(
+        outer_mesh, inner_loc, positions - inner_loc, chunk_size
+    )
+    time_legacy = _best_time(
+        _legacy_outer_hits, repeat, lambda: (positions, inner_loc, outer_mesh)
+    )
+    elapsed = _best_time(
+        MeshStore.get_first_ray_hits,
+        repeat,
+        lambda: (outer_mesh, inner_loc, positions - inner_loc, chunk_size),
+    )
+    print(f"per position rays: {time_legacy:.3f} s")
+    print(
+        f"batched rays: {elapsed:.3f} s, speedup {time_legacy / elapsed:.1f}x, "
+        f"same hits: {numpy.allclose(legacy, batched)}"
+    )
+
+
+def _legacy_sphere_collision(packed_objects, rows, level, positions, radii):
+    # per packed object transform and KD-tree query used before
+    # PackedObjects.get_level_spheres
+    search_tree = spatial.cKDTree(positions)
+    for row in rows:
+        packed_object = packed_objects.get_ingredients()[row]
+        ingredient = packed_object.ingredient
+        packed_positions = ingredient.transformPoints(
+            packed_object.position,
+            packed_object.rotation,
+            ingredient.positions[level],
+        )
+        distances, ind = search_tree.query(packed_positions, len(positions))
+        sum_radii = numpy.add(
+            numpy.array(radii)[ind].transpose(), numpy.array(ingredient.radii[level])
+        ).transpose()
+        if len(numpy.nonzero(distances - sum_radii < 0.0)[0]) != 0:
+            return True
+    return False
+
+
+def sphere_collisions(
+    spheres=64, objects=2000, neighbours=20, checks=2000, box_size=500, seed=0
+):
+    """
+    Compares the collision checks of a sphere tree with `spheres` spheres at
+    its deepest level against `neighbours` packed objects, per packed object
+    and against the cached world space spheres
+    """
+    rng = numpy.random.default_rng(seed)
+    ingredient = SimpleNamespace(
+        name="tree",
+        color=None,
+        encapsulating_radius=20.0,
+        positions=[[[0.0, 0.0, 0.0]], rng.uniform(-15, 15, (spheres, 3))],
+        radii=[[20.0], rng.uniform(2, 5, spheres)],
+        transformPoints=lambda trans, rot, points: Ingredient.transformPoints(
+            None, trans, rot, points
+        ),
+    )
+    packed_objects = PackedObjects()
+    for _ in range(objects):
+        rotation = numpy.identity(4)
+        rotation[:3, :3] = spatial.transform.Rotation.random(
+            random_state=rng.integers(1 << 31)
+        ).as_matrix()
+        packed_objects.add(
+            PackedObject(
+                rng.uniform(0, box_size, 3), rotation, 20.0, None, ingredient=ingredient
+            )
+        )
+    queries = [
+        (
+            rng.choice(objects, neighbours, replace=False),
+            numpy.array(
+                Ingredient.transformPoints(
+                    None,
+                    rng.uniform(0, box_size, 3),
+                    numpy.identity(4),
+                    ingredient.positions[1],
+                )
+            ),
+        )
+        for _ in range(checks)
+    ]
+    print(f"spheres: {spheres}, neighbours per check: {neighbours}")
+
+    start = perf_counter()
+    legacy = [
+        _legacy_sphere_collision(
+            packed_objects, rows, 1, positions, ingredient.radii[1]
+        )
+        for rows, positions in queries
+    ]
+    time_legacy = perf_counter() - start
+    print(f"per object: {time_legacy / checks * 1e6:.1f} us/check")
+
+    start = perf_counter()
+    level_spheres = packed_objects.get_level_spheres(1)
+    time_cache = perf_counter() - start
+    start = perf_counter()
+    cached = [
+        level_spheres.overlaps(rows, positions, ingredient.radii[1])
+        for rows, positions in queries
+    ]
+    elapsed = perf_counter() - start
+    print(
+        f"cached spheres: {elapsed / checks * 1e6:.1f} us/check, "
+        f"cached in {time_cache:.2f} s, speedup {time_legacy / elapsed:.1f}x, "
+        f"same results: {legacy == cached} ({sum(cached)} collisions)"
+    )
+
+
+def _legacy_read_sphere_file(lines):
+    # per line parse used before SphereTreeLoader
+    data = [x for x in lines if x[0] != "#" and len(x) > 1 and x[0] != "\r"]
+    centers = []
+    radii = []
+    line = 2
+    for level in range(int(data[1])):
+        nbs = int(data[line])
+        line += 1
+        cl = []
+        rl = []
+        for n in range(nbs):
+            x, y, z, r = list(map(float, data[line].split()[:4]))
+            cl.append((x, y, z))
+            rl.append(r)
+            line += 1
+        centers.append(cl)
+        radii.append(rl)
+    return centers, radii
+
+
+def sphere_tree_loading(spheres=(1, 64, 4096, 50000), ingredients=100, seed=0):
+    """
+    Compares reading the same sphere tree file for `ingredients` ingredients
+    with the per line parse, the first SphereTreeLoader parse, the .npz cache
+    file of a new run and the memoized trees
+    """
+    rng = numpy.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.sph")
+        with open(path, "w") as f:
+            f.write(f"# rmin rmax\n1 100\n{len(spheres)}\n")
+            for level, nb_spheres in enumerate(spheres):
+                f.write(f"{nb_spheres}\n")
+                for values in rng.uniform(0, 100, (nb_spheres, 4)):
+                    children = " 0 1 2 3" if level < len(spheres) - 1 else ""
+                    f.write(" ".join(f"{v:.3f}" for v in values) + children + "\n")
+        print(f"spheres per level: {list(spheres)}, ingredients: {ingredients}")
+
+        start = perf_counter()
+        for _ in range(ingredients):
+            with open(path) as f:
+                legacy = _legacy_read_sphere_file(f.readlines())
+        time_legacy = perf_counter() - start
+        print(f"per line parse: {time_legacy:.3f} s")
+
+        cache_path = SphereTreeLoader.get_cache_path(
+            Path(path).resolve(), os.stat(path)
+        )
+        SphereTreeLoader.trees.clear()
+        start = perf_counter()
+        centers, radii = SphereTreeLoader.load(path)
+        time_parse = perf_counter() - start
+        for _ in range(ingredients - 1):
+            SphereTreeLoader.load(path)
+        time_memo = perf_counter() - start
+        SphereTreeLoader.trees.clear()
+        start = perf_counter()
+        SphereTreeLoader.load(path)
+        time_cache_file = perf_counter() - start
+        cache_path.unlink()
+        print(
+            f"first parse: {time_parse:.3f} s, .npz cache file: {time_cache_file:.3f} s, "
+            f"all ingredients with the memo: {time_memo:.3f} s, "
+            f"speedup {time_legacy / time_memo:.0f}x"
+        )
+        same = all(
+            numpy.array_equal(centers[level], legacy[0][level])
+            and numpy.array_equal(radii[level], legacy[1][level])
+            for level in range(len(spheres))
+        )
+        print(f"same spheres: {same}")
+
+
+def sphere_voxelization(
+    image_size=(256, 256, 128), objects=(100, 1000, 20000), radius=4.0, seed=0
+):
+    """
+    Compares voxelizing `objects` spheres with a mask over the whole image per
+    sphere and with the cached sphere stamp written around each sphere
+    """
+    rng = numpy.random.default_rng(seed)
+    ingredient = SingleSphereIngr(radius=radius, name="sphere")
+    bounding_box = numpy.array([[0.0, 0.0, 0.0], image_size])
+    voxel_size = numpy.array([1.0, 1.0, 1.0])
+    print(f"image size: {tuple(image_size)}, sphere radius: {radius} voxels")
+    for nb_objects in objects:
+        positions = rng.uniform(0, image_size, (nb_objects, 3))
+        image_data = numpy.zeros(image_size, dtype=numpy.uint8)
+        start = perf_counter()
+        for position in positions:
+            ingredient.create_voxelization(
+                image_data, bounding_box, voxel_size, image_size, position
+            )
+        time_stamps = perf_counter() - start
+
+        # the whole image masks are timed on at most 100 spheres
+        nb_legacy = min(nb_objects, 100)
+        legacy_data = numpy.zeros(image_size, dtype=numpy.uint8)
+        start = perf_counter()
+        for position in positions[:nb_legacy]:
+            mask = SingleSphereIngr.create_circular_mask(
+                *image_size,
+                center=(position / voxel_size).astype(int),
+                radius=radius,
+                voxel_size=voxel_size,
+            )
+            legacy_data[mask] = 255
+        time_legacy = (perf_counter() - start) * nb_objects / nb_legacy
+        if nb_legacy < nb_objects:
+            check = "whole image masks extrapolated"
+        else:
+            check = f"same image: {numpy.array_equal(legacy_data, image_data)}"
+        print(
+            f"{nb_objects} spheres: whole image masks {time_legacy:.2f} s, "
+            f"stamps {time_stamps:.3f} s, speedup {time_legacy / time_stamps:.0f}x, "
+            f"{check}"
+        )
+
+
+def _pack(recipe_path, place_method, batched_jitter, seed, out):
+    config = ConfigLoader().config
+    config.update(
+        {
+            "place_method": place_method,
+            "overwrite_place_method": True,
+            "load_from_grid_file": False,
+            "show_progress_bar": False,
+            "save_analyze_result": False,
+            "save_plot_figures": False,
+            "batched_jitter": batched_jitter,
+            "out": out,
+        }
+    )
+    recipe = RecipeLoader(recipe_path, False, False).recipe_data
+    autopack.helper = upy.getHelperClass()(vi="nogui")
+    env = Environment(config=config, recipe=recipe)
+    env.helper = autopack.helper
+    env.saveResult = False
+    env.buildGrid(rebuild=True)
+    start = perf_counter()
+    env.pack_grid(seedNum=seed, verbose=0, usePP=False)
+    elapsed = perf_counter() - start
+    positions = [
+        numpy.ravel(packed_object.position)[:3].tolist()
+        for packed_object in env.packed_objects.get_all()
+    ]
+    return elapsed, positions
+
+
+def jitter_placement(
+    recipe="examples/recipes/v2/sphere_tree.json", place_method="spheresSST", seed=0
+):
+    """
+    Packs the recipe trying the jitter attempts of each point one at a time and
+    in batches
+    """
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as out:
+        time_sequential, sequential = _pack(recipe, place_method, False, seed, out)
+        time_batched, batched = _pack(recipe, place_method, True, seed, out)
+    logging.disable(logging.NOTSET)
+    print(f"{recipe} ({place_method}): {len(sequential)} objects")
+    print(
+        f"one attempt at a time: {time_sequential:.2f} s, "
+        f"batched: {time_batched:.2f} s, "
+        f"speedup {time_sequential / time_batched:.1f}x, "
+        f"same packing: {sequential == batched}"
+    )
+
+
+def _legacy_compartment_mask(mesh, widths, center, voxel_size):
+    # dense voxel coordinates queried with is_filled, before the rasterizer
+    Z, Y, X = numpy.meshgrid(
+        *[numpy.arange(width) for width in widths[::-1]], indexing="ij"
+    )
+    coords = numpy.column_stack(
+        [
+            (X * voxel_size[0] - center[0]).flatten(),
+            (Y * voxel_size[1] - center[1]).flatten(),
+            (Z * voxel_size[2] - center[2]).flatten(),
+        ]
+    )
+    trimesh_grid = trimesh.voxel.creation.voxelize(mesh, pitch=numpy.min(voxel_size))
+    return trimesh_grid.fill().is_filled(coords).reshape(widths, order="F")
+
+
+def compartment_voxelization(
+    mesh_path="cellpack/tests/geometry/membrane_1.obj", voxel_size=0.1, margin=2.0
+):
+    """
+    Compares the compartment mask of the dense voxel coordinates queried with
+    is_filled and of the voxel grid mapped to the image axes, the first time
+    and for a packing of the same mesh. The memory is the peak of the numpy
+    allocations.
+    """
+    mesh = trimesh.load(mesh_path)
+    mesh_store = MeshStore()
+    mesh_store.add_mesh_to_scene(mesh, "compartment")
+    compartment = SimpleNamespace(gname="compartment")
+    voxel_size = numpy.full(3, voxel_size)
+    widths = tuple(
+        ((numpy.ptp(mesh.bounds, axis=0) + 2 * margin) / voxel_size)
+        .astype(int)
+        .tolist()
+    )
+    center = margin - mesh.bounds[0]
+    print(f"image size: {widths}, {numpy.prod(widths)} voxels")
+
+    def run(function):
+        tracemalloc.start()
+        start = perf_counter()
+        mask = function()
+        elapsed = perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+        return mask, elapsed, peak
+
+    def rasterize():
+        return Compartment.create_voxelized_mask(
+            compartment, *widths, center, voxel_size, mesh_store
+        )
+
+    compartment.get_voxelized_mesh = Compartment.get_voxelized_mesh
+    legacy, time_legacy, memory_legacy = run(
+        lambda: _legacy_compartment_mask(mesh, widths, center, voxel_size)
+    )
+    Compartment.voxelized_meshes.clear()
+    mask, time_first, memory_first = run(rasterize)
+    _, time_cached, memory_cached = run(rasterize)
+    print(f"is_filled: {time_legacy:.2f} s, {memory_legacy:.0f} MB")
+    print(f"rasterizer: {time_first:.2f} s, {memory_first:.0f} MB")
+    print(
+        f"rasterizer with the voxelized mesh cached: {time_cached:.3f} s, "
+        f"{memory_cached:.0f} MB, speedup {time_legacy / time_cached:.0f}x"
+    )
+    print(f"same mask: {numpy.array_equal(mask, legacy)}")
+
+
+class _VoxelizationEnv(SimpleNamespace):
+    # the parts of Environment the image export uses
+    create_voxelization = Environment.create_voxelization
+    get_voxelization_channels = Environment.get_voxelization_channels
+    get_voxelization_bounds = Environment.get_voxelization_bounds
+    create_voxelization_tile = Environment.create_voxelization_tile
+
+
+def _image_export_run(image_size, objects, radius, chunk_size, seed, out, results):
+    rng = numpy.random.default_rng(seed)
+    packed_objects = PackedObjects()
+    ingredients = [
+        SingleSphereIngr(radius=radius, name=f"sphere_{index}", color=color)
+        for index, color in enumerate([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
+    ]
+    for index, position in enumerate(rng.uniform(0, image_size, (objects, 3))):
+        ingredient = ingredients[index % 2]
+        packed_objects.add(
+            PackedObject(position, numpy.identity(4), radius, index, ingredient)
+        )
+    env = _VoxelizationEnv(
+        boundingBox=numpy.array([[0.0, 0.0, 0.0], image_size]),
+        packed_objects=packed_objects,
+        mesh_store=None,
+        out_folder=out,
+    )
+    image_writer = ImageWriter(
+        env,
+        name="chunked" if chunk_size else "in_memory",
+        output_path=out,
+        voxel_size=[1, 1, 1],
+        convolution_options={"psf": "gaussian"},
+        chunk_size=chunk_size,
+    )
+    start_memory = _peak_memory_mb()
+    start = perf_counter()
+    if chunk_size is None:
+        env.create_voxelization(image_writer)
+        image_writer.export_image()
+    else:
+        image_writer.export_image_chunked()
+    results.put((perf_counter() - start, _peak_memory_mb() - start_memory))
+
+
+def chunked_image_export(
+    image_size=(512, 512, 256), objects=20000, radius=4.0, chunk_size=128, seed=0
+):
+    """
+    Compares exporting the convolved image of `objects` spheres in memory and
+    tile by tile. Each export runs in its own process so the peak memory is its
+    own.
+    """
+    context = multiprocessing.get_context("spawn")
+    print(f"image size: {tuple(image_size)}, 2 channels, {objects} spheres")
+    with tempfile.TemporaryDirectory() as out:
+        for tiles in (None, chunk_size):
+            results = context.Queue()
+            process = context.Process(
+                target=_image_export_run,
+                args=(image_size, objects, radius, tiles, seed, out, results),
+            )
+            process.start()
+            elapsed, memory = results.get()
+            process.join()
+            name = "in memory" if tiles is None else f"tiles of {tiles} voxels"
+            print(f"{name}: {elapsed:.2f} s, peak memory increase {memory:.0f} MB")
+        same = numpy.array_equal(
+            tifffile.imread(Path(out) / "voxelized_image_in_memory.ome.tiff"),
+            tifffile.imread(Path(out) / "voxelized_image_chunked.ome.tiff"),
+        )
+    print(f"same image: {same}")
+
+
+def convolution_backends(
+    image_size=(128, 128, 64),
+    kernel_sizes=(3, 5, 9, 15, 31),
+    channels=2,
+    max_direct_size=15,
+    seed=0,
+):
+    """
+    Compares the direct, separable and fft convolution of a `channels` image
+    with gaussian psfs of each kernel size, sigma is a sixth of the size. The
+    direct convolution is only timed up to max_direct_size.
+    """
+    rng = numpy.random.default_rng(seed)
+    image = numpy.where(rng.random((channels, *image_size)) < 0.05, 255, 0).astype(
+        numpy.uint8
+    )
+    image_writer = ImageWriter(
+        SimpleNamespace(boundingBox=numpy.array([[0, 0, 0], image_size])),
+        output_path=tempfile.gettempdir(),
+        voxel_size=[1, 1, 1],
+    )
+    print(f"image size: {tuple(image_size)}, {channels} channels")
+    for size in kernel_sizes:
+        psf = ImageWriter.create_gaussian_psf(sigma=size / 6, size=[size] * 3)
+        times = {}
+        images = {}
+        for backend in ("direct", "separable", "fft"):
+            if backend == "direct" and size > max_direct_size:
+                continue
+            start = perf_counter()
+            images[backend] = image_writer.convolve_image(image, psf, backend=backend)
+            times[backend] = perf_counter() - start
+        timings = ", ".join(
+            f"{backend} {elapsed:.2f} s" for backend, elapsed in times.items()
+        )
+        # the backends only differ by the float rounding before the uint8 cast
+        reference = images.get("direct", images["separable"]).astype(int)
+        max_difference = max(
+            numpy.abs(conv_image - reference).max() for conv_image in images.values()
+        )
+        print(
+            f"kernel {size}^3: {timings}, "
+            f"auto: {ImageWriter.choose_convolution_backend(psf)}, "
+            f"max difference {max_difference}"
+        )
+
+
+def binned_distances(
+    objects=(1000, 5000, 20000),
+    box_size=1000.0,
+    cutoff=100.0,
+    number_of_bins=100,
+    seed=0,
+):
+    """
+    Compares the histogram of all the pairwise distances of `objects` uniform
+    positions from pdist with the KD-tree counts up to cutoff
+    """
+    rng = numpy.random.default_rng(seed)
+    bin_edges = numpy.linspace(0, cutoff, number_of_bins + 1)
+
+    def run(function):
+        tracemalloc.start()
+        start = perf_counter()
+        result = function()
+        elapsed = perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+        return result, elapsed, peak
+
+    for count in objects:
+        positions = rng.uniform(0, box_size, (count, 3))
+        expected, time_pdist, memory_pdist = run(
+            lambda: numpy.histogram(spatial.distance.pdist(positions), bin_edges)[0]
+        )
+        binned, time_binned, memory_binned = run(
+            lambda: get_binned_distances(positions, bin_edges)
+        )
+        print(
+            f"{count} positions: pdist {time_pdist:.2f} s, {memory_pdist:.0f} MB, "
+            f"binned {time_binned:.2f} s, {memory_binned:.1f} MB, "
+            f"same counts: {numpy.array_equal(binned['counts'], expected)}"
+        )
+
+
+def main():
+    fire.Fire(
+        {
+            "binned_distances": binned_distances,
+            "chunked_image_export": chunked_image_export,
+            "compartment_voxelization": compartment_voxelization,
+            "convolution_backends": convolution_backends,
+            "grid_memory": grid_memory,
+            "grid_state_memory": grid_state_memory,
+            "jitter_placement": jitter_placement,
+            "points_in_sphere": points_in_sphere,
+            "scaled_distances": scaled_distances,
+            "sphere_collisions": sphere_collisions,
+            "sphere_tree_loading": sphere_tree_loading,
+            "sphere_voxelization": sphere_voxelization,
+            "update_distances": update_distances,
+        }
+    )
+
+
+# Run directly from command line
+if __name__ == "__main__":
+    main()
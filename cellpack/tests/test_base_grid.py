@@ -0,0 +1,141 @@
+import numpy
+import pytest
+from cellpack.autopack.BaseGrid import BaseGrid
+
+
+def test_grid_state_shares_buffers_with_grid():
+    grid = BaseGrid(boundingBox=([0, 0, 0], [40, 40, 40]), spacing=10)
+    grid_state = grid.create_state()
+    assert grid_state.distances is grid.distToClosestSurf
+    assert grid_state.free_points is grid.free_points
+    assert grid_state.nb_free_points == grid.gridVolume
+
+    snapshot = grid_state.snapshot()
+    grid_state.update({3: -1.0, 7: -2.0}, {4: 1.5})
+    assert grid_state.nb_free_points == grid.gridVolume - 2
+    assert grid.distToClosestSurf[3] == -1.0
+    assert grid.distToClosestSurf[4] == 1.5
+    # the snapshot is not affected by the update
+    assert snapshot.nb_free_points == grid.gridVolume
+    assert numpy.all(snapshot.free_points == numpy.arange(grid.gridVolume))
+    assert snapshot.distances[3] == grid.diag
+
+
+def test_compact_grid_state():
+    grid = BaseGrid(boundingBox=([0, 0, 0], [40, 40, 40]), spacing=10)
+    compact_grid = BaseGrid(
+        boundingBox=([0, 0, 0], [40, 40, 40]), spacing=10, compact_state=True
+    )
+    grid_state = grid.create_state()
+    compact_grid_state = compact_grid.create_state()
+    assert compact_grid_state.distances.dtype == numpy.float32
+    assert compact_grid_state.free_points.dtype == numpy.int32
+    assert compact_grid_state.distances.nbytes * 2 == grid_state.distances.nbytes
+
+    for state in (grid_state, compact_grid_state):
+        state.update({3: -1.0, 7: -2.0, 20: -0.5}, {4: 1.5, 8: 2.25})
+    assert compact_grid_state.nb_free_points == grid_state.nb_free_points
+    assert numpy.array_equal(compact_grid_state.free_points, grid_state.free_points)
+    assert numpy.allclose(compact_grid_state.distances, grid_state.distances)
+
+    compact_grid.reset()
+    assert compact_grid.distToClosestSurf.dtype == numpy.float32
+    assert compact_grid.free_points.dtype == numpy.int32
+    assert compact_grid.nbFreePoints == compact_grid.gridVolume
+
+
+def _remove_one_by_one(points, free_points, nb_free_points):
+    for pt in points:
+        free_points, nb_free_points = BaseGrid.reorder_free_points(
+            pt, free_points, nb_free_points
+        )
+    return nb_free_points
+
+
+@pytest.mark.parametrize(
+    "removals",
+    [
+        [[3, 5, 9]],
+        [[19, 18, 17, 0, 1]],
+        [[4, 19, 2], [19, 7, 18, 3]],
+        [[10, 11, 12, 13], [0, 11, 5], [16, 2, 14]],
+    ],
+)
+def test_remove_free_points_matches_reorder_free_points(removals):
+    expected = numpy.arange(20)
+    free_points = numpy.arange(20)
+    nb_expected = nb_free_points = 20
+    for points in removals:
+        nb_expected = _remove_one_by_one(points, expected, nb_expected)
+        nb_free_points = BaseGrid.remove_free_points(
+            numpy.array(points), free_points, nb_free_points
+        )
+        assert nb_free_points == nb_expected
+        assert numpy.array_equal(free_points, expected)
+
+
+def test_remove_free_points_random_sequences():
+    rng = numpy.random.default_rng(0)
+    for _ in range(200):
+        size = int(rng.integers(5, 100))
+        expected = numpy.arange(size)
+        free_points = numpy.arange(size)
+        nb_expected = nb_free_points = size
+        while nb_expected > 1:
+            points = rng.choice(size, int(rng.integers(1, nb_expected)), replace=False)
+            nb_expected = _remove_one_by_one(points, expected, nb_expected)
+            nb_free_points = BaseGrid.remove_free_points(
+                points, free_points, nb_free_points
+            )
+            assert nb_free_points == nb_expected
+            assert numpy.array_equal(free_points, expected)
+
+
+@pytest.mark.parametrize(
+    "bounding_box, spacing",
+    [
+        (([0, 0, 0], [100, 120, 90]), 7.3),
+        (([-50, 10, 0], [50, 80, 1]), 5.0),
+    ],
+)
+def test_points_in_sphere_matches_kd_tree(bounding_box, spacing):
+    grid = BaseGrid(boundingBox=bounding_box, spacing=spacing)
+    rng = numpy.random.default_rng(0)
+    lower = numpy.array(bounding_box[0]) - 20
+    upper = numpy.array(bounding_box[1]) + 20
+    for radius in [0.0, spacing / 2.0, spacing, 3.3 * spacing]:
+        for point in rng.uniform(lower, upper, size=(50, 3)):
+            indices = grid.getPointsInSphere(point, radius)
+            expected = numpy.sort(grid.getPointsInSphereTree(point, radius))
+            assert indices.dtype.kind == "i"
+            assert numpy.array_equal(indices, expected)
+
+
+def test_points_in_sphere_includes_off_grid_points():
+    grid = BaseGrid(boundingBox=([0, 0, 0], [40, 40, 40]), spacing=10)
+    surface_points = numpy.array([[8.0, 8.0, 8.0], [35.0, 35.0, 35.0]])
+    grid.masterGridPositions = numpy.vstack((grid.masterGridPositions, surface_points))
+    indices = grid.getPointsInSphere([5, 5, 5], 6.0)
+    assert indices.tolist() == [0, grid.gridVolume]
+
+
+def test_points_in_cube():
+    grid = BaseGrid(boundingBox=([0, 0, 0], [40, 40, 40]), spacing=10)
+    nx, ny, nz = grid.nbGridPoints
+    indices = grid.getPointsInCube(([0, 10, 20], [15, 25, 35]), None, None)
+    expected = [
+        x + y * nx + z * nx * ny
+        for z in range(2, 4)
+        for y in range(1, 3)
+        for x in [0, 1]
+    ]
+    assert indices.tolist() == expected
+
+
+def test_are_points_inside_bb():
+    grid = BaseGrid(boundingBox=([0, 0, 0], [20, 20, 20]), spacing=2)
+    rng = numpy.random.default_rng(0)
+    points = rng.uniform(-2, 22, size=(200, 3))
+    for dist, jitter in ((None, [1, 1, 1]), (3.0, [1, 1, 1]), (3.0, [1, 0, 1])):
+        expected = [grid.is_point_inside_bb(point, dist, jitter) for point in points]
+        assert grid.are_points_inside_bb(points, dist, jitter).tolist() == expected
@@ -0,0 +1,75 @@
+import numpy
+import pytest
+from scipy import spatial
+
+from cellpack.autopack.utils import (
+    combine_binned_distances,
+    get_binned_count_below,
+    get_binned_distances,
+    get_nearest_neighbor_statistics,
+    get_radial_distribution,
+)
+
+bin_edges = numpy.linspace(0, 30, 31)
+
+
+@pytest.fixture
+def positions():
+    rng = numpy.random.default_rng(0)
+    return rng.uniform(0, 50, (300, 3)), rng.uniform(0, 50, (200, 3))
+
+
+def test_binned_distances_match_pdist(positions):
+    binned = get_binned_distances(positions[0], bin_edges)
+    distances = spatial.distance.pdist(positions[0])
+    assert binned["counts"] == numpy.histogram(distances, bin_edges)[0].tolist()
+    assert binned["number_of_pairs"] == len(distances)
+
+    nearest = numpy.sort(spatial.distance.squareform(distances), axis=1)[:, 1]
+    statistics = get_nearest_neighbor_statistics(binned)
+    assert statistics["count"] == len(positions[0])
+    assert statistics["mean"] == pytest.approx(nearest.mean())
+    assert statistics["std"] == pytest.approx(nearest.std())
+    assert statistics["min"] == pytest.approx(nearest.min())
+    assert statistics["max"] == pytest.approx(nearest.max())
+
+
+def test_binned_distances_match_cdist(positions):
+    binned = get_binned_distances(positions[0], bin_edges, positions[1])
+    distances = spatial.distance.cdist(*positions)
+    assert binned["counts"] == numpy.histogram(distances, bin_edges)[0].tolist()
+    assert binned["number_of_pairs"] == distances.size
+    assert binned["nearest_neighbor"]["min"] == pytest.approx(distances.min())
+    assert get_binned_count_below(binned, 10.0) == numpy.count_nonzero(
+        distances <= 10.0
+    )
+
+
+def test_combine_binned_distances(positions):
+    binned = [get_binned_distances(position, bin_edges) for position in positions]
+    combined = combine_binned_distances(binned)
+    assert combined["counts"] == numpy.add(*[b["counts"] for b in binned]).tolist()
+    assert combined["nearest_neighbor"]["count"] == 500
+    assert combined["nearest_neighbor"]["min"] == min(
+        b["nearest_neighbor"]["min"] for b in binned
+    )
+    assert (
+        combine_binned_distances([get_binned_distances([], bin_edges)])[
+            "nearest_neighbor"
+        ]["min"]
+        is None
+    )
+    with pytest.raises(ValueError):
+        combine_binned_distances(
+            [binned[0], get_binned_distances(positions[1], bin_edges[:-1])]
+        )
+
+
+def test_radial_distribution_of_uniform_positions():
+    rng = numpy.random.default_rng(1)
+    binned = get_binned_distances(
+        rng.uniform(0, 100, (4000, 3)), numpy.linspace(0, 10, 11), volume=100**3
+    )
+    _, rdf = get_radial_distribution(binned)
+    # the positions near the box edges miss some neighbors
+    assert numpy.all(numpy.abs(rdf[2:] - 1) < 0.2)
@@ -0,0 +1,85 @@
+import numpy
+import pytest
+from cellpack.autopack.BaseGrid import BaseGrid
+from cellpack.autopack.CandidateIndex import CandidateIndex, WeightSumTree
+
+
+def test_get_candidates_is_a_read_only_prefix():
+    distances = numpy.array([5.0, 1.0, 3.0, 4.0, 0.5, 6.0])
+    compartment_ids = numpy.array([0, 0, 0, -1, 0, 0])
+    index = CandidateIndex(distances, compartment_ids, numpy.arange(6))
+    assert sorted(index.get_candidates(0, 3.0).tolist()) == [0, 2, 5]
+    assert sorted(index.get_candidates(0, 5.5).tolist()) == [5]
+    assert sorted(index.get_candidates(0, 0.0).tolist()) == [0, 1, 2, 4, 5]
+    assert index.get_candidates(-1, 0.0).tolist() == [3]
+    with pytest.raises(ValueError):
+        index.get_candidates(0, 3.0)[0] = 1
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_candidates_follow_placements(seed):
+    rng = numpy.random.default_rng(seed)
+    nb_points = 300
+    distances = rng.uniform(0, 10, nb_points)
+    compartment_ids = rng.integers(-2, 1, nb_points)
+    free_points = numpy.arange(nb_points)
+    nb_free_points = nb_points
+    is_free = numpy.ones(nb_points, dtype=bool)
+    index = CandidateIndex(distances, compartment_ids, free_points)
+    queries = [(c, t) for c in (-2, -1, 0) for t in rng.uniform(-1, 8, 3)]
+    for step in range(60):
+        # new thresholds get added while the index is updated
+        for compartment_id, threshold in queries[: step % len(queries) + 1]:
+            candidates = index.get_candidates(compartment_id, threshold)
+            expected = numpy.nonzero(
+                is_free & (compartment_ids == compartment_id) & (distances >= threshold)
+            )[0]
+            assert sorted(candidates.tolist()) == expected.tolist()
+        inside = rng.choice(numpy.nonzero(is_free)[0], 3, replace=False)
+        around = rng.choice(nb_points, 20, replace=False)
+        nb_free_points = BaseGrid.update_distances(
+            inside,
+            -numpy.ones(len(inside)),
+            around,
+            distances[around] - rng.uniform(0, 5, len(around)),
+            free_points,
+            nb_free_points,
+            distances,
+        )
+        is_free[inside] = False
+        index.update(inside, around)
+
+
+def test_weight_sum_tree_find_matches_cumulative_sum():
+    rng = numpy.random.default_rng(0)
+    weights = rng.uniform(0, 1, 50)
+    weights[[3, 10, 11]] = numpy.nan
+    points = numpy.sort(rng.choice(50, 21, replace=False))
+    tree = WeightSumTree(points, weights, 0, 0.0)
+    cumulative = numpy.cumsum(numpy.nan_to_num(weights[points]))
+    assert tree.total() == pytest.approx(cumulative[-1])
+    for value in rng.uniform(1e-9, cumulative[-1], 100):
+        assert tree.find(value) == points[numpy.searchsorted(cumulative, value)]
+    tree.remove(points)
+    assert tree.total() == 0.0
+    assert tree.find(0.5) is None
+
+
+def test_weighted_candidates_follow_placements():
+    rng = numpy.random.default_rng(1)
+    nb_points = 200
+    distances = rng.uniform(0, 10, nb_points)
+    compartment_ids = rng.integers(-1, 1, nb_points)
+    weights = rng.uniform(0, 1, nb_points)
+    index = CandidateIndex(distances, compartment_ids, numpy.arange(nb_points))
+    tree = index.get_weighted_candidates("ingredient", weights, 0, 3.0)
+    assert index.get_weighted_candidates("ingredient", None, 0, 3.0) is tree
+    for _ in range(20):
+        inside = rng.choice(nb_points, 3, replace=False)
+        around = rng.choice(nb_points, 20, replace=False)
+        distances[inside] = -1.0
+        distances[around] -= rng.uniform(0, 3, len(around))
+        index.update(inside, around)
+        candidates = index.get_candidates(0, 3.0)
+        assert tree.total() == pytest.approx(weights[candidates].sum())
+        assert tree.find(tree.total() / 2) in candidates
@@ -0,0 +1,26 @@
+from types import SimpleNamespace
+
+import numpy
+import pytest
+import trimesh
+from cellpack.autopack.BaseGrid import BaseGrid
+from cellpack.autopack.Compartment import Compartment
+from cellpack.autopack.MeshStore import MeshStore
+
+
+@pytest.mark.parametrize(
+    "mesh_name, spacing", [("sphere_4", 0.37), ("membrane_1", 1.5)]
+)
+def test_scanline_matches_contains(mesh_name, spacing):
+    mesh = trimesh.load(f"cellpack/tests/geometry/{mesh_name}.obj")
+    mesh_store = MeshStore()
+    mesh_store.add_mesh_to_scene(mesh, mesh_name)
+    lower, upper = mesh.bounds
+    grid = BaseGrid(boundingBox=(lower - 3, upper + 3), spacing=spacing)
+    # a point beyond the lattice, like the off grid surface points
+    grid.masterGridPositions = numpy.vstack((grid.masterGridPositions, mesh.centroid))
+    compartment = SimpleNamespace(gname=mesh_name)
+    inside = Compartment.get_inside_points_scanline(compartment, grid, mesh_store)
+    expected = mesh_store.contains_points_mesh(mesh_name, grid.masterGridPositions)
+    assert inside.any()
+    assert numpy.array_equal(inside, expected)
@@ -0,0 +1,114 @@
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import numpy
+import pytest
+import trimesh
+from trimesh.voxel import creation
+
+from cellpack.autopack.Compartment import Compartment
+from cellpack.autopack.MeshStore import MeshStore
+
+
+class MeshCompartment(SimpleNamespace):
+    create_voxelized_mask = Compartment.create_voxelized_mask
+    get_voxelized_mesh = staticmethod(Compartment.get_voxelized_mesh)
+
+
+def is_filled_mask(mesh, widths, center, voxel_size, hollow, voxel_offset):
+    # the dense coordinates query the rasterizer replaces
+    Z, Y, X = numpy.meshgrid(
+        *[
+            numpy.arange(voxel_offset[axis], voxel_offset[axis] + widths[axis])
+            for axis in (2, 1, 0)
+        ],
+        indexing="ij",
+    )
+    coords = numpy.column_stack(
+        [
+            (X * voxel_size[0] - center[0]).flatten(),
+            (Y * voxel_size[1] - center[1]).flatten(),
+            (Z * voxel_size[2] - center[2]).flatten(),
+        ]
+    )
+    trimesh_grid = creation.voxelize(mesh, pitch=numpy.min(voxel_size))
+    trimesh_grid = trimesh_grid.hollow() if hollow else trimesh_grid.fill()
+    return trimesh_grid.is_filled(coords).reshape(widths, order="F")
+
+
+@pytest.fixture
+def voxelized_meshes(monkeypatch):
+    monkeypatch.setattr(Compartment, "voxelized_meshes", OrderedDict())
+    return Compartment.voxelized_meshes
+
+
+@pytest.mark.parametrize(
+    "mesh_name, voxel_size, hollow, voxel_offset",
+    [
+        ("sphere_4", numpy.array([1, 1, 1]), False, [0, 0, 0]),
+        ("sphere_4", numpy.array([0.5, 0.75, 1.0]), True, [3, -2, 5]),
+        ("membrane_1", numpy.array([1.5, 1.5, 1.5]), False, [-4, 6, 0]),
+        ("membrane_1", numpy.array([2.0, 1.0, 1.5]), True, [0, 0, 0]),
+    ],
+)
+def test_mask_matches_is_filled(
+    voxelized_meshes, mesh_name, voxel_size, hollow, voxel_offset
+):
+    mesh = trimesh.load(f"cellpack/tests/geometry/{mesh_name}.obj")
+    mesh_store = MeshStore()
+    mesh_store.add_mesh_to_scene(mesh, mesh_name)
+    compartment = MeshCompartment(gname=mesh_name)
+    widths = tuple((numpy.ptp(mesh.bounds, axis=0) / voxel_size).astype(int) + 12)
+    center = -mesh.bounds[0] + 5.3
+    mask = compartment.create_voxelized_mask(
+        *widths,
+        center=center,
+        voxel_size=voxel_size,
+        mesh_store=mesh_store,
+        hollow=hollow,
+        voxel_offset=voxel_offset,
+    )
+    expected = is_filled_mask(
+        mesh_store.get_mesh(mesh_name), widths, center, voxel_size, hollow, voxel_offset
+    )
+    assert expected.any()
+    assert numpy.array_equal(mask, expected)
+
+
+def test_voxelized_mesh_is_cached(voxelized_meshes, monkeypatch):
+    voxelized = []
+    voxelize = creation.voxelize
+
+    def counting_voxelize(mesh, pitch):
+        voxelized.append(pitch)
+        return voxelize(mesh, pitch)
+
+    monkeypatch.setattr(creation, "voxelize", counting_voxelize)
+    mesh = trimesh.load("cellpack/tests/geometry/sphere_4.obj")
+    matrix, _ = Compartment.get_voxelized_mesh(mesh, 1.0)
+    other_matrix, _ = Compartment.get_voxelized_mesh(mesh.copy(), 1.0)
+    assert other_matrix is matrix
+    assert len(voxelized) == 1
+
+    Compartment.get_voxelized_mesh(mesh, 1.0, hollow=True)
+    Compartment.get_voxelized_mesh(mesh, 0.5)
+    mesh.apply_translation([1.0, 0.0, 0.0])
+    Compartment.get_voxelized_mesh(mesh, 1.0)
+    assert len(voxelized) == 4
+    assert len(voxelized_meshes) == 4
+
+
+def test_voxelized_meshes_are_evicted(voxelized_meshes, monkeypatch):
+    mesh = trimesh.load("cellpack/tests/geometry/sphere_4.obj")
+    matrix, _ = Compartment.get_voxelized_mesh(mesh, 1.0)
+    monkeypatch.setattr(Compartment, "voxelized_meshes_max_size", 2 * matrix.nbytes)
+    Compartment.get_voxelized_mesh(mesh, 1.0, hollow=True)
+    # a hit makes the filled matrix the most recently used
+    Compartment.get_voxelized_mesh(mesh, 1.0)
+    other_mesh = mesh.copy().apply_translation([0.25, 0.0, 0.0])
+    other_matrix, _ = Compartment.get_voxelized_mesh(other_mesh, 1.0)
+    assert other_matrix.nbytes == matrix.nbytes
+    assert list(voxelized_meshes) == [
+        (hash(mesh), 1.0, False),
+        (hash(other_mesh), 1.0, False),
+    ]
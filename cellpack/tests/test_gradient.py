@@ -0,0 +1,38 @@
+import numpy
+import pytest
+
+from cellpack.autopack.BaseGrid import BaseGrid
+from cellpack.autopack.Gradient import Gradient
+
+
+def make_gradient(mode, compact_weights):
+    return Gradient(
+        {
+            "name": mode,
+            "description": "",
+            "mode": mode,
+            "weight_mode": "linear",
+            "pick_mode": "rnd",
+            "mode_settings": {"center": [20, 20, 20], "direction": [1, 1, 0]},
+            "weight_mode_settings": {},
+            "invert": None,
+        },
+        compact_weights=compact_weights,
+    )
+
+
+@pytest.mark.parametrize("mode", ["X", "vector", "radial", "uniform"])
+def test_compact_weights(mode):
+    grid = BaseGrid(boundingBox=([0, 0, 0], [40, 40, 40]), spacing=5)
+    bounding_box = numpy.array(grid.boundingBox)
+    gradient = make_gradient(mode, False)
+    compact_gradient = make_gradient(mode, True)
+    gradient.build_weight_map(bounding_box, grid.masterGridPositions)
+    compact_gradient.build_weight_map(bounding_box, grid.masterGridPositions)
+
+    assert compact_gradient.weight.dtype == numpy.float16
+    assert numpy.allclose(compact_gradient.weight, gradient.weight, atol=1e-3)
+    points = numpy.arange(0, grid.gridVolume, 7)
+    weights = compact_gradient.get_weights(points)
+    assert weights.dtype == numpy.float64
+    assert numpy.allclose(weights, gradient.get_weights(points), atol=1e-3)
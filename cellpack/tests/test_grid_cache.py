@@ -0,0 +1,81 @@
+import os
+from types import SimpleNamespace
+
+from cellpack.autopack.BaseGrid import BaseGrid
+from cellpack.autopack.GridCache import GridCache
+
+
+def write_grid(size):
+    def save(path):
+        os.makedirs(path)
+        with open(os.path.join(path, "grid.npy"), "wb") as file_obj:
+            file_obj.write(b"0" * size)
+
+    return save
+
+
+def test_get_counts_hits_and_misses(tmp_path):
+    cache = GridCache(tmp_path, max_size=1000)
+    key = "a" * GridCache.key_length
+    assert cache.get(key) is None
+    path = cache.store(key, write_grid(10))
+    assert cache.get(key) == path
+    assert cache.get_stats() == {"hits": 1, "misses": 1}
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_store_evicts_least_recently_used(tmp_path):
+    cache = GridCache(tmp_path, max_size=300)
+    keys = [str(index) * GridCache.key_length for index in range(3)]
+    for age, key in enumerate(keys):
+        path = cache.store(key, write_grid(100))
+        os.utime(path, (age, age))
+    cache.max_size = 250
+    # the oldest grid is used again, the second one is now the least recently used
+    assert cache.get(keys[0]) is not None
+    cache.store("3" * GridCache.key_length, write_grid(100))
+    assert cache.get_path(keys[0]).is_dir()
+    assert not cache.get_path(keys[1]).is_dir()
+    assert not cache.get_path(keys[2]).is_dir()
+
+
+def test_evict_keeps_other_files_and_new_grid(tmp_path):
+    other_file = tmp_path / "recipe_grid"
+    write_grid(100)(other_file)
+    cache = GridCache(tmp_path, max_size=10)
+    path = cache.store("b" * GridCache.key_length, write_grid(100))
+    assert path.is_dir()
+    assert other_file.is_dir()
+
+
+def test_key_depends_on_grid_inputs():
+    compartment = SimpleNamespace(
+        name="sphere",
+        type="single_sphere",
+        gname="sphere",
+        ghost=None,
+        radius=25.0,
+        position=[0, 0, 0],
+        scale=1.0,
+        bounding_box=None,
+    )
+    env = SimpleNamespace(
+        innerGridMethod="trimesh",
+        boundingBox=[[0, 0, 0], [100, 100, 100]],
+        fbox_bb=None,
+        implicit_lattice=False,
+        compartments=[compartment],
+        mesh_store=None,
+    )
+    key = GridCache.get_key(env, BaseGrid, 10)
+    assert len(key) == GridCache.key_length
+    assert GridCache.get_key(env, BaseGrid, 10) == key
+    assert GridCache.get_key(env, BaseGrid, 5) != key
+    env.innerGridMethod = "raytrace"
+    assert GridCache.get_key(env, BaseGrid, 10) != key
+    env.innerGridMethod = "trimesh"
+    env.implicit_lattice = True
+    assert GridCache.get_key(env, BaseGrid, 10) != key
+    env.implicit_lattice = False
+    compartment.radius = 30.0
+    assert GridCache.get_key(env, BaseGrid, 10) != key
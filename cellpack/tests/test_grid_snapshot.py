@@ -0,0 +1,99 @@
+import pickle
+from types import SimpleNamespace
+
+import numpy
+import trimesh
+from scipy import spatial
+
+from cellpack.autopack.BaseGrid import BaseGrid
+from cellpack.autopack.Environment import Environment
+from cellpack.autopack.GridSnapshot import GridSnapshot, LazyKDTree
+from cellpack.autopack.MeshStore import MeshStore
+
+
+def make_env():
+    grid = BaseGrid(boundingBox=([0, 0, 0], [40, 40, 40]), spacing=10)
+    mesh = trimesh.creation.icosphere(radius=10.0)
+    mesh.vertices += 20
+    surface_points = [0, 5, 9]
+    grid.compartment_ids[surface_points] = 1
+    grid.compartment_ids[[21, 22]] = -1
+    grid.distToClosestSurf_store = grid.distToClosestSurf.copy()
+    grid.aInteriorGrids = [numpy.array([21, 22])]
+    grid.aSurfaceGrids = [surface_points]
+    grid.set_surfPtsBht(grid.masterGridPositions[surface_points])
+    compartment = SimpleNamespace(
+        name="sphere",
+        gname="sphere",
+        faces=mesh.faces,
+        vertices=mesh.vertices,
+        vnormals=mesh.vertex_normals,
+        filename="sphere.obj",
+        ref_obj="sphere",
+        bb=(mesh.vertices.min(0), mesh.vertices.max(0)),
+        center=numpy.array([20.0, 20.0, 20.0]),
+        encapsulating_radius=numpy.float64(10.0),
+        radius=numpy.float64(9.5),
+        insidePoints=numpy.array([21, 22], dtype=numpy.int32),
+        surfacePoints=surface_points,
+        surfacePointsCoords=[grid.masterGridPositions[i] for i in surface_points],
+        surfacePointsNormals={i: numpy.array([0.0, 0.0, 1.0]) for i in surface_points},
+        surface_normal_rows=None,
+        surface_normals=None,
+        ogsurfacePoints=mesh.vertices,
+        ogsurfacePointsNormals=mesh.vertex_normals,
+        OGsrfPtsBht=spatial.cKDTree(mesh.vertices),
+        closestId=numpy.arange(grid.gridVolume),
+    )
+    return SimpleNamespace(
+        grid=grid,
+        compartments=[compartment],
+        mesh_store=MeshStore(),
+        get_attributes_to_update=Environment.get_attributes_to_update,
+    )
+
+
+def test_snapshot_round_trip(tmp_path):
+    env = make_env()
+    GridSnapshot.save(env, tmp_path / "grid")
+    assert GridSnapshot.is_snapshot(tmp_path / "grid")
+
+    restored = make_env()
+    for name in Environment.get_attributes_to_update():
+        setattr(restored.compartments[0], name, None)
+    GridSnapshot.load(restored, tmp_path / "grid", BaseGrid)
+
+    grid = restored.grid
+    assert isinstance(grid.masterGridPositions, numpy.memmap)
+    assert not grid.masterGridPositions.flags.writeable
+    assert numpy.array_equal(grid.masterGridPositions, env.grid.masterGridPositions)
+    assert numpy.array_equal(grid.compartment_ids, env.grid.compartment_ids)
+    assert grid.gridVolume == env.grid.gridVolume
+    assert type(grid.gridSpacing) is type(env.grid.gridSpacing)
+    assert numpy.all(grid.distToClosestSurf == env.grid.diag)
+    assert grid.nbFreePoints == len(env.grid.free_points)
+    assert grid.surfPtsBht.query(env.grid.masterGridPositions[5])[1] == 1
+
+    compartment = restored.compartments[0]
+    original = env.compartments[0]
+    assert numpy.array_equal(compartment.surfacePoints, original.surfacePoints)
+    assert compartment.surface_normals is None
+    assert compartment.radius == original.radius
+    assert (
+        compartment.surfacePointsNormals.keys() == original.surfacePointsNormals.keys()
+    )
+    assert isinstance(compartment.OGsrfPtsBht, LazyKDTree)
+    point = original.ogsurfacePoints[3]
+    assert compartment.OGsrfPtsBht.query(point) == original.OGsrfPtsBht.query(point)
+    mesh = restored.mesh_store.get_object("sphere")
+    assert numpy.array_equal(mesh.faces, original.faces)
+
+
+def test_lazy_kd_tree_is_built_on_first_query():
+    points = numpy.random.default_rng(0).uniform(0, 1, (20, 3))
+    tree = LazyKDTree(points)
+    assert tree.tree is None
+    assert tree.query(points[4])[1] == 4
+    assert tree.tree is not None
+    unpickled = pickle.loads(pickle.dumps(tree))
+    assert unpickled.query(points[7])[1] == 7
@@ -0,0 +1,230 @@
+import concurrent.futures
+from types import SimpleNamespace
+
+import numpy
+import pytest
+import tifffile
+import trimesh
+
+from cellpack.autopack.Compartment import Compartment
+from cellpack.autopack.Environment import Environment
+from cellpack.autopack.MeshStore import MeshStore
+from cellpack.autopack.ingredient import SingleSphereIngr
+from cellpack.autopack.ingredient.single_cube import SingleCubeIngr
+from cellpack.autopack.interface_objects.packed_objects import (
+    PackedObject,
+    PackedObjects,
+)
+from cellpack.autopack.writers.ImageWriter import ImageWriter
+
+
+class PackingEnv(SimpleNamespace):
+    create_voxelization = Environment.create_voxelization
+    get_voxelization_channels = Environment.get_voxelization_channels
+    get_voxelization_bounds = Environment.get_voxelization_bounds
+    create_voxelization_tile = Environment.create_voxelization_tile
+
+
+class MeshCompartment(SimpleNamespace):
+    create_voxelization = Compartment.create_voxelization
+    create_voxelized_mask = Compartment.create_voxelized_mask
+    get_voxelized_mesh = staticmethod(Compartment.get_voxelized_mesh)
+
+
+@pytest.fixture
+def env(tmp_path):
+    mesh_store = MeshStore()
+    mesh_store.add_mesh_to_scene(
+        trimesh.load("cellpack/tests/geometry/sphere_4.obj"), "sphere_4"
+    )
+    compartment = MeshCompartment(
+        name="compartment",
+        gname="sphere_4",
+        color=[0.5, 0.5, 1.0],
+        encapsulating_radius=4.0,
+    )
+    packed_objects = PackedObjects()
+    packed_objects.add(
+        PackedObject(
+            position=numpy.array([9.0, 8.0, 6.0]),
+            rotation=numpy.identity(4),
+            radius=4.0,
+            pt_index=None,
+            ingredient=compartment,
+            is_compartment=True,
+        )
+    )
+    rng = numpy.random.default_rng(0)
+    sphere = SingleSphereIngr(radius=1.5, name="sphere", color=[1.0, 0.0, 0.0])
+    cube = SingleCubeIngr(
+        bounds=[[-2, -1, -1], [2, 1, 1]], name="cube", color=[0.0, 1.0, 0.0]
+    )
+    for index in range(30):
+        ingredient = [sphere, cube][index % 2]
+        rotation = numpy.identity(4)
+        rotation[:3, :3] = trimesh.transformations.random_rotation_matrix(
+            rng.random(3)
+        )[:3, :3]
+        packed_objects.add(
+            PackedObject(
+                position=rng.uniform(-2, [22, 18, 14]),
+                rotation=rotation,
+                radius=ingredient.encapsulating_radius,
+                pt_index=index,
+                ingredient=ingredient,
+            )
+        )
+    return PackingEnv(
+        boundingBox=numpy.array([[0.0, 0.0, 0.0], [20.0, 16.0, 12.0]]),
+        packed_objects=packed_objects,
+        mesh_store=mesh_store,
+        out_folder=tmp_path,
+    )
+
+
+def export_images(env, tmp_path, **options):
+    in_memory = ImageWriter(env, name="in_memory", output_path=tmp_path, **options)
+    env.create_voxelization(in_memory)
+    in_memory.export_image()
+    chunked = ImageWriter(
+        env, name="chunked", output_path=tmp_path, chunk_size=[7, 5, 4], **options
+    )
+    chunked.export_image_chunked()
+    return (
+        tmp_path / "voxelized_image_in_memory.ome.tiff",
+        tmp_path / "voxelized_image_chunked.ome.tiff",
+    )
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"voxel_size": [1, 1, 1]},
+        {"voxel_size": [0.5, 1, 1.5], "projection_axis": "x"},
+        {
+            "voxel_size": [1, 1, 1],
+            "convolution_options": {
+                "psf": "gaussian",
+                "psf_parameters": {"sigma": 1.0, "size": [5, 3, 4]},
+            },
+        },
+        {
+            "voxel_size": [1, 1, 1],
+            "hollow": True,
+            "projection_axis": "y",
+            "convolution_options": {"psf": "box"},
+        },
+    ],
+)
+def test_chunked_export_matches_in_memory_export(env, tmp_path, options):
+    in_memory_path, chunked_path = export_images(env, tmp_path, **options)
+    with tifffile.TiffFile(in_memory_path) as in_memory:
+        expected = in_memory.asarray()
+        expected_description = in_memory.pages[0].description
+    with tifffile.TiffFile(chunked_path) as chunked:
+        image = chunked.asarray()
+        description = chunked.pages[0].description
+    assert expected.shape[1] == 3
+    assert numpy.all(expected.max(axis=(0, 2, 3)) > 0)
+    assert numpy.array_equal(image, expected)
+    assert description == expected_description
+
+
+def test_chunked_export_to_zarr(env, tmp_path):
+    zarr = pytest.importorskip("zarr")
+    in_memory_path, _ = export_images(env, tmp_path, voxel_size=[1, 1, 1])
+    writer = ImageWriter(
+        env,
+        name="chunked",
+        output_path=tmp_path,
+        voxel_size=[1, 1, 1],
+        chunk_size=8,
+        image_format="ome.zarr",
+    )
+    writer.export_image_chunked()
+    group = zarr.open_group(tmp_path / "voxelized_image_chunked.ome.zarr", mode="r")
+    expected = tifffile.imread(in_memory_path)
+    assert numpy.array_equal(group["0"][:], expected.swapaxes(0, 1))
+    channels = group.attrs["omero"]["channels"]
+    assert [channel["label"] for channel in channels] == [
+        "compartment",
+        "sphere",
+        "cube",
+    ]
+    assert channels[1]["color"] == "FF0000"
+
+
+@pytest.mark.parametrize(
+    "psf",
+    [
+        ImageWriter.create_gaussian_psf(sigma=2.0, size=[7, 5, 6]),
+        ImageWriter.create_box_psf([4, 5, 3]),
+        numpy.random.default_rng(1).random((5, 4, 3)),
+    ],
+)
+def test_convolution_backends_match_direct(psf):
+    psf = psf / psf.sum()
+    rng = numpy.random.default_rng(0)
+    channel = numpy.where(rng.random((24, 20, 16)) < 0.1, 255, 0).astype(numpy.uint8)
+    expected = ImageWriter.convolve_channel(channel, psf, backend="direct")
+    backends = ["fft"]
+    if ImageWriter.get_separable_psf(psf) is not None:
+        backends.append("separable")
+    for backend in backends:
+        conv_channel = ImageWriter.convolve_channel(channel, psf, backend=backend)
+        # the float rounding can only move a value across an integer
+        assert numpy.abs(conv_channel.astype(int) - expected).max() <= 1
+
+
+def test_choose_convolution_backend():
+    assert ImageWriter.choose_convolution_backend(ImageWriter.create_box_psf()) == (
+        "direct"
+    )
+    gaussian_psf = ImageWriter.create_gaussian_psf(sigma=3.0, size=[15, 15, 15])
+    assert ImageWriter.choose_convolution_backend(gaussian_psf) == "separable"
+    random_psf = numpy.random.default_rng(0).random((5, 5, 5))
+    assert ImageWriter.get_separable_psf(random_psf) is None
+    assert ImageWriter.choose_convolution_backend(random_psf) == "fft"
+    with pytest.raises(ValueError):
+        ImageWriter.convolve_channel(
+            numpy.zeros((4, 4, 4), dtype=numpy.uint8), random_psf, "separable"
+        )
+
+
+def test_chunked_export_uses_one_thread_pool_and_no_fft(env, tmp_path, monkeypatch):
+    psf = numpy.random.default_rng(1).random((5, 4, 3))
+    in_memory = ImageWriter(
+        env,
+        name="in_memory",
+        output_path=tmp_path,
+        voxel_size=[1, 1, 1],
+        convolution_options={"psf": psf, "backend": "direct"},
+    )
+    env.create_voxelization(in_memory)
+    in_memory.export_image()
+
+    pools = []
+    thread_pool_executor = concurrent.futures.ThreadPoolExecutor
+
+    def counting_thread_pool_executor(*args, **kwargs):
+        pools.append(args)
+        return thread_pool_executor(*args, **kwargs)
+
+    monkeypatch.setattr(
+        concurrent.futures, "ThreadPoolExecutor", counting_thread_pool_executor
+    )
+    chunked = ImageWriter(
+        env,
+        name="chunked",
+        output_path=tmp_path,
+        voxel_size=[1, 1, 1],
+        convolution_options={"psf": psf},
+        chunk_size=[7, 5, 4],
+    )
+    chunked.export_image_chunked()
+    assert len(pools) == 1
+    assert ImageWriter.choose_convolution_backend(psf) == "fft"
+    assert numpy.array_equal(
+        tifffile.imread(tmp_path / "voxelized_image_chunked.ome.tiff"),
+        tifffile.imread(tmp_path / "voxelized_image_in_memory.ome.tiff"),
+    )
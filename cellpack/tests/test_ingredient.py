@@ -1,5 +1,10 @@
+from random import seed
+from types import SimpleNamespace
+
+import numpy
 import pytest
-from ..autopack.ingredient import Ingredient
+from ..autopack.ingredient import Ingredient, SingleSphereIngr
+from ..autopack.randomRot import RandomRot
 
 
 @pytest.mark.parametrize(
@@ -111,3 +116,52 @@ def test_validate_ingredient_info(ingredient_info, output):
         assert validated_info == output
     except Exception as e:
         assert str(e) == output
+
+
+def test_new_distances_and_inside_points_from_arrays():
+    ingr = SingleSphereIngr(radius=2.0, name="test")
+    rng = numpy.random.default_rng(0)
+    grid_distances = rng.uniform(0, 5, size=50)
+    points = rng.integers(0, 50, size=200)
+    signed_distances = rng.uniform(-3, 6, size=200)
+    inside_points = {}
+    new_dist_points = {}
+    for point, signed_distance in zip(points.tolist(), signed_distances.tolist()):
+        inside_points, new_dist_points = ingr.get_new_distances_and_inside_points(
+            None,
+            None,
+            None,
+            point,
+            grid_distances,
+            new_dist_points,
+            inside_points,
+            signed_distance,
+        )
+    inside, new_dist = ingr.get_new_distances_and_inside_points_from_arrays(
+        points, signed_distances, grid_distances
+    )
+    assert inside[0].tolist() == list(inside_points.keys())
+    assert numpy.allclose(inside[1], list(inside_points.values()))
+    assert new_dist[0].tolist() == list(new_dist_points.keys())
+    assert numpy.allclose(new_dist[1], list(new_dist_points.values()))
+
+
+def test_rewind_jitter_candidates():
+    env = SimpleNamespace(
+        grid=SimpleNamespace(gridSpacing=4.0), randomRot=RandomRot(seed=3)
+    )
+    ingr = SingleSphereIngr(radius=2.0, name="test", jitter_attempts=6)
+    ingr.compartment_id = 0
+    ingr.rotation_range = 2 * numpy.pi
+    seed(7)
+    start = ingr.get_random_state(env)
+    locations, rotations = ingr.get_jitter_candidates(env, (0, 0, 0), numpy.identity(4))
+    assert len(locations) == len(rotations) == 6
+
+    # after the rewind, the next draws are those of the attempts after the third
+    ingr.rewind_jitter_candidates(env, start, (0, 0, 0), numpy.identity(4), 3)
+    next_locations, next_rotations = ingr.get_jitter_candidates(
+        env, (0, 0, 0), numpy.identity(4), 3
+    )
+    assert numpy.array_equal(next_locations, locations[3:])
+    assert numpy.array_equal(next_rotations, rotations[3:])
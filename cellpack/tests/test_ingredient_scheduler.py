@@ -0,0 +1,73 @@
+import random
+from unittest.mock import MagicMock
+
+import numpy
+import pytest
+from cellpack.autopack.IngredientScheduler import FenwickTree, IngredientScheduler
+
+
+def make_ingredient(name, priority):
+    ingredient = MagicMock(priority=priority)
+    ingredient.name = name
+    return ingredient
+
+
+def legacy_pick(active_ingredients):
+    # cumulative threshold scan the scheduler replaces
+    priorities = [ingredient.priority for ingredient in active_ingredients]
+    thresholds = numpy.cumsum(priorities) / sum(priorities)
+    prob = random.uniform(0, 1.0)
+    for index, threshold in enumerate(thresholds):
+        if prob <= threshold:
+            return active_ingredients[index]
+    return active_ingredients[0]
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_fenwick_find_matches_cumulative_sum(seed):
+    rng = numpy.random.default_rng(seed)
+    weights = rng.uniform(0, 1, 37)
+    weights[rng.choice(37, 5)] = 0.0
+    tree = FenwickTree(weights)
+    cumulative = numpy.cumsum(weights)
+    assert tree.total() == pytest.approx(cumulative[-1])
+    for value in rng.uniform(1e-9, cumulative[-1] * 0.999, 100):
+        assert tree.find(value) == numpy.searchsorted(cumulative, value)
+    assert tree.find(cumulative[-1] + 1.0) is None
+
+
+def test_negative_priorities_are_picked_first():
+    first = make_ingredient("first", -2)
+    second = make_ingredient("second", -1)
+    weighted = make_ingredient("weighted", 1.0)
+    scheduler = IngredientScheduler([first, second], [weighted])
+    assert scheduler.pick() is first
+    assert scheduler.get_normalized_priority(first) == 0.0
+    scheduler.remove(first)
+    assert scheduler.pick() is second
+    scheduler.remove(second)
+    assert scheduler.pick() is weighted
+    assert scheduler.active_ingredients == [weighted]
+
+
+def test_picks_match_the_threshold_scan():
+    ingredients = [
+        make_ingredient(str(index), priority)
+        for index, priority in enumerate([5.0, 1.0, 0.5, 3.0, 0.25, 2.0])
+    ]
+    random.seed(0)
+    scheduler = IngredientScheduler([], ingredients)
+    legacy_active = list(ingredients)
+    for step in range(200):
+        state = random.getstate()
+        picked = scheduler.pick()
+        random.setstate(state)
+        assert picked is legacy_pick(legacy_active)
+        if step % 40 == 39:
+            scheduler.remove(picked)
+            legacy_active.remove(picked)
+    assert scheduler.active_ingredients == legacy_active
+    total = sum(ingredient.priority for ingredient in legacy_active)
+    assert scheduler.get_normalized_priority(legacy_active[0]) == pytest.approx(
+        legacy_active[0].priority / total
+    )
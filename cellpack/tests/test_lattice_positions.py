@@ -0,0 +1,109 @@
+import numpy
+import pytest
+
+from cellpack.autopack.BaseGrid import BaseGrid, LatticeIndices, LatticePositions
+from cellpack.autopack.GridSnapshot import GridSnapshotReader, GridSnapshotWriter
+
+bounding_box = ([0, 0, 0], [50, 30, 40])
+
+
+def make_grids():
+    dense = BaseGrid(boundingBox=bounding_box, spacing=10)
+    implicit = BaseGrid(boundingBox=bounding_box, spacing=10, implicit_lattice=True)
+    return dense, implicit
+
+
+def test_implicit_grid_matches_dense_grid():
+    dense, implicit = make_grids()
+    assert isinstance(implicit.masterGridPositions, LatticePositions)
+    assert isinstance(implicit.ijkPtIndice, LatticeIndices)
+    assert implicit.gridVolume == dense.gridVolume
+    assert len(implicit.masterGridPositions) == len(dense.masterGridPositions)
+    assert numpy.array_equal(
+        numpy.asarray(implicit.masterGridPositions), dense.masterGridPositions
+    )
+    assert numpy.array_equal(numpy.asarray(implicit.ijkPtIndice), dense.ijkPtIndice)
+    assert numpy.array_equal(implicit.free_points, dense.free_points)
+
+
+@pytest.mark.parametrize(
+    "key",
+    [
+        7,
+        -1,
+        slice(None),
+        slice(3, 50, 4),
+        numpy.array([0, 12, 5, 5, -2]),
+        [[1, 2], [3, 4]],
+        (slice(None), 1),
+        (numpy.array([4, 9]), 2),
+        (11, 0),
+    ],
+)
+def test_lattice_indexing(key):
+    dense, implicit = make_grids()
+    for lattice, array in (
+        (implicit.masterGridPositions, dense.masterGridPositions),
+        (implicit.ijkPtIndice, dense.ijkPtIndice),
+    ):
+        assert numpy.array_equal(lattice[key], array[key])
+
+
+def test_lattice_mask_and_take():
+    dense, implicit = make_grids()
+    mask = numpy.zeros(dense.gridVolume, dtype=bool)
+    mask[[2, 30, 31]] = True
+    assert numpy.array_equal(
+        implicit.masterGridPositions[mask], dense.masterGridPositions[mask]
+    )
+    points = numpy.array([8, 1, 40])
+    assert numpy.array_equal(
+        numpy.take(implicit.masterGridPositions, points, axis=0),
+        dense.masterGridPositions[points],
+    )
+    with pytest.raises(IndexError):
+        implicit.masterGridPositions[dense.gridVolume]
+
+
+def test_off_grid_positions():
+    dense, implicit = make_grids()
+    positions = numpy.array([[1.5, 2.5, 3.5], [4.0, 5.0, 6.0]])
+    dense.add_off_grid_positions(positions)
+    implicit.add_off_grid_positions(positions)
+    assert dense.masterGridPositions.dtype == implicit.masterGridPositions.dtype
+    assert numpy.array_equal(
+        numpy.asarray(implicit.masterGridPositions), dense.masterGridPositions
+    )
+    points = numpy.array([-1, 0, dense.gridVolume, 3])
+    assert numpy.array_equal(
+        implicit.masterGridPositions[points], dense.masterGridPositions[points]
+    )
+
+
+def test_points_in_sphere_positions():
+    dense, implicit = make_grids()
+    point = numpy.array([20.0, 12.0, 18.0])
+    points = implicit.getPointsInSphere(point, 15)
+    assert numpy.array_equal(points, dense.getPointsInSphere(point, 15))
+    assert numpy.array_equal(
+        implicit.masterGridPositions[points], dense.masterGridPositions[points]
+    )
+
+
+def test_snapshot_of_lattice_arrays(tmp_path):
+    _, implicit = make_grids()
+    implicit.add_off_grid_positions([[1.0, 2.0, 3.0]])
+    writer = GridSnapshotWriter(tmp_path)
+    writer.save_array("positions", implicit.masterGridPositions)
+    writer.save_array("ijk", implicit.ijkPtIndice)
+    reader = GridSnapshotReader(tmp_path, writer.manifest)
+
+    positions = reader.load_array("positions")
+    assert isinstance(positions, LatticePositions)
+    assert positions.dtype == implicit.masterGridPositions.dtype
+    assert numpy.array_equal(
+        numpy.asarray(positions), numpy.asarray(implicit.masterGridPositions)
+    )
+    ijk = reader.load_array("ijk")
+    assert isinstance(ijk, LatticeIndices)
+    assert numpy.array_equal(numpy.asarray(ijk), numpy.asarray(implicit.ijkPtIndice))
@@ -0,0 +1,27 @@
+import numpy
+import trimesh
+from cellpack.autopack.MeshStore import MeshStore
+
+
+def test_scaled_distances_between_spheres():
+    inner_mesh = trimesh.creation.icosphere(radius=2.0)
+    outer_mesh = trimesh.creation.icosphere(radius=4.0)
+    rng = numpy.random.default_rng(0)
+    directions = rng.normal(size=(200, 3))
+    directions /= numpy.linalg.norm(directions, axis=1)[:, None]
+    positions = directions * rng.uniform(2.2, 3.8, (200, 1))
+    scaled, between, inner_distances = MeshStore.calc_scaled_distances_for_positions(
+        positions, inner_mesh, outer_mesh, chunk_size=64
+    )
+    inner_loc, _, _ = trimesh.proximity.ProximityQuery(inner_mesh).on_surface(positions)
+    for index, position in enumerate(positions):
+        # first hit of the same ray cast alone
+        hits, _, _ = outer_mesh.ray.intersects_location(
+            ray_origins=[inner_loc[index]],
+            ray_directions=[position - inner_loc[index]],
+        )
+        assert numpy.isclose(
+            between[index], numpy.linalg.norm(hits[0] - inner_loc[index])
+        )
+    assert numpy.all((scaled >= 0) & (scaled <= 1))
+    assert numpy.allclose(scaled, inner_distances / between)
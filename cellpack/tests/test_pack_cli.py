@@ -88,3 +88,53 @@ def test_pack_with_default_config(tmp_path, monkeypatch, recipe_data):
     # default `out: "out/"` is relative, monkeypatch.chdir keeps outputs inside tmp_path.
     monkeypatch.chdir(tmp_path)
     pack(recipe=recipe_data)
+    # the grid cache is in the out folder too
+    assert list((tmp_path / "out" / "grid_cache").glob("*_grid"))
+
+
+def test_parallel_pack_with_surface_ingredients(tmp_path):
+    """The seed workers keep the surface points of the shared grid"""
+    recipe = {
+        "version": "1.0.0",
+        "format_version": "2.0",
+        "name": "test_parallel_surface",
+        "bounding_box": [[0, 0, 0], [200, 200, 200]],
+        "objects": {
+            "sphere_60": {"type": "single_sphere", "radius": 60},
+            "sphere_8": {
+                "type": "single_sphere",
+                "radius": 8,
+                "place_method": "spheresSST",
+            },
+        },
+        "composition": {
+            "space": {"regions": {"interior": ["compartment"]}},
+            "compartment": {
+                "object": "sphere_60",
+                "count": 1,
+                "regions": {
+                    "interior": [{"object": "sphere_8", "count": 5}],
+                    "surface": [{"object": "sphere_8", "count": 5}],
+                },
+            },
+        },
+    }
+    config = {
+        "name": "test_parallel_surface",
+        "out": f"{tmp_path}/",
+        "parallel": True,
+        "number_of_packings": 2,
+        "spacing": 8,
+        "save_analyze_result": False,
+        "save_plot_figures": False,
+        "show_progress_bar": False,
+        "load_from_grid_file": False,
+    }
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps(config))
+    pack(recipe=recipe, config_path=str(config_path))
+    (positions_path,) = tmp_path.glob("**/positions_*.json")
+    positions = json.loads(positions_path.read_text())
+    assert len(positions) == 2
+    for seed_positions in positions.values():
+        assert len(seed_positions["compartment_surface_sphere_8"]) == 5
@@ -0,0 +1,236 @@
+import numpy
+import pytest
+from unittest.mock import MagicMock
+from cellpack import autopack
+from cellpack.autopack import upy
+from cellpack.autopack.Environment import Environment
+from cellpack.autopack.interface_objects.packed_objects import (
+    PackedObject,
+    PackedObjects,
+)
+from cellpack.autopack.loaders.config_loader import ConfigLoader
+from cellpack.autopack.loaders.recipe_loader import RecipeLoader
+
+
+def make_packed_object(name, position, is_compartment=False):
+    ingredient = MagicMock(encapsulating_radius=2.0, color=[1, 0, 0])
+    ingredient.name = name
+    return PackedObject(
+        position=position,
+        rotation=numpy.identity(4),
+        radius=1.0,
+        pt_index=len(position),
+        ingredient=ingredient,
+        is_compartment=is_compartment,
+    )
+
+
+def test_packed_objects_columns():
+    packed_objects = PackedObjects(capacity=2)
+    packed_objects.add(make_packed_object("compartment", [0, 0, 0], True))
+    for i in range(5):
+        name = "A" if i % 2 == 0 else "B"
+        packed_objects.add(make_packed_object(name, [i, 0, 0]))
+
+    assert len(packed_objects.get_all()) == 6
+    assert len(packed_objects.get_ingredients()) == 5
+    assert len(packed_objects.get_compartment()) == 1
+    positions = packed_objects.get_positions()
+    assert positions.shape == (5, 3)
+    assert positions[:, 0].tolist() == [0, 1, 2, 3, 4]
+    assert packed_objects.get_encapsulating_radii().tolist() == [2.0] * 5
+    assert packed_objects.get_positions_for_ingredient("A")[:, 0].tolist() == [
+        0,
+        2,
+        4,
+    ]
+    assert packed_objects.get_rotations_for_ingredient("B").shape == (2, 4, 4)
+    assert len(packed_objects.get_positions_for_ingredient("C")) == 0
+    with pytest.raises(ValueError):
+        positions[0, 0] = 10.0
+
+
+def make_sphere_tree_object(position, rotation, positions, radii):
+    ingredient = MagicMock(encapsulating_radius=10.0, color=[1, 0, 0])
+    ingredient.name = "tree"
+    ingredient.positions = positions
+    ingredient.radii = radii
+    ingredient.transformPoints = lambda trans, rot, points: [
+        numpy.matmul(numpy.array(rot)[:3, :3], point) + trans for point in points
+    ]
+    return PackedObject(position, rotation, 10.0, None, ingredient=ingredient)
+
+
+def brute_force_overlaps(packed_objects, rows, level, positions, radii):
+    for row in rows:
+        packed_object = packed_objects.get_ingredients()[row]
+        ingredient = packed_object.ingredient
+        packed_positions = ingredient.transformPoints(
+            packed_object.position,
+            packed_object.rotation,
+            ingredient.positions[level],
+        )
+        for packed_position, packed_radius in zip(
+            packed_positions, ingredient.radii[level]
+        ):
+            for position, radius in zip(positions, radii):
+                if numpy.linalg.norm(packed_position - position) < (
+                    radius + packed_radius
+                ):
+                    return True
+    return False
+
+
+def test_level_spheres():
+    rng = numpy.random.default_rng(0)
+    packed_objects = PackedObjects(capacity=2)
+    packed_objects.add(make_packed_object("compartment", [0, 0, 0], True))
+    nb_spheres = [3, 5, 1, 4, 6, 2]
+    for i, count in enumerate(nb_spheres):
+        rotation = numpy.identity(4)
+        rotation[:3, :3] = numpy.linalg.qr(rng.normal(size=(3, 3)))[0]
+        packed_objects.add(
+            make_sphere_tree_object(
+                rng.uniform(0, 30, 3),
+                rotation,
+                [[[0, 0, 0]], rng.uniform(-5, 5, (count, 3))],
+                [[10.0], rng.uniform(1, 3, count)],
+            )
+        )
+        if i == 2:
+            # objects placed after the first call are added on the next one
+            assert len(packed_objects.get_level_spheres(1)) == sum(nb_spheres[:3])
+
+    level_spheres = packed_objects.get_level_spheres(1)
+    assert level_spheres.nb_objects == len(nb_spheres)
+    assert len(level_spheres) == sum(nb_spheres)
+    assert len(packed_objects.get_level_spheres(0)) == len(nb_spheres)
+
+    rows = numpy.array([4, 1])
+    positions, radii, owners = level_spheres.get_spheres(rows)
+    assert owners.tolist() == [4] * 6 + [1] * 5
+    packed_object = packed_objects.get_ingredients()[4]
+    assert numpy.allclose(
+        positions[:6],
+        packed_object.ingredient.transformPoints(
+            packed_object.position,
+            packed_object.rotation,
+            packed_object.ingredient.positions[1],
+        ),
+    )
+    assert numpy.array_equal(radii[:6], packed_object.ingredient.radii[1])
+
+    for _ in range(50):
+        positions = rng.uniform(-5, 35, (4, 3))
+        radii = rng.uniform(0.5, 2, 4)
+        rows = rng.choice(len(nb_spheres), 3, replace=False)
+        assert level_spheres.overlaps(rows, positions, radii) == brute_force_overlaps(
+            packed_objects, rows, 1, positions, radii
+        )
+
+    queries = rng.uniform(-5, 35, (30, 4, 3))
+    query_rows = [rng.choice(len(nb_spheres), 2, replace=False) for _ in queries]
+    query_indices = numpy.repeat(numpy.arange(len(queries)), 2)
+    radii = rng.uniform(0.5, 2, 4)
+    overlapping = level_spheres.overlaps_queries(
+        query_indices, numpy.concatenate(query_rows), queries, radii
+    )
+    assert overlapping.tolist() == [
+        level_spheres.overlaps(rows, positions, radii)
+        for rows, positions in zip(query_rows, queries)
+    ]
+    assert overlapping.any() and not overlapping.all()
+
+
+def test_level_spheres_without_tree_level():
+    packed_objects = PackedObjects()
+    single_sphere = make_packed_object("single", [1, 2, 3])
+    single_sphere.ingredient.positions = None
+    packed_objects.add(single_sphere)
+    packed_objects.add(
+        make_sphere_tree_object([10, 0, 0], numpy.identity(4), [[[0, 0, 0]]], [[10.0]])
+    )
+    positions, radii, owners = packed_objects.get_level_spheres(1).get_spheres(
+        numpy.array([0, 1])
+    )
+    # the encapsulating sphere, and the deepest level of the shallower tree
+    assert numpy.array_equal(positions, [[1, 2, 3], [10, 0, 0]])
+    assert radii.tolist() == [2.0, 10.0]
+    assert owners.tolist() == [0, 1]
+
+
+def test_mixed_single_and_multi_sphere_packing(tmp_path):
+    (tmp_path / "tree.sph").write_text("6 12\n2\n1\n0 0 0 12\n2\n-6 0 0 6\n6 0 0 6\n")
+    recipe = {
+        "version": "1.0.0",
+        "format_version": "2.0",
+        "name": "mixed_spheres",
+        "bounding_box": [[0, 0, 0], [100, 100, 1]],
+        "objects": {
+            "single": {"type": "single_sphere", "radius": 6},
+            "tree": {
+                "type": "multi_sphere",
+                "representations": {
+                    "packing": {
+                        "path": str(tmp_path),
+                        "name": "tree.sph",
+                        "format": "sph",
+                    }
+                },
+            },
+        },
+        "composition": {
+            "space": {
+                "regions": {
+                    "interior": [
+                        {"object": "single", "count": 40},
+                        {"object": "tree", "count": 40},
+                    ]
+                }
+            }
+        },
+    }
+    config = ConfigLoader().config
+    config.update(
+        out=f"{tmp_path}/",
+        place_method="spheresSST",
+        overwrite_place_method=True,
+        load_from_grid_file=False,
+        show_progress_bar=False,
+        randomness_seed=0,
+    )
+    recipe_data = RecipeLoader(recipe, False, False).recipe_data
+    helper = upy.getHelperClass()(vi="nogui")
+    autopack.helper = helper
+    env = Environment(config=config, recipe=recipe_data)
+    env.helper = helper
+    env.buildGrid(rebuild=True)
+    env.pack_grid(verbose=0, usePP=False)
+
+    spheres = []
+    for row, packed_object in enumerate(env.packed_objects.get_ingredients()):
+        ingredient = packed_object.ingredient
+        if getattr(ingredient, "positions", None) is None:
+            spheres.append(
+                (row, packed_object.position, packed_object.encapsulating_radius)
+            )
+            continue
+        for position, radius in zip(
+            ingredient.transformPoints(
+                packed_object.position,
+                packed_object.rotation,
+                ingredient.positions[-1],
+            ),
+            ingredient.radii[-1],
+        ):
+            spheres.append((row, position, radius))
+    assert len({type(o.ingredient) for o in env.packed_objects.get_ingredients()}) == 2
+    for row, position, radius in spheres:
+        for other_row, other_position, other_radius in spheres:
+            if row < other_row:
+                assert (
+                    numpy.linalg.norm(
+                        numpy.ravel(position)[:3] - numpy.ravel(other_position)[:3]
+                    )
+                    >= radius + other_radius - 1e-6
+                )
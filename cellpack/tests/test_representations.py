@@ -56,7 +56,9 @@ def test_pdb_url():
     assert representations.get_pdb_path() == "test_path/test.pdb"
 
 
-def test_sphere_tree():
+def test_sphere_tree(tmp_path, monkeypatch):
+    # keep the .npz sidecar of the sphere tree out of the source tree
+    monkeypatch.setitem(autopack.CACHE_DIR, "collisionTrees", tmp_path)
     autopack.CURRENT_RECIPE_PATH = os.path.dirname(".")
     representations = Representations(packing=test_sphere_tree_obj)
     assert len(representations.get_positions()) > 0
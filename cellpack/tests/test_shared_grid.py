@@ -0,0 +1,44 @@
+import concurrent.futures
+from types import SimpleNamespace
+
+import numpy
+import pytest
+from cellpack.autopack.SharedGrid import SharedGrid
+
+
+def make_grid():
+    return SimpleNamespace(
+        masterGridPositions=numpy.arange(30, dtype=float).reshape(10, 3),
+        compartment_ids=numpy.array([0, 0, -1, -1, 1, 1, 0, 0, 0, 0]),
+        distToClosestSurf_store=numpy.linspace(0, 1, 10),
+        distToClosestSurf=numpy.linspace(0, 1, 10),
+        free_points=numpy.arange(10),
+    )
+
+
+def sum_shared_arrays(specs):
+    grid = SimpleNamespace()
+    SharedGrid.attach(grid, specs)
+    return (
+        grid.masterGridPositions.sum(),
+        grid.compartment_ids.sum(),
+        grid.distToClosestSurf_store.sum(),
+    )
+
+
+def test_shared_grid_attach():
+    grid = make_grid()
+    with SharedGrid(grid) as shared_grid:
+        attached = SimpleNamespace()
+        SharedGrid.attach(attached, shared_grid.specs)
+        for name in SharedGrid.array_names:
+            assert numpy.array_equal(getattr(attached, name), getattr(grid, name))
+        with pytest.raises(ValueError):
+            attached.distToClosestSurf_store[0] = 2.0
+        with shared_grid.detached(grid):
+            assert grid.masterGridPositions is None
+            assert grid.free_points is None
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                sums = executor.submit(sum_shared_arrays, shared_grid.specs).result()
+        assert grid.free_points is not None
+        assert sums == (435.0, 0, 5.0)
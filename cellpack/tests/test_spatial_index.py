@@ -0,0 +1,45 @@
+import numpy
+import pytest
+from cellpack.autopack.SpatialIndex import SpatialHashGrid
+
+
+@pytest.mark.parametrize("cell_size, radius", [(5.0, 3.0), (5.0, 12.0), (1.0, 50.0)])
+def test_query_ball_point_matches_brute_force(cell_size, radius):
+    rng = numpy.random.default_rng(0)
+    positions = rng.uniform(-20, 20, size=(300, 3))
+    index = SpatialHashGrid(cell_size, capacity=16)
+    for position in positions:
+        index.add(position, radius=1.0)
+    assert len(index) == len(positions)
+    for point in rng.uniform(-25, 25, size=(20, 3)):
+        indices, distances = index.query_ball_point(point, radius, sort=True)
+        expected_distances = numpy.linalg.norm(positions - point, axis=1)
+        expected = numpy.nonzero(expected_distances <= radius)[0]
+        assert sorted(indices.tolist()) == expected.tolist()
+        assert numpy.allclose(distances, expected_distances[indices])
+        assert numpy.all(numpy.diff(distances) >= 0)
+
+
+def test_add_tracks_radii():
+    index = SpatialHashGrid(10.0)
+    index.add([0, 0, 0], radius=2.0)
+    index.add([30, 0, 0], radius=7.0)
+    assert index.max_radius == 7.0
+    assert index.radii[: len(index)].tolist() == [2.0, 7.0]
+
+
+def test_query_ball_points_matches_query_ball_point():
+    rng = numpy.random.default_rng(1)
+    index = SpatialHashGrid(5.0)
+    for position in rng.uniform(-20, 20, size=(200, 3)):
+        index.add(position, radius=1.0)
+    points = rng.uniform(-10, 10, size=(12, 3))
+    point_indices, indices, distances = index.query_ball_points(points, 6.0)
+    assert numpy.all(numpy.diff(point_indices) >= 0)
+    for point_index, point in enumerate(points):
+        expected_indices, expected_distances = index.query_ball_point(point, 6.0)
+        expected_order = numpy.argsort(expected_indices)
+        found = numpy.nonzero(point_indices == point_index)[0]
+        found = found[numpy.argsort(indices[found])]
+        assert indices[found].tolist() == expected_indices[expected_order].tolist()
+        assert numpy.array_equal(distances[found], expected_distances[expected_order])
@@ -0,0 +1,92 @@
+import os
+import shutil
+from pathlib import Path
+
+import numpy
+import pytest
+
+from cellpack import autopack
+from cellpack.autopack.loaders.sphere_tree_loader import SphereTreeLoader
+
+test_sphere_file = Path(__file__).parent / "geometry" / "test.sph"
+
+
+@pytest.fixture
+def sphere_file(tmp_path, monkeypatch):
+    monkeypatch.setitem(autopack.CACHE_DIR, "collisionTrees", tmp_path / "cache")
+    monkeypatch.setattr(SphereTreeLoader, "trees", {})
+    (tmp_path / "cache").mkdir()
+    path = tmp_path / "test.sph"
+    shutil.copy(test_sphere_file, path)
+    return path
+
+
+def read_nested_lists(path):
+    # the per line parse the loader replaces
+    with open(path) as f:
+        data = [x for x in f if x[0] != "#" and len(x) > 1 and x[0] != "\r"]
+    centers, radii = [], []
+    line = 2
+    for _ in range(int(data[1])):
+        nb_spheres = int(data[line])
+        rows = [list(map(float, x.split()[:4])) for x in data[line + 1 :][:nb_spheres]]
+        centers.append([row[:3] for row in rows])
+        radii.append([row[3] for row in rows])
+        line += nb_spheres + 1
+    return centers, radii
+
+
+def test_parse_matches_nested_lists(sphere_file):
+    centers, radii = SphereTreeLoader.load(str(sphere_file))
+    expected_centers, expected_radii = read_nested_lists(sphere_file)
+    assert [len(level) for level in radii] == [1, 3, 12]
+    for level in range(3):
+        assert centers[level].shape == (len(expected_radii[level]), 3)
+        assert numpy.array_equal(centers[level], expected_centers[level])
+        assert numpy.array_equal(radii[level], expected_radii[level])
+
+
+def test_load_is_memoized(sphere_file, monkeypatch):
+    centers, radii = SphereTreeLoader.load(str(sphere_file))
+    assert not centers[0].flags.writeable
+
+    def fail(lines):
+        raise AssertionError("the sphere tree was parsed again")
+
+    monkeypatch.setattr(SphereTreeLoader, "parse", fail)
+    other_centers, other_radii = SphereTreeLoader.load(str(sphere_file))
+    assert all(a is b for a, b in zip(centers, other_centers))
+    assert all(a is b for a, b in zip(radii, other_radii))
+
+
+def test_load_from_cache_file(sphere_file, monkeypatch):
+    centers, radii = SphereTreeLoader.load(str(sphere_file))
+    cache_files = list(Path(autopack.CACHE_DIR["collisionTrees"]).glob("*.npz"))
+    assert len(cache_files) == 1
+
+    # a new process only has the cache file
+    monkeypatch.setattr(SphereTreeLoader, "trees", {})
+    monkeypatch.setattr(SphereTreeLoader, "parse", None)
+    cached_centers, cached_radii = SphereTreeLoader.load(str(sphere_file))
+    for level in range(len(centers)):
+        assert numpy.array_equal(cached_centers[level], centers[level])
+        assert numpy.array_equal(cached_radii[level], radii[level])
+
+
+def test_modified_file_is_parsed_again(sphere_file):
+    SphereTreeLoader.load(str(sphere_file))
+    with open(sphere_file) as f:
+        content = f.read()
+    with open(sphere_file, "w") as f:
+        f.write(content.replace(" 0.00 0.00 0.00 100.00", " 1.00 2.00 3.00 90.00"))
+    stat = os.stat(sphere_file)
+    os.utime(sphere_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    centers, radii = SphereTreeLoader.load(str(sphere_file))
+    assert numpy.array_equal(centers[0], [[1.0, 2.0, 3.0]])
+    assert numpy.array_equal(radii[0], [90.0])
+
+
+def test_load_without_cache_file(sphere_file):
+    SphereTreeLoader.load(str(sphere_file), use_cache_file=False)
+    assert not list(Path(autopack.CACHE_DIR["collisionTrees"]).glob("*.npz"))
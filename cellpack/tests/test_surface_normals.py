@@ -0,0 +1,51 @@
+from types import SimpleNamespace
+
+import numpy
+import trimesh
+from cellpack.autopack.Compartment import Compartment
+from cellpack.autopack.MeshStore import MeshStore
+
+
+def make_mesh_store():
+    mesh_store = MeshStore()
+    mesh_store.add_mesh_to_scene(trimesh.creation.icosphere(radius=10.0), "sphere")
+    return mesh_store
+
+
+def test_get_normals_matches_get_normal():
+    mesh_store = make_mesh_store()
+    positions = numpy.random.default_rng(0).uniform(-12, 12, (50, 3))
+    normals = mesh_store.get_normals("sphere", positions)
+    for position, normal in zip(positions, normals):
+        assert numpy.array_equal(normal, mesh_store.get_normal("sphere", position))
+
+
+def test_build_surface_normals():
+    mesh_store = make_mesh_store()
+    positions = numpy.random.default_rng(1).uniform(-12, 12, (20, 3))
+    compartment_ids = numpy.zeros(20, dtype=int)
+    compartment_ids[[2, 5, 7, 19]] = 1
+    compartment_ids[[3, 4]] = -1
+    env = SimpleNamespace(
+        grid=SimpleNamespace(
+            masterGridPositions=positions, compartment_ids=compartment_ids
+        )
+    )
+    # normal set by BuildGrid for an off grid surface point
+    compartment = SimpleNamespace(
+        number=1, gname="sphere", surfacePointsNormals={19: [0.0, 0.0, 1.0]}
+    )
+    Compartment.build_surface_normals(compartment, env, mesh_store)
+    rows = compartment.surface_normal_rows
+    assert numpy.nonzero(rows >= 0)[0].tolist() == [2, 5, 7, 19]
+    assert rows[[2, 5, 7, 19]].tolist() == [0, 1, 2, 3]
+    for point in (2, 5, 7, 19):
+        normal = Compartment.get_normal_for_point(
+            compartment, point, positions[point], None
+        )
+        if point == 19:
+            assert normal.tolist() == [0.0, 0.0, 1.0]
+        else:
+            assert numpy.array_equal(
+                normal, mesh_store.get_normal("sphere", positions[point])
+            )
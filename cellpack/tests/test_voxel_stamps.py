@@ -0,0 +1,140 @@
+from types import SimpleNamespace
+
+import numpy
+import pytest
+from scipy.spatial.transform import Rotation
+
+from cellpack.autopack.ingredient import SingleSphereIngr
+from cellpack.autopack.ingredient.Ingredient import Ingredient
+from cellpack.autopack.ingredient.multi_sphere import MultiSphereIngr
+from cellpack.autopack.ingredient.single_cube import SingleCubeIngr
+from cellpack.autopack.ingredient.single_cylinder import SingleCylinderIngr
+
+bounding_box = numpy.array([[0.0, 0.0, 0.0], [40.0, 30.0, 20.0]])
+
+
+def voxel_positions(image_size, voxel_size):
+    X, Y, Z = numpy.meshgrid(*[numpy.arange(n) for n in image_size], indexing="ij")
+    return numpy.stack([X, Y, Z], axis=-1) * voxel_size + bounding_box[0]
+
+
+def random_rotation(seed):
+    rotation = numpy.identity(4)
+    rotation[:3, :3] = Rotation.random(random_state=seed).as_matrix()
+    return rotation
+
+
+@pytest.mark.parametrize(
+    "voxel_size", [numpy.array([1, 1, 1]), numpy.array([2.0, 1.5, 1.0])]
+)
+def test_sphere_voxelization_matches_circular_mask(voxel_size):
+    ingr = SingleSphereIngr(radius=4.5, name="sphere")
+    image_size = tuple(((bounding_box[1] - bounding_box[0]) / voxel_size).astype(int))
+    rng = numpy.random.default_rng(0)
+    # positions inside, across the edges and outside of the image
+    for position in rng.uniform(-8, 48, size=(20, 3)):
+        image_data = numpy.zeros(image_size, dtype=numpy.uint8)
+        ingr.create_voxelization(
+            image_data, bounding_box, voxel_size, image_size, position
+        )
+        mask = SingleSphereIngr.create_circular_mask(
+            *image_size,
+            center=((position - bounding_box[0]) / voxel_size).astype(int),
+            radius=ingr.radius,
+            voxel_size=voxel_size,
+        )
+        assert numpy.array_equal(image_data == 255, mask)
+
+
+def test_multi_sphere_voxelization():
+    voxel_size = numpy.array([1.0, 1.0, 1.0])
+    image_size = (40, 30, 20)
+    ingr = SimpleNamespace(
+        deepest_level=1,
+        positions=[[[0, 0, 0]], [[-4.0, 0, 0], [4.0, 1.0, 0]]],
+        radii=[[8.0], [3.0, 2.5]],
+        transformPoints=lambda trans, rot, points: Ingredient.transformPoints(
+            None, trans, rot, points
+        ),
+    )
+    position = numpy.array([20.0, 15.0, 10.0])
+    rotation = random_rotation(1)
+    image_data = numpy.zeros(image_size, dtype=numpy.uint8)
+    MultiSphereIngr.create_voxelization(
+        ingr, image_data, bounding_box, voxel_size, image_size, position, rotation
+    )
+    expected = numpy.zeros(image_size, dtype=bool)
+    centers = ingr.transformPoints(position, rotation, ingr.positions[1])
+    for center, radius in zip(centers, ingr.radii[1]):
+        expected |= SingleSphereIngr.create_circular_mask(
+            *image_size,
+            center=(center / voxel_size).astype(int),
+            radius=radius,
+            voxel_size=voxel_size,
+        )
+    assert numpy.array_equal(image_data == 255, expected)
+
+
+@pytest.mark.parametrize(
+    "bounds, position, rotation",
+    [
+        ([[-6, -3, -2], [6, 3, 2]], [38.0, 15.0, 10.0], random_rotation(2)),
+        ([[0, 0, 0], [10, 10, 10]], [15.0, 10.0, 5.0], numpy.identity(4)),
+        ([[0, 0, 0], [10, 6, 4]], [15.25, 10.5, 5.75], random_rotation(4)),
+    ],
+)
+def test_cube_voxelization(bounds, position, rotation):
+    voxel_size = numpy.array([1.0, 1.0, 1.0])
+    image_size = (40, 30, 20)
+    ingr = SingleCubeIngr(bounds=bounds, name="cube")
+    position = numpy.array(position)
+    image_data = numpy.zeros(image_size, dtype=numpy.uint8)
+    ingr.create_voxelization(
+        image_data, bounding_box, voxel_size, image_size, position, rotation=rotation
+    )
+    # the cube is centered on position + R.center, as in the collision code
+    center = position + rotation[:3, :3] @ ingr.center
+    local_points = (voxel_positions(image_size, voxel_size) - center) @ rotation[:3, :3]
+    expected = numpy.all(numpy.abs(local_points) <= ingr.edges / 2.0, axis=-1)
+    assert expected.any()
+    assert numpy.array_equal(image_data == 255, expected)
+    distances = numpy.linalg.norm(
+        voxel_positions(image_size, voxel_size)[expected] - position, axis=-1
+    )
+    assert distances.max() <= ingr.get_voxelization_radius()
+
+
+def test_non_centered_cube_voxel_count():
+    ingr = SingleCubeIngr(bounds=[[0, 0, 0], [10, 10, 10]], name="cube")
+    image_data = numpy.zeros((40, 30, 20), dtype=numpy.uint8)
+    ingr.create_voxelization(
+        image_data,
+        bounding_box,
+        numpy.array([1.0, 1.0, 1.0]),
+        image_data.shape,
+        numpy.array([15.0, 10.0, 5.0]),
+    )
+    assert numpy.count_nonzero(image_data) == 11**3
+
+
+def test_cylinder_voxelization():
+    voxel_size = numpy.array([1.0, 1.0, 2.0])
+    image_size = (40, 30, 10)
+    ingr = SingleCylinderIngr(
+        bounds=numpy.array([[0.0, 0.0, 0.0], [0.0, 0.0, 16.0]]),
+        radius=3.0,
+        name="cylinder",
+    )
+    position = numpy.array([12.0, 14.0, 9.0])
+    rotation = random_rotation(3)
+    image_data = numpy.zeros(image_size, dtype=numpy.uint8)
+    ingr.create_voxelization(
+        image_data, bounding_box, voxel_size, image_size, position, rotation=rotation
+    )
+    axis = rotation[:3, :3] @ numpy.array([0.0, 0.0, 16.0])
+    relative = voxel_positions(image_size, voxel_size) - (position - axis / 2)
+    t = relative @ axis / axis.dot(axis)
+    distances = numpy.linalg.norm(relative - t[..., None] * axis, axis=-1)
+    expected = (t >= 0) & (t <= 1) & (distances <= 3.0)
+    assert expected.any()
+    assert numpy.array_equal(image_data == 255, expected)